@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный бенчмарк входа: пропускная способность /api/auth/login и
+задержки p50/p95/p99 при параллельных клиентах.
+
+Сервер запускается через uvicorn в отдельном процессе с временной базой.
+Параллельно с входами измеряется задержка /api/health: bcrypt не должен
+задерживать остальные запросы.
+
+Примеры:
+    python benchmark_login.py --concurrency 32 --requests 2000
+    python benchmark_login.py --rounds 12 --seed-rounds 10 --json login.json
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentiles(latencies):
+    if not latencies:
+        return {}
+    latencies = sorted(latencies)
+    return {p: round(latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] * 1000, 2) for p in (50, 95, 99)}
+
+
+def post(url, payload):
+    request = urllib.request.Request(url, json.dumps(payload).encode('utf-8'), {'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=60) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def get(url):
+    try:
+        with urllib.request.urlopen(url, timeout=60) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def seed_users(db_path, count, rounds):
+    # Один хеш на всех: посев не должен занимать больше самого бенчмарка
+    hashed = bcrypt.hashpw(b'password', bcrypt.gensalt(rounds)).decode('utf-8')
+    conn = sqlite3.connect(db_path)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            role TEXT NOT NULL,
+            office_id INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.executemany(
+        "INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, 'client')",
+        [(f'user{i}', f'user{i}@example.com', hashed) for i in range(count)]
+    )
+    conn.commit()
+    conn.close()
+
+
+def start_server(args, workdir, db_path, port):
+    env = {
+        **os.environ,
+        'DB_PATH': db_path,
+        'BCRYPT_ROUNDS': str(args.rounds),
+        'PORT': str(port),
+    }
+    if args.workers:
+        env['PASSWORD_WORKERS'] = str(args.workers)
+    if args.max_pending is not None:
+        env['PASSWORD_MAX_PENDING'] = str(args.max_pending)
+    command = [sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port), '--log-level', 'warning',
+               '--app-dir', os.path.dirname(os.path.abspath(__file__))]
+    server = subprocess.Popen(command, env=env, cwd=workdir, stdout=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if get(f'{url}/api/health') == 200:
+                return server, url
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('Server did not start in 30s')
+
+
+def run(args, url):
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def login(i):
+        payload = {'email': f'user{i % args.users}@example.com', 'password': 'password'}
+        started = time.perf_counter()
+        code = post(f'{url}/api/auth/login', payload)
+        elapsed = time.perf_counter() - started
+        with lock:
+            statuses[code] = statuses.get(code, 0) + 1
+            if code == 200:
+                latencies.append(elapsed)
+
+    # Задержка легкого запроса, пока идут входы
+    health = []
+
+    def probe():
+        while not done.is_set():
+            started = time.perf_counter()
+            get(f'{url}/api/health')
+            health.append(time.perf_counter() - started)
+            time.sleep(args.probe_interval)
+
+    prober = threading.Thread(target=probe, daemon=True)
+    prober.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(login, range(args.requests)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    prober.join()
+
+    return {
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'rounds': args.rounds,
+        'seed_rounds': args.seed_rounds,
+        'elapsed_sec': round(elapsed, 3),
+        'logins_per_sec': round(statuses.get(200, 0) / elapsed, 1),
+        'statuses': {str(code): count for code, count in sorted(statuses.items())},
+        'login_ms': percentiles(latencies),
+        'health_ms': percentiles(health),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Login throughput benchmark')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=int(os.getenv('BCRYPT_ROUNDS', 12)),
+                        help='стоимость bcrypt на сервере')
+    parser.add_argument('--seed-rounds', type=int, help='стоимость хешей в базе (ниже --rounds - проверка пересчета)')
+    parser.add_argument('--workers', type=int, help='PASSWORD_WORKERS сервера')
+    parser.add_argument('--max-pending', type=int, help='PASSWORD_MAX_PENDING сервера')
+    parser.add_argument('--probe-interval', type=float, default=0.05)
+    parser.add_argument('--json', help='сохранить результат в JSON-файл')
+    args = parser.parse_args()
+    if args.seed_rounds is None:
+        args.seed_rounds = args.rounds
+
+    with tempfile.TemporaryDirectory(prefix='login-bench-') as workdir:
+        db_path = os.path.join(workdir, 'bench.db')
+        seed_users(db_path, args.users, args.seed_rounds)
+        server, url = start_server(args, workdir, db_path, free_port())
+        try:
+            result = run(args, url)
+        finally:
+            server.terminate()
+            server.wait()
+
+        conn = sqlite3.connect(db_path)
+        result['rehashed_users'] = conn.execute(
+            'SELECT COUNT(*) FROM users WHERE password LIKE ?', (f'$2b${args.rounds:02d}$%',)
+        ).fetchone()[0] if args.seed_rounds != args.rounds else 0
+        conn.close()
+
+    login_ms, health_ms = result['login_ms'], result['health_ms']
+    print(f"{result['logins_per_sec']} logins/sec, statuses {result['statuses']}")
+    print(f"login  p50 {login_ms.get(50)} ms, p95 {login_ms.get(95)} ms, p99 {login_ms.get(99)} ms")
+    print(f"health p50 {health_ms.get(50)} ms, p95 {health_ms.get(95)} ms, p99 {health_ms.get(99)} ms")
+    if args.seed_rounds != args.rounds:
+        print(f"rehashed users: {result['rehashed_users']} of {args.users}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
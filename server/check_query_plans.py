@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Проверка схемы main.py на временной базе: планы горячих запросов
+(EXPLAIN QUERY PLAN) не содержат полного просмотра таблиц и сортировки во
+временном B-дереве, а employee_count, поддерживаемый триггерами, совпадает
+с фактическим числом сотрудников.
+
+Запуск: python check_query_plans.py; код возврата 1 при нарушении.
+"""
+
+import os
+import sys
+import sqlite3
+import tempfile
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def query_plan(conn, sql, params):
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+
+def check_plans(main, conn):
+    # (название, запрос, параметры, ожидаемые фрагменты плана)
+    checks = [
+        ("offices list", main.OFFICES_LIST_SQL, (-1,), ["idx_offices_name"]),
+        ("offices page", main.OFFICES_AFTER_SQL, ("A", 1, 100), ["SEARCH offices USING INDEX idx_offices_name"]),
+        ("offices boundary", main.OFFICES_BOUNDARY_SQL, (99,), ["idx_offices_name"]),
+        ("offices boundary+", main.OFFICES_BOUNDARY_AFTER_SQL, ("A", 1, 99),
+         ["SEARCH offices USING COVERING INDEX idx_offices_name"]),
+        ("office by id", main.OFFICE_BY_ID_SQL, (1,), ["USING INTEGER PRIMARY KEY"]),
+        ("user by id", main.USER_BY_ID_SQL, (1,), ["USING INTEGER PRIMARY KEY"]),
+        ("login", main.LOGIN_SQL, ("a@example.com", "a@example.com"),
+         ["sqlite_autoindex_users", "idx_users_username"]),
+        ("office employees", "SELECT COUNT(*) FROM users WHERE office_id = ?", (1,), ["idx_users_office_id"]),
+    ]
+    failures = []
+    for name, sql, params, expected in checks:
+        plan = query_plan(conn, sql, params)
+        text = " | ".join(plan)
+        print(f"{name:<18} {text}")
+        # SCAN по индексу допустим только для полного списка офисов в порядке индекса
+        full_scans = [step for step in plan if step.startswith("SCAN") and "INDEX" not in step]
+        if full_scans:
+            failures.append(f"{name}: full table scan ({', '.join(full_scans)})")
+        if any("TEMP B-TREE" in step for step in plan):
+            failures.append(f"{name}: sorts in a temporary B-tree")
+        for fragment in expected:
+            if fragment not in text:
+                failures.append(f"{name}: plan does not use {fragment}")
+    return failures
+
+
+def check_employee_count(conn):
+    conn.execute("INSERT INTO offices (name) VALUES ('A')")
+    conn.execute("INSERT INTO offices (name) VALUES ('B')")
+    users = [("u1", "u1@example.com", 1), ("u2", "u2@example.com", 1), ("u3", "u3@example.com", 2),
+             ("u4", "u4@example.com", None), ("u5", "u5@example.com", 3)]
+    conn.executemany(
+        "INSERT INTO users (username, email, password, role, office_id) VALUES (?, ?, 'x', 'office', ?)", users
+    )
+    conn.execute("UPDATE users SET office_id = 2 WHERE username = 'u1'")
+    conn.execute("UPDATE users SET office_id = 1 WHERE username = 'u4'")
+    conn.execute("DELETE FROM users WHERE username = 'u2'")
+    # Офис создается после пользователя, который уже на него ссылается
+    conn.execute("INSERT INTO offices (name) VALUES ('C')")
+
+    mismatches = conn.execute("""
+        SELECT o.id, o.employee_count, COUNT(u.id) AS actual
+        FROM offices o LEFT JOIN users u ON u.office_id = o.id
+        GROUP BY o.id
+        HAVING o.employee_count != actual
+    """).fetchall()
+    return [f"office {row[0]}: employee_count {row[1]}, actual {row[2]}" for row in mismatches]
+
+
+def main():
+    with tempfile.TemporaryDirectory(prefix="query-plans-") as workdir:
+        os.environ["DB_PATH"] = os.path.join(workdir, "check.db")
+        # main.py создает uploads в текущем каталоге
+        os.chdir(workdir)
+        sys.path.insert(0, SERVER_DIR)
+        import main
+
+        main.db.close()
+        conn = sqlite3.connect(os.environ["DB_PATH"])
+        print(f"schema version {conn.execute('PRAGMA user_version').fetchone()[0]} of {len(main.MIGRATIONS)}")
+        failures = check_plans(main, conn)
+        failures += check_employee_count(conn)
+        conn.close()
+
+    if failures:
+        print("FAILED:", file=sys.stderr)
+        for failure in failures:
+            print(f"  {failure}", file=sys.stderr)
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Слой доступа к SQLite для main.py: общий ограниченный пул соединений.
+
+Все соединения открываются к одному файлу (get_db_path) в режиме WAL, поэтому
+читатели не ждут завершения записи. Каждое соединение держит кэш
+подготовленных выражений (cached_statements), и повторные запросы с тем же
+текстом SQL не компилируются заново.
+"""
+
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Размер пула и ожидание свободного соединения, сек
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 8))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 5))
+# Сколько ждать снятия блокировки записи другим соединением, мс
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", 5000))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", 256 * 2 ** 20))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", 16 * 1024))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", 256))
+
+
+def get_db_path():
+    # DB_PATH задает путь явно; на Render диск проекта только для чтения
+    if os.getenv("DB_PATH"):
+        return os.getenv("DB_PATH")
+    return '/tmp/lawtech.db' if os.getenv('RENDER') else 'lawtech.db'
+
+
+class PoolTimeout(Exception):
+    """Свободное соединение не появилось за DB_POOL_TIMEOUT секунд."""
+
+
+class ConnectionPool:
+    """Ограниченный пул соединений SQLite.
+
+    Соединения создаются по мере надобности, но не больше ``size``; лишние
+    запросы ждут освобождения не дольше ``timeout`` и получают PoolTimeout.
+    Соединения работают в режиме autocommit: чтение идет без явной
+    транзакции, запись - через ``transaction()``.
+    """
+
+    def __init__(self, path, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(size)
+        # LIFO: чаще используются уже прогретые соединения
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.closed = False
+
+    def _open(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE,
+        )
+        conn.row_factory = sqlite3.Row
+        # journal_mode=WAL сохраняется в файле базы, остальные настройки - на соединение
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def _connect(self):
+        conn = self._open()
+        with self.lock:
+            self.created += 1
+        return conn
+
+    @contextmanager
+    def connection(self):
+        if self.closed:
+            raise RuntimeError("Connection pool is closed")
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f"No free database connection in {self.timeout}s")
+        conn = None
+        try:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            yield conn
+        except BaseException:
+            if conn is not None and conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            if conn is not None:
+                if self.closed:
+                    conn.close()
+                else:
+                    self.idle.put(conn)
+            self.slots.release()
+
+    def dedicated(self):
+        """Отдельное соединение с настройками пула, не занимающее место в пуле.
+
+        Для долгих чтений (потоковая выдача), которые иначе держали бы
+        соединение пула до конца ответа; закрывает вызывающий.
+        """
+        if self.closed:
+            raise RuntimeError("Connection pool is closed")
+        return self._open()
+
+    @contextmanager
+    def transaction(self):
+        """Соединение с транзакцией записи: commit при выходе, rollback при ошибке.
+
+        BEGIN IMMEDIATE сразу берет блокировку записи, поэтому транзакция,
+        начавшаяся с чтения, не получит SQLITE_BUSY при переходе к записи.
+        """
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    def close(self):
+        self.closed = True
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "created": self.created,
+            "idle": self.idle.qsize(),
+        }
+
+
+def migrate(conn, migrations):
+    """Применяет миграции схемы, которых еще нет в базе.
+
+    migrations - список шагов, каждый шаг - список SQL-выражений; номер
+    последнего примененного шага хранится в PRAGMA user_version. Вызывается
+    внутри transaction(): шаг и новый номер версии фиксируются вместе, а
+    воркеры, стартующие одновременно, применяют миграции по очереди.
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, statements in enumerate(migrations[version:], start=version + 1):
+        for statement in statements:
+            conn.execute(statement)
+        conn.execute(f"PRAGMA user_version = {number}")
+        print(f"Applied schema migration {number}")
+
+
+db = ConnectionPool(get_db_path())
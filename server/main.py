@@ -1,18 +1,22 @@
-from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File
+from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File, Query, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from pydantic import BaseModel, EmailStr
-from typing import Optional, List
+from typing import Optional, List, Dict, Any
 import jwt
-import bcrypt
-import sqlite3
 import os
+import json
+import base64
 from datetime import datetime, timedelta
 import uvicorn
 from pathlib import Path
 
+from database import db, migrate, PoolTimeout
+from passwords import hasher, HasherOverloaded
+from principals import principals
+
 # Создаем экземпляр FastAPI
 app = FastAPI(title="LawTech API", version="1.0.0")
 
@@ -42,12 +46,28 @@ app.add_middleware(
 # Конфигурация
 JWT_SECRET = os.getenv("JWT_SECRET", "law-tech-secret-key")
 PORT = int(os.getenv("PORT", 3001))
+# Страница списка офисов: размер по умолчанию и максимальный limit
+OFFICES_PAGE_SIZE = int(os.getenv("OFFICES_PAGE_SIZE", 100))
+OFFICES_PAGE_MAX = int(os.getenv("OFFICES_PAGE_MAX", 1000))
+# Сколько строк читать из курсора за раз при потоковой выдаче
+OFFICES_STREAM_CHUNK = int(os.getenv("OFFICES_STREAM_CHUNK", 200))
 UPLOADS_DIR = Path("uploads")
 UPLOADS_DIR.mkdir(exist_ok=True)
 
 # Создаем директорию для статических файлов
 app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
 
+# Поисковый сервис (scripts/search_api.py) в том же процессе, по пути /faiss.
+# Нужны зависимости из scripts/requirements.txt
+if os.getenv("SEARCH_API_MOUNT") == "1":
+    import sys
+    sys.path.insert(0, str(Path(__file__).parent / "scripts"))
+    from search_api import app as search_app, start_service
+
+    app.mount("/faiss", search_app, name="faiss")
+    # События startup смонтированного приложения не вызываются, запускаем загрузку здесь
+    app.add_event_handler("startup", start_service)
+
 # Схемы Pydantic
 class UserRegister(BaseModel):
     name: str
@@ -76,6 +96,10 @@ class TokenResponse(BaseModel):
 class HealthResponse(BaseModel):
     status: str
     timestamp: str
+    # Загрузка пула соединений, очереди bcrypt и кэша пользователей
+    database: Dict[str, Any]
+    passwords: Dict[str, Any]
+    principals: Dict[str, Any]
 
 class OfficeCreate(BaseModel):
     name: str
@@ -104,68 +128,125 @@ class OfficeResponse(BaseModel):
     online: bool = False
     last_activity: Optional[str] = None
 
-# Функция для получения пути к базе данных
-def get_db_path():
-    return '/tmp/lawtech.db' if os.getenv('RENDER') else 'lawtech.db'
+# Миграции схемы поверх таблиц из init_db; применяются по порядку,
+# номер версии хранится в PRAGMA user_version. Новые шаги - только в конец списка
+MIGRATIONS = [
+    # 1: индексы для выборки сотрудников офиса и входа по имени пользователя
+    [
+        "CREATE INDEX IF NOT EXISTS idx_users_office_id ON users(office_id)",
+        "CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)",
+        "CREATE INDEX IF NOT EXISTS idx_offices_name ON offices(name)",
+    ],
+    # 2: число сотрудников хранится в offices и поддерживается триггерами,
+    # поэтому верно и для записей, сделанных Node.js-сервером в ту же базу
+    [
+        "ALTER TABLE offices ADD COLUMN employee_count INTEGER NOT NULL DEFAULT 0",
+        "UPDATE offices SET employee_count = (SELECT COUNT(*) FROM users WHERE users.office_id = offices.id)",
+        '''
+            CREATE TRIGGER IF NOT EXISTS trg_users_insert_employee_count
+            AFTER INSERT ON users WHEN NEW.office_id IS NOT NULL
+            BEGIN
+                UPDATE offices SET employee_count = employee_count + 1 WHERE id = NEW.office_id;
+            END
+        ''',
+        '''
+            CREATE TRIGGER IF NOT EXISTS trg_users_delete_employee_count
+            AFTER DELETE ON users WHEN OLD.office_id IS NOT NULL
+            BEGIN
+                UPDATE offices SET employee_count = employee_count - 1 WHERE id = OLD.office_id;
+            END
+        ''',
+        '''
+            CREATE TRIGGER IF NOT EXISTS trg_users_update_employee_count
+            AFTER UPDATE OF office_id ON users WHEN OLD.office_id IS NOT NEW.office_id
+            BEGIN
+                UPDATE offices SET employee_count = employee_count - 1 WHERE id = OLD.office_id;
+                UPDATE offices SET employee_count = employee_count + 1 WHERE id = NEW.office_id;
+            END
+        ''',
+        # Пользователь мог указать office_id до создания офиса
+        '''
+            CREATE TRIGGER IF NOT EXISTS trg_offices_insert_employee_count
+            AFTER INSERT ON offices
+            BEGIN
+                UPDATE offices SET employee_count = (SELECT COUNT(*) FROM users WHERE users.office_id = NEW.id)
+                WHERE id = NEW.id;
+            END
+        ''',
+    ],
+]
 
 # Инициализация базы данных
 def init_db():
-    db_path = get_db_path()
-    print(f"Database path: {db_path}")
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    # Создаем таблицу пользователей если её нет
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            role TEXT NOT NULL,
-            office_id INTEGER,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Создаем таблицу офисов если её нет
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS offices (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            address TEXT,
-            contact_phone TEXT,
-            work_phone2 TEXT,
-            website TEXT,
-            revenue INTEGER DEFAULT 0,
-            orders INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    print(f"Database path: {db.path}")
+    with db.transaction() as conn:
+        # Создаем таблицу пользователей если её нет
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT NOT NULL,
+                email TEXT UNIQUE NOT NULL,
+                password TEXT NOT NULL,
+                role TEXT NOT NULL,
+                office_id INTEGER,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Создаем таблицу офисов если её нет
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS offices (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                address TEXT,
+                contact_phone TEXT,
+                work_phone2 TEXT,
+                website TEXT,
+                revenue INTEGER DEFAULT 0,
+                orders INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        migrate(conn, MIGRATIONS)
+
     print("✅ База данных инициализирована")
 
-# Инициализируем БД при запуске
-init_db()
+@app.on_event("shutdown")
+def close_db():
+    principals.stop()
+    db.close()
+    hasher.shutdown()
+
+# Пул исчерпан: клиент может повторить запрос позже
+@app.exception_handler(PoolTimeout)
+async def pool_timeout_handler(request, exc):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "База данных перегружена, повторите запрос позже"},
+        headers={"Retry-After": "1"},
+    )
 
-# Утилиты для работы с БД
-def get_db_connection():
-    conn = sqlite3.connect(get_db_path())
-    conn.row_factory = sqlite3.Row
-    return conn
+# Очередь на хеширование паролей заполнена
+@app.exception_handler(HasherOverloaded)
+async def hasher_overloaded_handler(request, exc):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Сервер перегружен, повторите запрос позже"},
+        headers={"Retry-After": "1"},
+    )
 
 # Утилиты для аутентификации
 security = HTTPBearer()
 
+# bcrypt выполняется в отдельном пуле (passwords.py), вызывающий поток ждет результата
 def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    return hasher.hash(password)
 
 def verify_password(password: str, hashed: str) -> bool:
-    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    return hasher.verify(password, hashed)
 
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -175,6 +256,10 @@ def create_access_token(data: dict):
     return encoded_jwt
 
 def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    # Уже проверенный токен не декодируем повторно до истечения его exp
+    user_id = principals.tokens.get(credentials.credentials)
+    if user_id is not None:
+        return user_id
     try:
         payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=["HS256"])
         user_id: int = payload.get("id")
@@ -184,6 +269,8 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
                 detail="Invalid authentication credentials",
                 headers={"WWW-Authenticate": "Bearer"},
             )
+        # Токен без exp бессрочен для jwt.decode; в кэше он живет PRINCIPAL_CACHE_TTL
+        principals.tokens.set(credentials.credentials, user_id, expires_at=payload.get("exp"))
         return user_id
     except jwt.PyJWTError:
         raise HTTPException(
@@ -197,24 +284,30 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
 async def health_check():
     return HealthResponse(
         status="OK",
-        timestamp=datetime.now().isoformat()
+        timestamp=datetime.now().isoformat(),
+        database=db.stats(),
+        passwords=hasher.stats(),
+        principals=principals.stats()
     )
 
+LOGIN_SQL = "SELECT id, username, email, password, role, office_id FROM users WHERE email = ? OR username = ?"
+USER_BY_ID_SQL = "SELECT id, username, email, role, office_id FROM users WHERE id = ?"
+
+# Обработчики с запросами к БД объявлены через def: FastAPI выполняет их
+# в пуле потоков, и блокирующий sqlite3 не останавливает цикл событий
 @app.post("/api/auth/register", response_model=TokenResponse)
-async def register(user_data: UserRegister):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+def register(user_data: UserRegister):
     try:
         # Проверяем, существует ли пользователь
-        cursor.execute("SELECT id FROM users WHERE email = ?", (user_data.email,))
-        if cursor.fetchone():
+        with db.connection() as conn:
+            existing = conn.execute("SELECT id FROM users WHERE email = ?", (user_data.email,)).fetchone()
+        if existing:
             raise HTTPException(
                 status_code=status.HTTP_409_CONFLICT,
                 detail="Пользователь с таким email уже существует"
             )
         
-        # Хешируем пароль
+        # Хешируем пароль вне транзакции, чтобы не держать блокировку записи
         hashed_password = hash_password(user_data.password)
         
         # Определяем office_id
@@ -223,13 +316,13 @@ async def register(user_data: UserRegister):
             final_office_id = user_data.officeId
         
         # Создаем пользователя
-        cursor.execute(
-            "INSERT INTO users (username, email, password, role, office_id) VALUES (?, ?, ?, ?, ?)",
-            (user_data.name, user_data.email, hashed_password, user_data.userType, final_office_id)
-        )
-        
-        user_id = cursor.lastrowid
-        conn.commit()
+        with db.transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO users (username, email, password, role, office_id) VALUES (?, ?, ?, ?, ?)",
+                (user_data.name, user_data.email, hashed_password, user_data.userType, final_office_id)
+            )
+            user_id = cursor.lastrowid
+            principals.invalidate(user_id, conn)
         
         # Создаем токен
         token = create_access_token({
@@ -253,8 +346,9 @@ async def register(user_data: UserRegister):
             user=user_response
         )
         
+    except (HTTPException, PoolTimeout, HasherOverloaded):
+        raise
     except Exception as e:
-        conn.rollback()
         if "UNIQUE constraint failed" in str(e):
             raise HTTPException(
                 status_code=status.HTTP_409_CONFLICT,
@@ -264,168 +358,215 @@ async def register(user_data: UserRegister):
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Внутренняя ошибка сервера"
         )
-    finally:
-        conn.close()
 
 @app.post("/api/auth/login", response_model=TokenResponse)
-async def login(user_data: UserLogin):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def login(user_data: UserLogin):
+    # Ищем пользователя
+    with db.connection() as conn:
+        user = conn.execute(LOGIN_SQL, (user_data.email, user_data.email)).fetchone()
     
-    try:
-        # Ищем пользователя
-        cursor.execute(
-            "SELECT id, username, email, password, role, office_id FROM users WHERE email = ? OR username = ?",
-            (user_data.email, user_data.email)
-        )
-        user = cursor.fetchone()
-        
-        if not user or not verify_password(user_data.password, user['password']):
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Неверный email или пароль"
-            )
-        
-        # Создаем токен
-        token = create_access_token({
-            "id": user['id'],
-            "email": user['email'],
-            "role": user['role']
-        })
-        
-        # Возвращаем ответ
-        user_response = UserResponse(
-            id=user['id'],
-            username=user['username'],
-            email=user['email'],
-            role=user['role'],
-            office_id=user['office_id']
-        )
-        
-        return TokenResponse(
-            message="Успешная авторизация",
-            token=token,
-            user=user_response
+    if not user or not verify_password(user_data.password, user['password']):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Неверный email или пароль"
         )
-        
-    finally:
-        conn.close()
+    
+    # Хеш с устаревшей стоимостью пересчитываем в фоне; условие на старый
+    # хеш не дает затереть пароль, смененный за это время
+    if hasher.needs_rehash(user['password']):
+        def save_rehash(new_hash, user_id=user['id'], old_hash=user['password']):
+            with db.transaction() as conn:
+                conn.execute(
+                    "UPDATE users SET password = ?, updated_at = datetime('now') WHERE id = ? AND password = ?",
+                    (new_hash, user_id, old_hash)
+                )
+                principals.invalidate(user_id, conn)
+        hasher.rehash_later(user['id'], user_data.password, save_rehash)
+    
+    # Создаем токен
+    token = create_access_token({
+        "id": user['id'],
+        "email": user['email'],
+        "role": user['role']
+    })
+    
+    # Возвращаем ответ
+    user_response = UserResponse(
+        id=user['id'],
+        username=user['username'],
+        email=user['email'],
+        role=user['role'],
+        office_id=user['office_id']
+    )
+    
+    return TokenResponse(
+        message="Успешная авторизация",
+        token=token,
+        user=user_response
+    )
 
 @app.get("/api/auth/me", response_model=UserResponse)
-async def get_current_user(user_id: int = Depends(verify_token)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def get_current_user(user_id: int = Depends(verify_token)):
+    # Пользователь из кэша; каждое изменение строки users вызывает
+    # principals.invalidate(user_id, conn) в той же транзакции
+    cached = principals.users.get(user_id)
+    if cached is not None:
+        return cached
     
-    try:
-        cursor.execute(
-            "SELECT id, username, email, role, office_id FROM users WHERE id = ?",
-            (user_id,)
+    with db.connection() as conn:
+        user = conn.execute(USER_BY_ID_SQL, (user_id,)).fetchone()
+    
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Пользователь не найден"
         )
-        user = cursor.fetchone()
-        
-        if not user:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Пользователь не найден"
-            )
-        
-        return UserResponse(
-            id=user['id'],
-            username=user['username'],
-            email=user['email'],
-            role=user['role'],
-            office_id=user['office_id']
+    
+    principal = UserResponse(
+        id=user['id'],
+        username=user['username'],
+        email=user['email'],
+        role=user['role'],
+        office_id=user['office_id']
+    )
+    principals.users.set(user_id, principal)
+    return principal
+
+# Запросы офисов; постоянный текст SQL попадает в кэш подготовленных выражений.
+# employee_count хранится в offices (миграция 2), соединение с users не нужно
+# Порядок (name, id) берется из idx_offices_name (индекс хранит rowid), а
+# продолжение после курсора - диапазонный поиск по нему же. LIMIT -1 - без ограничения
+OFFICES_LIST_SQL = "SELECT * FROM offices ORDER BY name, id LIMIT ?"
+OFFICES_AFTER_SQL = "SELECT * FROM offices WHERE (name, id) > (?, ?) ORDER BY name, id LIMIT ?"
+OFFICE_BY_ID_SQL = "SELECT * FROM offices WHERE id = ?"
+# Последняя строка страницы и следующая за ней: по ним строится X-Next-Cursor
+# потоковой выдачи, которая не может прочитать лишнюю строку заранее
+OFFICES_BOUNDARY_SQL = "SELECT name, id FROM offices ORDER BY name, id LIMIT 2 OFFSET ?"
+OFFICES_BOUNDARY_AFTER_SQL = "SELECT name, id FROM offices WHERE (name, id) > (?, ?) ORDER BY name, id LIMIT 2 OFFSET ?"
+
+def encode_cursor(office) -> str:
+    return base64.urlsafe_b64encode(json.dumps([office['name'], office['id']]).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor: str):
+    try:
+        name, office_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if not isinstance(name, str) or not isinstance(office_id, int):
+            raise ValueError(cursor)
+        return name, office_id
+    except (ValueError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Некорректный курсор"
         )
-        
-    finally:
-        conn.close()
+
+def offices_query(cursor: Optional[str], limit: int):
+    if cursor is None:
+        return OFFICES_LIST_SQL, (limit,)
+    return OFFICES_AFTER_SQL, (*decode_cursor(cursor), limit)
+
+def offices_boundary_query(cursor: Optional[str], limit: int):
+    if cursor is None:
+        return OFFICES_BOUNDARY_SQL, (limit - 1,)
+    return OFFICES_BOUNDARY_AFTER_SQL, (*decode_cursor(cursor), limit - 1)
+
+def office_response(office) -> OfficeResponse:
+    return OfficeResponse(
+        id=office['id'],
+        name=office['name'],
+        address=office['address'],
+        contact_phone=office['contact_phone'],
+        work_phone2=office['work_phone2'],
+        website=office['website'],
+        employee_count=office['employee_count'],
+        revenue=office['revenue'] or 0,
+        orders=office['orders'] or 0,
+        online=False,
+        last_activity=None
+    )
 
 # API роуты для офисов
 @app.get("/api/offices", response_model=List[OfficeResponse])
-async def get_offices(current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect('database.db')
-    conn.row_factory = sqlite3.Row
+def get_offices(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=OFFICES_PAGE_MAX),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    current_user: dict = Depends(get_current_user),
+):
+    # Без limit и cursor возвращается весь список, как раньше. С ними -
+    # страница в порядке (name, id); курсор следующей страницы в X-Next-Cursor
+    paginated = limit is not None or cursor is not None
+    if paginated and limit is None:
+        limit = OFFICES_PAGE_SIZE
+    
+    if stream:
+        headers = {}
+        conn = db.dedicated()
+        try:
+            # Курсор нужен до отправки заголовков. Поиск границы страницы и
+            # выдача идут в одной транзакции чтения и видят одни и те же строки
+            conn.execute("BEGIN")
+            if paginated:
+                boundary = conn.execute(*offices_boundary_query(cursor, limit)).fetchall()
+                if len(boundary) > 1:
+                    headers["X-Next-Cursor"] = encode_cursor(boundary[0])
+            sql, params = offices_query(cursor, limit if paginated else -1)
+        except BaseException:
+            conn.close()
+            raise
+        return StreamingResponse(stream_offices(conn, sql, params), media_type="application/json", headers=headers)
+    
+    # Лишняя строка показывает, есть ли следующая страница
+    sql, params = offices_query(cursor, limit + 1 if paginated else -1)
+    with db.connection() as conn:
+        offices = conn.execute(sql, params).fetchall()
     
+    if paginated and len(offices) > limit:
+        offices = offices[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(offices[-1])
+    
+    return [office_response(office) for office in offices]
+
+def stream_offices(conn, sql, params):
+    """JSON-массив офисов частями по мере чтения из курсора.
+
+    В памяти одновременно не больше OFFICES_STREAM_CHUNK строк, первый байт
+    уходит клиенту до чтения всей таблицы. Генератор выполняется Starlette
+    в пуле потоков; conn - отдельное соединение (db.dedicated), поэтому
+    медленный клиент не занимает соединение пула. Генератор его закрывает.
+    """
     try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT o.*, COUNT(u.id) as employee_count
-            FROM offices o
-            LEFT JOIN users u ON u.office_id = o.id
-            GROUP BY o.id
-            ORDER BY o.name
-        """)
-        
-        offices = cursor.fetchall()
-        
-        return [
-            OfficeResponse(
-                id=office['id'],
-                name=office['name'],
-                address=office['address'],
-                contact_phone=office['contact_phone'],
-                work_phone2=office['work_phone2'],
-                website=office['website'],
-                employee_count=office['employee_count'],
-                revenue=office['revenue'] or 0,
-                orders=office['orders'] or 0,
-                online=False,
-                last_activity=None
-            )
-            for office in offices
-        ]
-        
+        rows = conn.execute(sql, params)
+        yield "["
+        separator = ""
+        while True:
+            chunk = rows.fetchmany(OFFICES_STREAM_CHUNK)
+            if not chunk:
+                break
+            yield separator + ",".join(office_response(office).model_dump_json() for office in chunk)
+            separator = ","
+        yield "]"
     finally:
+        # Незавершенная транзакция чтения держит снимок и мешает checkpoint WAL
         conn.close()
 
 @app.get("/api/offices/{office_id}", response_model=OfficeResponse)
-async def get_office(office_id: int, current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect('database.db')
-    conn.row_factory = sqlite3.Row
+def get_office(office_id: int, current_user: dict = Depends(get_current_user)):
+    with db.connection() as conn:
+        office = conn.execute(OFFICE_BY_ID_SQL, (office_id,)).fetchone()
     
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT o.*, COUNT(u.id) as employee_count
-            FROM offices o
-            LEFT JOIN users u ON u.office_id = o.id
-            WHERE o.id = ?
-            GROUP BY o.id
-        """, (office_id,))
-        
-        office = cursor.fetchone()
-        
-        if not office:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Офис не найден"
-            )
-        
-        return OfficeResponse(
-            id=office['id'],
-            name=office['name'],
-            address=office['address'],
-            contact_phone=office['contact_phone'],
-            work_phone2=office['work_phone2'],
-            website=office['website'],
-            employee_count=office['employee_count'],
-            revenue=office['revenue'] or 0,
-            orders=office['orders'] or 0,
-            online=False,
-            last_activity=None
+    if not office:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Офис не найден"
         )
-        
-    finally:
-        conn.close()
+    
+    return office_response(office)
 
 @app.post("/api/offices", response_model=OfficeResponse)
-async def create_office(office_data: OfficeCreate, current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect('database.db')
-    conn.row_factory = sqlite3.Row
-    
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
+def create_office(office_data: OfficeCreate, current_user: dict = Depends(get_current_user)):
+    with db.transaction() as conn:
+        cursor = conn.execute("""
             INSERT INTO offices (name, address, contact_phone, work_phone2, website, created_at, updated_at)
             VALUES (?, ?, ?, ?, ?, datetime('now'), datetime('now'))
         """, (
@@ -436,46 +577,16 @@ async def create_office(office_data: OfficeCreate, current_user: dict = Depends(
             office_data.website
         ))
         
-        office_id = cursor.lastrowid
-        conn.commit()
-        
         # Получаем созданный офис
-        cursor.execute("""
-            SELECT o.*, 0 as employee_count
-            FROM offices o
-            WHERE o.id = ?
-        """, (office_id,))
-        
-        office = cursor.fetchone()
-        
-        return OfficeResponse(
-            id=office['id'],
-            name=office['name'],
-            address=office['address'],
-            contact_phone=office['contact_phone'],
-            work_phone2=office['work_phone2'],
-            website=office['website'],
-            employee_count=0,
-            revenue=office['revenue'] or 0,
-            orders=office['orders'] or 0,
-            online=False,
-            last_activity=None
-        )
-        
-    finally:
-        conn.close()
+        office = conn.execute(OFFICE_BY_ID_SQL, (cursor.lastrowid,)).fetchone()
+    
+    return office_response(office)
 
 @app.put("/api/offices/{office_id}", response_model=OfficeResponse)
-async def update_office(office_id: int, office_data: OfficeUpdate, current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect('database.db')
-    conn.row_factory = sqlite3.Row
-    
-    try:
-        cursor = conn.cursor()
-        
+def update_office(office_id: int, office_data: OfficeUpdate, current_user: dict = Depends(get_current_user)):
+    with db.transaction() as conn:
         # Проверяем существование офиса
-        cursor.execute("SELECT id FROM offices WHERE id = ?", (office_id,))
-        if not cursor.fetchone():
+        if not conn.execute("SELECT id FROM offices WHERE id = ?", (office_id,)).fetchone():
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Офис не найден"
@@ -509,71 +620,38 @@ async def update_office(office_id: int, office_data: OfficeUpdate, current_user:
             update_fields.append("updated_at = datetime('now')")
             update_values.append(office_id)
             
-            cursor.execute(f"""
+            conn.execute(f"""
                 UPDATE offices 
                 SET {', '.join(update_fields)}
                 WHERE id = ?
             """, update_values)
-            
-            conn.commit()
         
         # Получаем обновленный офис
-        cursor.execute("""
-            SELECT o.*, COUNT(u.id) as employee_count
-            FROM offices o
-            LEFT JOIN users u ON u.office_id = o.id
-            WHERE o.id = ?
-            GROUP BY o.id
-        """, (office_id,))
-        
-        office = cursor.fetchone()
-        
-        return OfficeResponse(
-            id=office['id'],
-            name=office['name'],
-            address=office['address'],
-            contact_phone=office['contact_phone'],
-            work_phone2=office['work_phone2'],
-            website=office['website'],
-            employee_count=office['employee_count'],
-            revenue=office['revenue'] or 0,
-            orders=office['orders'] or 0,
-            online=False,
-            last_activity=None
-        )
-        
-    finally:
-        conn.close()
+        office = conn.execute(OFFICE_BY_ID_SQL, (office_id,)).fetchone()
+    
+    return office_response(office)
 
 @app.delete("/api/offices/{office_id}")
-async def delete_office(office_id: int, current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect('database.db')
-    
-    try:
-        cursor = conn.cursor()
-        
+def delete_office(office_id: int, current_user: dict = Depends(get_current_user)):
+    with db.transaction() as conn:
         # Проверяем существование офиса
-        cursor.execute("SELECT id FROM offices WHERE id = ?", (office_id,))
-        if not cursor.fetchone():
+        if not conn.execute("SELECT id FROM offices WHERE id = ?", (office_id,)).fetchone():
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Офис не найден"
             )
         
         # Удаляем офис
-        cursor.execute("DELETE FROM offices WHERE id = ?", (office_id,))
-        conn.commit()
-        
-        return {"message": "Офис успешно удален"}
-        
-    finally:
-        conn.close()
+        conn.execute("DELETE FROM offices WHERE id = ?", (office_id,))
+    
+    return {"message": "Офис успешно удален"}
 
 # SPA обработка удалена - фронтенд развертывается отдельно на Render
 
 # Инициализируем базу данных при запуске
 print("Initializing database...")
 init_db()
+principals.start(db)
 print("Database initialized successfully")
 print(f"Server starting on port {PORT}")
 print(f"JWT_SECRET configured: {'Yes' if JWT_SECRET else 'No'}")
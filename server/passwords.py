@@ -0,0 +1,118 @@
+"""
+Хеширование паролей bcrypt в отдельном ограниченном пуле потоков.
+
+bcrypt отпускает GIL, поэтому потоков достаточно: пул ограничивает число
+одновременных хеширований числом ядер, а PASSWORD_MAX_PENDING - число
+ожидающих запросов, сверх которого вход и регистрация сразу получают 503.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+# Стоимость bcrypt: каждое увеличение на 1 удваивает время хеширования
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", os.cpu_count() or 2))
+# Должно быть меньше пула потоков FastAPI (40), иначе входы займут все потоки
+# и остальные обработчики будут ждать
+PASSWORD_MAX_PENDING = int(os.getenv("PASSWORD_MAX_PENDING", max(16, 2 * PASSWORD_WORKERS)))
+# Одновременных фоновых пересчетов устаревших хешей; они не занимают места
+# в очереди входов и запускаются, только пока очередь заполнена меньше чем наполовину
+PASSWORD_REHASH_MAX = int(os.getenv("PASSWORD_REHASH_MAX", max(1, PASSWORD_WORKERS // 2)))
+
+
+class HasherOverloaded(Exception):
+    """В очереди на хеширование уже PASSWORD_MAX_PENDING запросов."""
+
+
+class PasswordHasher:
+    def __init__(self, rounds=BCRYPT_ROUNDS, workers=PASSWORD_WORKERS, max_pending=PASSWORD_MAX_PENDING,
+                 rehash_max=PASSWORD_REHASH_MAX):
+        self.rounds = rounds
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.workers = workers
+        self.max_pending = max_pending
+        self.rehash_max = rehash_max
+        self.lock = threading.Lock()
+        self.pending = 0
+        # Пользователи, чей хеш сейчас пересчитывается
+        self.rehashing = set()
+        self.rejected = 0
+        self.rehashed = 0
+
+    def _run(self, fn, *args):
+        with self.lock:
+            if self.max_pending > 0 and self.pending >= self.max_pending:
+                self.rejected += 1
+                raise HasherOverloaded("Too many pending password operations")
+            self.pending += 1
+        try:
+            return self.executor.submit(fn, *args).result()
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def _hash(self, password):
+        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(self.rounds)).decode('utf-8')
+
+    def hash(self, password: str) -> str:
+        return self._run(self._hash, password)
+
+    def verify(self, password: str, hashed: str) -> bool:
+        return self._run(bcrypt.checkpw, password.encode('utf-8'), hashed.encode('utf-8'))
+
+    def needs_rehash(self, hashed: str) -> bool:
+        # Формат хеша: $2b$12$<соль и хеш>; устаревшими считаются
+        # другая версия алгоритма и стоимость ниже BCRYPT_ROUNDS
+        parts = hashed.split('$')
+        if len(parts) < 4 or parts[1] != '2b' or not parts[2].isdigit():
+            return True
+        return int(parts[2]) < self.rounds
+
+    def rehash_later(self, user_id, password: str, save) -> bool:
+        """Пересчитывает хеш в фоне и передает его в save(new_hash).
+
+        Ответ на вход не ждет пересчета. Пересчет пропускается, если хеш
+        этого пользователя уже пересчитывается, занято rehash_max мест или
+        очередь входов заполнена наполовину: хеш обновится при одном из
+        следующих входов.
+        """
+        with self.lock:
+            if (user_id in self.rehashing or len(self.rehashing) >= self.rehash_max
+                    or self.max_pending > 0 and self.pending >= self.max_pending // 2):
+                return False
+            self.rehashing.add(user_id)
+
+        def rehash():
+            try:
+                save(self._hash(password))
+                with self.lock:
+                    self.rehashed += 1
+            except Exception as e:
+                print(f"Password rehash failed: {e}")
+            finally:
+                with self.lock:
+                    self.rehashing.discard(user_id)
+
+        self.executor.submit(rehash)
+        return True
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def stats(self):
+        return {
+            "rounds": self.rounds,
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "rehash_max": self.rehash_max,
+            "rehashing": len(self.rehashing),
+            "rejected": self.rejected,
+            "rehashed": self.rehashed,
+        }
+
+
+hasher = PasswordHasher()
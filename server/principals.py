@@ -0,0 +1,167 @@
+"""
+Кэш аутентифицированных пользователей и разобранных JWT.
+
+Повторные запросы с тем же токеном авторизуются без jwt.decode и без
+запроса к SQLite. Записи пользователей живут PRINCIPAL_CACHE_TTL секунд и
+удаляются явно через ``invalidate(user_id)`` при изменении пользователя
+или его роли. Разобранный токен хранится до его exp, токен без exp -
+PRINCIPAL_CACHE_TTL секунд.
+
+При нескольких воркерах uvicorn каждый держит свой кэш. Если задан
+PRINCIPAL_INVALIDATION_POLL, ``invalidate`` дополнительно пишет user_id в
+таблицу principal_invalidations общей базы, а остальные воркеры опрашивают
+ее с этим интервалом.
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", 60))
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", 10000))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+# Интервал опроса инвалидаций других воркеров, сек; 0 - выключено
+PRINCIPAL_INVALIDATION_POLL = float(os.getenv("PRINCIPAL_INVALIDATION_POLL", 0))
+# Сколько хранить записи инвалидаций, сек
+PRINCIPAL_INVALIDATION_RETENTION = 3600
+
+
+class TTLCache:
+    """LRU-кэш с временем жизни записи; потокобезопасный."""
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is not None and item[1] <= time.time():
+                del self.data[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, expires_at=None):
+        if self.max_size <= 0:
+            return
+        if expires_at is None:
+            expires_at = time.time() + self.ttl
+        with self.lock:
+            self.data[key] = (value, expires_at)
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+class PrincipalCache:
+    def __init__(self, ttl=PRINCIPAL_CACHE_TTL, max_size=PRINCIPAL_CACHE_SIZE,
+                 token_cache_size=TOKEN_CACHE_SIZE, poll_interval=PRINCIPAL_INVALIDATION_POLL):
+        self.users = TTLCache(max_size, ttl)
+        # Токены хранятся до exp, токены без exp - ttl секунд
+        self.tokens = TTLCache(token_cache_size, ttl)
+        self.poll_interval = poll_interval
+        self.db = None
+        self.last_invalidation = 0
+        self.stop_event = threading.Event()
+        self.watcher = None
+
+    def start(self, db):
+        """Включает обмен инвалидациями между воркерами через общую базу."""
+        if self.poll_interval <= 0 or self.watcher is not None:
+            return
+        with db.transaction() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS principal_invalidations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            self.last_invalidation = conn.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM principal_invalidations"
+            ).fetchone()[0]
+        self.db = db
+        self.stop_event.clear()
+        self.watcher = threading.Thread(target=self._watch, name="principal-invalidations", daemon=True)
+        self.watcher.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.watcher is not None:
+            self.watcher.join(timeout=self.poll_interval + 1)
+            self.watcher = None
+
+    def invalidate(self, user_id, conn=None):
+        """Удаляет пользователя из кэша этого и (если включено) остальных воркеров.
+
+        conn - соединение открытой транзакции записи: тогда запись об
+        инвалидации фиксируется вместе с изменением пользователя.
+        """
+        self.users.pop(user_id)
+        if self.db is None:
+            return
+        if conn is None:
+            with self.db.transaction() as conn:
+                self._publish(conn, user_id)
+        else:
+            self._publish(conn, user_id)
+
+    def _publish(self, conn, user_id):
+        conn.execute("INSERT INTO principal_invalidations (user_id) VALUES (?)", (user_id,))
+        conn.execute(
+            "DELETE FROM principal_invalidations WHERE created_at < datetime('now', ?)",
+            (f"-{PRINCIPAL_INVALIDATION_RETENTION} seconds",)
+        )
+
+    def _watch(self):
+        while not self.stop_event.wait(self.poll_interval):
+            try:
+                with self.db.connection() as conn:
+                    rows = conn.execute(
+                        "SELECT id, user_id FROM principal_invalidations WHERE id > ? ORDER BY id",
+                        (self.last_invalidation,)
+                    ).fetchall()
+                for row in rows:
+                    self.users.pop(row['user_id'])
+                    self.last_invalidation = row['id']
+            except Exception as e:
+                print(f"Principal invalidation poll failed: {e}")
+
+    def stats(self):
+        return {
+            "users": self.users.stats(),
+            "tokens": self.tokens.stats(),
+            "cross_worker": self.db is not None,
+        }
+
+
+principals = PrincipalCache()
@@ -0,0 +1,151 @@
+import time
+import queue
+import threading
+import logging
+from collections import Counter, deque
+from concurrent.futures import Future
+
+import numpy as np
+
+logger = logging.getLogger('faiss-service')
+
+
+class MicroBatcher:
+    """Объединяет одновременные запросы на кодирование в пачки.
+
+    Все запросы, уже стоящие в очереди, но не более ``max_batch_size`` штук,
+    кодируются одним вызовом ``encode_fn``, после чего каждый получает свою
+    строку результата. Если модель свободна, пачка уходит сразу, поэтому
+    одиночный запрос не ждет. Пока предыдущие пачки еще кодируются (только с
+    ``submit_fn``), сборщик ждет новые запросы до ``max_wait_ms``.
+    """
+
+    def __init__(self, encode_fn, max_batch_size=32, max_wait_ms=5, history_size=10000,
+                 submit_fn=None, max_in_flight=1):
+        self.encode_fn = encode_fn
+        # submit_fn(texts) -> Future: пачки отправляются без ожидания результата,
+        # так что одновременно обрабатывается до max_in_flight пачек
+        self.submit_fn = submit_fn
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        # Пачки, отправленные через submit_fn и еще не закодированные
+        self.active = 0
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.batch_sizes = Counter()
+        self.wait_times = deque(maxlen=history_size)
+        self.batches = 0
+        self.items = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+                self.thread.start()
+
+    def submit(self, text):
+        if self.thread is None:
+            self.start()
+        future = Future()
+        self.queue.put((text, future, time.perf_counter()))
+        return future
+
+    def encode(self, text):
+        return self.submit(text).result()
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            # Ждать имеет смысл, только пока модель занята: иначе ожидание
+            # лишь добавляет задержку одиночному запросу
+            timeout = deadline - time.perf_counter()
+            if not self.active or timeout <= 0:
+                break
+            try:
+                # Короткими отрезками, чтобы заметить освобождение модели
+                batch.append(self.queue.get(timeout=min(timeout, 0.001)))
+            except queue.Empty:
+                pass
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            texts = [text for text, _, _ in batch]
+            if self.submit_fn is not None:
+                self.in_flight.acquire()
+                with self.lock:
+                    self.active += 1
+                try:
+                    pending = self.submit_fn(texts)
+                except Exception as e:
+                    self._release()
+                    self._fail(batch, e)
+                    continue
+                pending.add_done_callback(lambda f, batch=batch: self._finish_async(batch, f))
+            else:
+                try:
+                    embeddings = np.asarray(self.encode_fn(texts))
+                except Exception as e:
+                    self._fail(batch, e)
+                    continue
+                self._finish(batch, embeddings)
+            self._record(batch, started)
+
+    def _release(self):
+        with self.lock:
+            self.active -= 1
+        self.in_flight.release()
+
+    def _finish_async(self, batch, pending):
+        self._release()
+        try:
+            embeddings = np.asarray(pending.result())
+        except Exception as e:
+            self._fail(batch, e)
+            return
+        self._finish(batch, embeddings)
+
+    def _finish(self, batch, embeddings):
+        for (_, future, _), embedding in zip(batch, embeddings):
+            future.set_result(embedding)
+
+    def _fail(self, batch, error):
+        logger.error(f"Batch encoding of {len(batch)} texts failed: {str(error)}")
+        for _, future, _ in batch:
+            future.set_exception(error)
+
+    def _record(self, batch, started):
+        with self.lock:
+            self.batches += 1
+            self.items += len(batch)
+            self.batch_sizes[len(batch)] += 1
+            self.wait_times.extend(started - enqueued_at for _, _, enqueued_at in batch)
+
+    def stats(self):
+        with self.lock:
+            waits = np.array(self.wait_times) * 1000
+            return {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000,
+                'batches': self.batches,
+                'items': self.items,
+                'avg_batch_size': round(self.items / self.batches, 2) if self.batches else 0.0,
+                'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                'queue_wait_ms': {
+                    'p50': round(float(np.percentile(waits, 50)), 3) if len(waits) else 0.0,
+                    'p99': round(float(np.percentile(waits, 99)), 3) if len(waits) else 0.0,
+                    'max': round(float(waits.max()), 3) if len(waits) else 0.0,
+                },
+                'queue_depth': self.queue.qsize(),
+                'active_batches': self.active,
+            }
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Проверка бэкендов модели перед переключением ENCODER_BACKEND:
+косинусное расхождение с эталонной моделью PyTorch fp32 и пропускная
+способность в предложениях в секунду.
+
+Примеры:
+    python benchmark_encoders.py
+    python benchmark_encoders.py --backends torch-int8,onnx-int8 --texts sentences.txt --min-cosine 0.98
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import numpy as np
+
+from encoders import ENCODER_BACKENDS, create_encoder
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+SAMPLE_TEXTS = [
+    'Статья 159 УК РФ. Мошенничество',
+    'Расторжение договора аренды по требованию арендодателя',
+    'Изменение и расторжение договора возможны по соглашению сторон',
+    'Работодатель обязан выплатить компенсацию за неиспользованный отпуск',
+    'Срок исковой давности составляет три года со дня, когда лицо узнало о нарушении своего права',
+    'Наследство открывается со смертью гражданина',
+    'Порядок обжалования постановления по делу об административном правонарушении',
+    'Договор купли-продажи недвижимости должен быть заключен в письменной форме',
+    'Алименты на несовершеннолетних детей взыскиваются судом ежемесячно',
+    'Налоговый вычет при покупке квартиры',
+]
+
+
+def load_texts(args):
+    if args.texts:
+        with open(args.texts, 'r', encoding='utf-8') as f:
+            texts = [line.strip() for line in f if line.strip()]
+    else:
+        texts = SAMPLE_TEXTS
+    # Повторяем выборку до нужного объема, чтобы замер пропускной способности был устойчивым
+    repeats = max(1, -(-args.count // len(texts)))
+    return (texts * repeats)[:max(args.count, len(texts))]
+
+
+def measure(encoder, texts, batch_size):
+    encoder.encode(texts[:batch_size], batch_size=batch_size)
+    started = time.perf_counter()
+    embeddings = np.asarray(encoder.encode(texts, batch_size=batch_size), dtype='float32')
+    elapsed = time.perf_counter() - started
+    return embeddings, len(texts) / elapsed
+
+
+def cosine(a, b):
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return (a * b).sum(axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parity and throughput check for encoder backends')
+    parser.add_argument('--model', default=os.environ.get('MODEL_NAME', 'distilbert-base-nli-mean-tokens'))
+    parser.add_argument('--backends', default=','.join(ENCODER_BACKENDS))
+    parser.add_argument('--texts', help='файл с предложениями, по одному на строку')
+    parser.add_argument('--count', type=int, default=512, help='сколько предложений кодировать')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--min-cosine', type=float, default=0.99,
+                        help='минимально допустимое косинусное сходство с fp32')
+    parser.add_argument('--json', help='сохранить результаты в JSON-файл')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    texts = load_texts(args)
+    model_dir = os.path.join(DATA_DIR, 'onnx', args.model.replace('/', '_'))
+
+    reference, reference_rate = measure(create_encoder('torch', args.model, num_threads=args.threads or None),
+                                        texts, args.batch_size)
+
+    results = []
+    failed = False
+    print(f"{len(texts)} sentences, batch size {args.batch_size}")
+    print(f"{'backend':<12} {'sent/s':>9} {'speedup':>8} {'mean cos':>9} {'min cos':>9}")
+    for backend in args.backends.split(','):
+        if backend == 'torch':
+            embeddings, rate = reference, reference_rate
+        else:
+            encoder = create_encoder(backend, args.model, model_dir, args.threads or None)
+            embeddings, rate = measure(encoder, texts, args.batch_size)
+
+        similarity = cosine(reference, embeddings)
+        result = {
+            'backend': backend,
+            'sentences_per_sec': round(rate, 1),
+            'speedup': round(rate / reference_rate, 2),
+            'mean_cosine': round(float(similarity.mean()), 5),
+            'min_cosine': round(float(similarity.min()), 5),
+        }
+        results.append(result)
+        failed = failed or result['min_cosine'] < args.min_cosine
+        print(f"{backend:<12} {result['sentences_per_sec']:>9.1f} {result['speedup']:>8.2f} "
+              f"{result['mean_cosine']:>9.5f} {result['min_cosine']:>9.5f}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'model': args.model, 'sentences': len(texts), 'results': results}, f, indent=2)
+
+    if failed:
+        print(f"Cosine similarity below {args.min_cosine} for at least one backend", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
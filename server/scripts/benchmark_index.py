@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Сравнение типов индекса FAISS: recall@k относительно точного flat-индекса
+и задержка одиночного поиска (p50/p99).
+
+Примеры:
+    python benchmark_index.py --synthetic 200000
+    python benchmark_index.py --types ivf,hnsw --nprobe 8,16,32 --ef-search 32,64,128
+"""
+
+import os
+import json
+import time
+import argparse
+import logging
+import numpy as np
+import faiss
+
+from index_factory import build_index, set_search_params, sample_embeddings
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+
+def load_embeddings(args):
+    if args.synthetic:
+        rng = np.random.RandomState(args.seed)
+        # Кластеризованные данные ближе к реальным embeddings, чем равномерный шум
+        centers = rng.randn(max(1, args.synthetic // 1000), args.dim).astype('float32')
+        labels = rng.randint(len(centers), size=args.synthetic)
+        return centers[labels] + 0.3 * rng.randn(args.synthetic, args.dim).astype('float32')
+
+    from document_store import DocumentStore
+    store = DocumentStore(args.data_dir, args.dim)
+    store.open()
+    try:
+        _, embeddings = store.all_embeddings()
+    finally:
+        store.close()
+    return embeddings
+
+
+def measure(index, queries, k):
+    latencies = []
+    found = []
+    for query in queries:
+        started = time.perf_counter()
+        _, ids = index.search(query.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - started) * 1000)
+        found.append(ids[0])
+    return np.array(found), np.array(latencies)
+
+
+def recall_at_k(found, truth):
+    hits = sum(len(set(f[f != -1]) & set(t)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark FAISS index types')
+    parser.add_argument('--data-dir', default=DATA_DIR, help='каталог с хранилищем документов')
+    parser.add_argument('--synthetic', type=int, default=0, help='сгенерировать N случайных векторов вместо хранилища')
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--types', default='flat,ivf,ivfpq,hnsw')
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--nlist', type=int, default=1024)
+    parser.add_argument('--nprobe', default='8,16,32', help='значения nprobe через запятую')
+    parser.add_argument('--pq-m', type=int, default=48)
+    parser.add_argument('--pq-nbits', type=int, default=8)
+    parser.add_argument('--hnsw-m', type=int, default=32)
+    parser.add_argument('--ef-construction', type=int, default=80)
+    parser.add_argument('--ef-search', default='32,64,128', help='значения efSearch через запятую')
+    parser.add_argument('--train-sample', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='сохранить результаты в JSON-файл')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    embeddings = np.ascontiguousarray(load_embeddings(args), dtype='float32')
+    if len(embeddings) == 0:
+        parser.error('no embeddings to benchmark')
+    ids = np.arange(len(embeddings), dtype='int64')
+
+    rng = np.random.RandomState(args.seed + 1)
+    query_rows = rng.choice(len(embeddings), min(args.queries, len(embeddings)), replace=False)
+    queries = embeddings[query_rows] + 0.05 * rng.randn(len(query_rows), args.dim).astype('float32')
+    k = min(args.k, len(embeddings))
+
+    # Эталон: точный поиск по flat-индексу
+    ground_truth = faiss.IndexFlatL2(args.dim)
+    ground_truth.add(embeddings)
+    _, truth = ground_truth.search(queries, k)
+
+    train = sample_embeddings(embeddings, args.train_sample, seed=args.seed)
+    params = {
+        'nlist': args.nlist,
+        'pq_m': args.pq_m,
+        'pq_nbits': args.pq_nbits,
+        'hnsw_m': args.hnsw_m,
+        'ef_construction': args.ef_construction,
+    }
+
+    results = []
+    print(f"{len(embeddings)} vectors, {len(queries)} queries, k={k}")
+    print(f"{'index':<8} {'param':<14} {'build, s':>9} {'recall@k':>9} {'p50, ms':>8} {'p99, ms':>8}")
+    for kind in args.types.split(','):
+        started = time.perf_counter()
+        index = build_index(kind, args.dim, train, **params)
+        index.add_with_ids(embeddings, ids)
+        build_time = time.perf_counter() - started
+
+        if kind in ('ivf', 'ivfpq'):
+            settings = [('nprobe', int(v)) for v in args.nprobe.split(',')]
+        elif kind == 'hnsw':
+            settings = [('efSearch', int(v)) for v in args.ef_search.split(',')]
+        else:
+            settings = [(None, None)]
+
+        for name, value in settings:
+            if name == 'nprobe':
+                set_search_params(index, nprobe=value)
+            elif name == 'efSearch':
+                set_search_params(index, ef_search=value)
+
+            found, latencies = measure(index, queries, k)
+            result = {
+                'index': kind,
+                'param': name,
+                'value': value,
+                'build_sec': round(build_time, 3),
+                'recall_at_k': round(recall_at_k(found, truth), 4),
+                'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+                'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+            }
+            results.append(result)
+            label = f'{name}={value}' if name else '-'
+            print(f"{kind:<8} {label:<14} {result['build_sec']:>9.2f} {result['recall_at_k']:>9.4f} "
+                  f"{result['p50_ms']:>8.3f} {result['p99_ms']:>8.3f}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'vectors': len(embeddings), 'queries': len(queries), 'k': k, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный бенчмарк FAISSService без сети и без настоящей модели:
+синтетический корпус, заглушка вместо модели, скорость загрузки, задержки
+search и search_by_embedding (p50/p95/p99), задержки CRUD, время перестроения
+индекса и потребление памяти (RSS).
+
+Каждый размер корпуса запускается в отдельном процессе со своим каталогом
+данных, поэтому RSS не накапливается между прогонами. Настройки сервиса
+(MICRO_BATCH_ENABLED, WAL_FSYNC, CHUNKING_ENABLED и т.д.) берутся из окружения.
+
+Примеры:
+    python benchmark_service.py --sizes 1000,10000,100000 --json results.json
+    python benchmark_service.py --sizes 1000000 --index-type ivf
+    python benchmark_service.py --baseline baseline.json --tolerance 0.2
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+WORDS = (
+    'договор аренда квартира работодатель отпуск компенсация наследство суд иск срок давность налог вычет '
+    'алименты штраф постановление жалоба купля продажа недвижимость собственник залог кредит банк долг '
+    'увольнение трудовой кодекс статья пункт закон право обязанность сторона соглашение расторжение'
+).split()
+
+# Метрики для сравнения с базовым прогоном: True - чем больше, тем лучше
+METRICS = {
+    'ingest_docs_per_sec': True,
+    'search_p50_ms': False,
+    'search_p99_ms': False,
+    'search_by_embedding_p50_ms': False,
+    'search_by_embedding_p99_ms': False,
+    'add_p50_ms': False,
+    'update_p50_ms': False,
+    'delete_p50_ms': False,
+    'rebuild_sec': False,
+    'rss_peak_mb': False,
+}
+
+
+class StubEncoder:
+    """Детерминированная заглушка модели: вектор зависит только от текста."""
+
+    def __init__(self, dim):
+        self.dim = dim
+
+    def encode(self, texts, batch_size=32):
+        return np.vstack([
+            np.random.RandomState(zlib.crc32(text.encode('utf-8'))).randn(self.dim).astype('float32')
+            for text in texts
+        ]) if len(texts) else np.zeros((0, self.dim), dtype='float32')
+
+
+def percentiles(latencies):
+    latencies = np.array(latencies) * 1000
+    return {p: round(float(np.percentile(latencies, p)), 3) for p in (50, 95, 99)}
+
+
+def rss_mb():
+    # Текущий RSS из /proc и пиковый из getrusage (в Linux ru_maxrss в КБ)
+    current = None
+    if os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource else None
+    return (round(current, 1) if current else None), (round(peak, 1) if peak else None)
+
+
+def iter_corpus(size, args, rng, centers):
+    for start in range(0, size, args.batch_size):
+        count = min(args.batch_size, size - start)
+        words = rng.choice(len(WORDS), (count, args.doc_words))
+        categories = rng.randint(args.categories, size=count)
+        documents = [{
+            'title': f'Документ {start + i}',
+            'content': ' '.join(WORDS[w] for w in words[i]),
+            'category': f'category-{categories[i]}',
+        } for i in range(count)]
+        if args.embeddings == 'random':
+            # Кластеризованные векторы, как в benchmark_index.py
+            labels = rng.randint(len(centers), size=count)
+            embeddings = centers[labels] + 0.3 * rng.randn(count, args.dim).astype('float32')
+            for document, embedding in zip(documents, embeddings):
+                document['embedding'] = embedding
+        yield documents
+
+
+def run_size(args):
+    """Один прогон в дочернем процессе; каталог данных задан через FAISS_DATA_DIR."""
+    import logging
+    import search_service
+
+    logging.getLogger('faiss-service').setLevel(logging.WARNING)
+    service = search_service.service
+    service.model = StubEncoder(args.dim)
+    service.initialize()
+
+    rng = np.random.RandomState(args.seed)
+    centers = rng.randn(max(1, args.size // 1000), args.dim).astype('float32')
+    result = {'size': args.size, 'index_type': search_service.INDEX_TYPE, 'embeddings': args.embeddings}
+
+    started = time.perf_counter()
+    for documents in iter_corpus(args.size, args, rng, centers):
+        service.add_documents(documents, persist=False)
+    service.save_index()
+    elapsed = time.perf_counter() - started
+    result['ingest_sec'] = round(elapsed, 3)
+    result['ingest_docs_per_sec'] = round(args.size / elapsed, 1)
+    result['rss_after_ingest_mb'], _ = rss_mb()
+
+    # IVF обучается на выборке, поэтому после загрузки индекс переобучается
+    started = time.perf_counter()
+    service.rebuild_index()
+    result['rebuild_sec'] = round(time.perf_counter() - started, 3)
+
+    queries = [' '.join(WORDS[w] for w in rng.choice(len(WORDS), 3)) + f' {i}' for i in range(args.queries)]
+    latencies = []
+    for query in queries:
+        started = time.perf_counter()
+        service.search(query, args.k, args.fields)
+        latencies.append(time.perf_counter() - started)
+    for p, value in percentiles(latencies).items():
+        result[f'search_p{p}_ms'] = value
+
+    embeddings = centers[rng.randint(len(centers), size=args.queries)] + \
+        0.3 * rng.randn(args.queries, args.dim).astype('float32')
+    latencies = []
+    for embedding in embeddings:
+        started = time.perf_counter()
+        service.search_by_embedding(embedding.tolist(), args.k, args.fields)
+        latencies.append(time.perf_counter() - started)
+    for p, value in percentiles(latencies).items():
+        result[f'search_by_embedding_p{p}_ms'] = value
+
+    # Одиночные изменения: их стоимость не должна расти с размером корпуса
+    crud = {'add': [], 'update': [], 'delete': []}
+    added = []
+    for i in range(args.crud_ops):
+        started = time.perf_counter()
+        added.append(service.add_document({'title': f'Новый {i}', 'content': queries[i % len(queries)]}))
+        crud['add'].append(time.perf_counter() - started)
+    for i, doc_id in enumerate(added):
+        started = time.perf_counter()
+        service.update_document(doc_id, {'content': f'{queries[(i + 1) % len(queries)]} изменен'})
+        crud['update'].append(time.perf_counter() - started)
+    for doc_id in added:
+        started = time.perf_counter()
+        service.delete_document(doc_id)
+        crud['delete'].append(time.perf_counter() - started)
+    for op, latencies in crud.items():
+        if latencies:
+            result[f'{op}_p50_ms'] = percentiles(latencies)[50]
+            result[f'{op}_p99_ms'] = percentiles(latencies)[99]
+
+    result['rss_mb'], result['rss_peak_mb'] = rss_mb()
+    return result
+
+
+def spawn(size, args):
+    data_dir = tempfile.mkdtemp(prefix=f'faiss-bench-{size}-')
+    result_path = os.path.join(data_dir, 'result.json')
+    env = {
+        **os.environ,
+        'FAISS_DATA_DIR': data_dir,
+        'INDEX_TYPE': args.index_type,
+        'ENCODE_BATCH_SIZE': str(args.batch_size),
+        'EMBEDDING_SIZE': str(args.dim),
+    }
+    if not args.result_cache:
+        # Иначе повторные запросы измеряют кэш, а не поиск
+        env['RESULT_CACHE_SIZE'] = '0'
+    command = [sys.executable, os.path.abspath(__file__), '--run-size', str(size), '--result-file', result_path]
+    command += [f'-k{args.k}'] + [f'--{name.replace("_", "-")}={value}' for name, value in vars(args).items()
+                                  if name in ('dim', 'queries', 'fields', 'embeddings', 'batch_size', 'doc_words',
+                                              'categories', 'crud_ops', 'seed')]
+    try:
+        subprocess.run(command, check=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+        with open(result_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    finally:
+        if not args.keep_data:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def compare(results, baseline, tolerance):
+    """Возвращает список регрессий относительно базового прогона."""
+    previous = {(r['size'], r.get('index_type')): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        base = previous.get((result['size'], result.get('index_type')))
+        if base is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            old, new = base.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"size={result['size']} {metric}: {old} -> {new} ({change:+.1%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of FAISSService')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='размеры корпуса через запятую (до 1000000)')
+    parser.add_argument('--index-type', default=os.environ.get('INDEX_TYPE', 'flat'))
+    parser.add_argument('--embeddings', choices=('random', 'stub'), default='random',
+                        help='random - готовые кластеризованные векторы, stub - кодирование заглушкой модели')
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('-k', type=int, default=5)
+    parser.add_argument('--fields', default='full')
+    parser.add_argument('--batch-size', type=int, default=1000, help='размер пачки при загрузке')
+    parser.add_argument('--doc-words', type=int, default=50)
+    parser.add_argument('--categories', type=int, default=10)
+    parser.add_argument('--crud-ops', type=int, default=100)
+    parser.add_argument('--result-cache', action='store_true', help='не отключать кэш результатов поиска')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep-data', action='store_true')
+    parser.add_argument('--json', help='сохранить результаты в JSON-файл')
+    parser.add_argument('--baseline', help='JSON предыдущего прогона для сравнения')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='допустимое ухудшение метрики, доля')
+    parser.add_argument('--run-size', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_size:
+        args.size = args.run_size
+        with open(args.result_file, 'w', encoding='utf-8') as f:
+            json.dump(run_size(args), f)
+        return
+
+    results = []
+    print(f"{'size':>8} {'ingest/s':>10} {'search p50':>11} {'p99':>8} {'by emb p50':>11} {'p99':>8} "
+          f"{'add p50':>8} {'rebuild, s':>10} {'RSS, MB':>8}")
+    for size in (int(s) for s in args.sizes.split(',')):
+        result = spawn(size, args)
+        results.append(result)
+        print(f"{size:>8} {result['ingest_docs_per_sec']:>10.1f} {result['search_p50_ms']:>11.3f} "
+              f"{result['search_p99_ms']:>8.3f} {result['search_by_embedding_p50_ms']:>11.3f} "
+              f"{result['search_by_embedding_p99_ms']:>8.3f} {result.get('add_p50_ms', 0):>8.3f} "
+              f"{result['rebuild_sec']:>10.2f} {result['rss_peak_mb'] or 0:>8.1f}")
+
+    report = {
+        'config': {name: value for name, value in vars(args).items()
+                   if name not in ('json', 'baseline', 'run_size', 'result_file', 'keep_data')},
+        'results': results,
+    }
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"Regressions over {args.tolerance:.0%} against {args.baseline}:", file=sys.stderr)
+            for line in regressions:
+                print(f"  {line}", file=sys.stderr)
+            sys.exit(1)
+        print(f"No regressions over {args.tolerance:.0%} against {args.baseline}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,394 @@
+import os
+import re
+import math
+import heapq
+import threading
+from functools import lru_cache
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from wal import replace_atomic
+
+try:
+    # Полноценный стеммер Snowball, если установлен PyStemmer
+    import Stemmer
+    _snowball = Stemmer.Stemmer('russian')
+except ImportError:
+    _snowball = None
+
+# Номера статей и пунктов ("159", "159.1", "14.2") сохраняются одним токеном
+TOKEN_RE = re.compile(r'\d+(?:\.\d+)*|[^\W\d_]+')
+CYRILLIC_RE = re.compile(r'[а-я]')
+
+STOPWORDS = frozenset('''
+    а без более бы был была были было быть в вам вас весь во вот все всего всех вы где да даже для до его ее если
+    есть еще же за здесь и из или им их к как ко когда кто ли либо мне может мы на над надо наш не него нее нет ни
+    них но ну о об однако он она они оно от очень по под при с со так также такой там те тем то того тоже той только
+    том ты у уже хотя чего чей чем что чтобы чье чья эта эти это я
+'''.split())
+
+# Окончания для упрощенного стеммера, от длинных к коротким
+_REFLEXIVE = ('ся', 'сь')
+_ENDINGS = tuple(sorted('''
+    ившись ывшись вшись ивши ывши вши ив ыв
+    ими ыми его ого ему ому ее ие ые ое ей ий ый ой ем им ым ом их ых ую юю ая яя ою ею
+    ила ыла ена ейте уйте ите или ыли ило ыло ено ует уют ены ить ыть ишь ете йте ешь нно
+    ла на ли ло но ет ют ны ть ил ыл ен ят ит ыт уй
+    иями ями ами иях ях иям ям ием ией ев ов ье еи ии ах ам ию ью ия ья
+    а е и й о у ы ь ю я
+'''.split(), key=len, reverse=True))
+_DERIVATIONAL = ('ость', 'ост')
+MIN_STEM_LENGTH = 3
+
+
+@lru_cache(maxsize=200000)
+def stem(word):
+    # Словарь корпуса ограничен, поэтому основы слов кэшируются
+    if _snowball is not None:
+        return _snowball.stemWord(word)
+    if not CYRILLIC_RE.search(word):
+        return word
+
+    for ending in _REFLEXIVE:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM_LENGTH:
+            word = word[:-len(ending)]
+            break
+    for ending in _ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM_LENGTH:
+            word = word[:-len(ending)]
+            break
+    for ending in _DERIVATIONAL:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM_LENGTH:
+            word = word[:-len(ending)]
+            break
+    return word
+
+
+def tokenize(text):
+    tokens = TOKEN_RE.findall(text.casefold().replace('ё', 'е'))
+    return [stem(token) for token in tokens if token not in STOPWORDS]
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Объединяет ранжированные списки ID методом reciprocal rank fusion."""
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] += 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class BM25Index:
+    """Инвертированный индекс в памяти с ранжированием BM25.
+
+    Документы хранятся в двух сегментах. Основной сегмент неизменяемый: для
+    каждого термина это массивы NumPy, упорядоченные по вкладу документа в
+    оценку (impact), и их копия, упорядоченная по номеру документа. Вклады
+    посчитаны по статистике коллекции на момент сборки сегмента (freeze).
+    Новые и измененные документы попадают в небольшой дельта-сегмент на
+    словарях, удаленные из основного сегмента помечаются в маске alive.
+    Когда дельта и удаления превышают merge_ratio коллекции, сегменты
+    сливаются в новый основной.
+
+    Поиск по основному сегменту идет блоками по спискам вкладов и
+    останавливается, как только k-я лучшая оценка не меньше суммы вкладов
+    на текущей глубине всех списков (threshold algorithm): непросмотренные
+    документы уже не могут попасть в top-k.
+    """
+
+    def __init__(self, k1=1.5, b=0.75, merge_ratio=0.05, min_merge=1000):
+        self.k1 = k1
+        self.b = b
+        self.merge_ratio = merge_ratio
+        self.min_merge = min_merge
+        self.lock = threading.RLock()
+        self.tag_names = []
+        self.tag_codes = {}
+        self._set_main(np.zeros(0, dtype='int64'), np.zeros(0, dtype='float32'), np.zeros(0, dtype='int32'),
+                       [], np.zeros(1, dtype='int64'), np.zeros(0, dtype='int32'), np.zeros(0, dtype='float32'),
+                       np.zeros(0, dtype='uint16'), np.zeros(0, dtype='int32'), np.zeros(0, dtype='float32'),
+                       np.zeros(0, dtype='float32'), 0.0)
+        self._reset_delta()
+
+    def _set_main(self, ids, lengths, tags, terms, offsets, order_rows, order_impacts, order_tfs,
+                  sorted_rows, sorted_impacts, idf, avg_length):
+        # Основной сегмент: документы упорядочены по ID, номер строки - позиция в ids
+        self.main_ids = ids
+        self.main_lengths = lengths
+        self.main_tags = tags
+        self.main_alive = np.ones(len(ids), dtype=bool)
+        self.main_alive_count = len(ids)
+        self.term_names = list(terms)
+        self.terms = {term: tid for tid, term in enumerate(self.term_names)}
+        # Постинги термина tid - срез offsets[tid]:offsets[tid + 1] во всех массивах
+        self.offsets = offsets
+        self.order_rows = order_rows
+        self.order_impacts = order_impacts
+        self.order_tfs = order_tfs
+        self.sorted_rows = sorted_rows
+        self.sorted_impacts = sorted_impacts
+        self.idf = idf
+        self.avg_length = avg_length
+        self.removed = 0
+        self.total_length = int(lengths.sum())
+
+    def _reset_delta(self):
+        self.postings = defaultdict(dict)
+        self.doc_terms = {}
+        self.doc_lengths = {}
+        self.doc_tags = {}
+
+    def __len__(self):
+        return self.main_alive_count + len(self.doc_lengths)
+
+    def _tag_code(self, tag):
+        tag = tag or ''
+        code = self.tag_codes.get(tag)
+        if code is None:
+            code = self.tag_codes[tag] = len(self.tag_names)
+            self.tag_names.append(tag)
+        return code
+
+    def _main_row(self, doc_id):
+        row = int(np.searchsorted(self.main_ids, doc_id))
+        if row < len(self.main_ids) and self.main_ids[row] == doc_id and self.main_alive[row]:
+            return row
+        return None
+
+    def add(self, doc_id, text, tag=None):
+        counts = Counter(tokenize(text))
+        with self.lock:
+            self._remove(doc_id)
+            self._add_counts(doc_id, counts, tag)
+            self._maybe_merge()
+
+    def _add_counts(self, doc_id, counts, tag):
+        for term, tf in counts.items():
+            self.postings[term][doc_id] = tf
+        length = sum(counts.values())
+        self.doc_terms[doc_id] = tuple(counts)
+        self.doc_lengths[doc_id] = length
+        self.doc_tags[doc_id] = tag
+        self.total_length += length
+
+    def build(self, documents):
+        """Заполняет пустой индекс парами (ID, текст, метка) и собирает основной сегмент один раз."""
+        with self.lock:
+            for doc_id, text, tag in documents:
+                self._remove(doc_id)
+                self._add_counts(doc_id, Counter(tokenize(text)), tag)
+            self.freeze()
+
+    def remove(self, doc_id):
+        with self.lock:
+            removed = self._remove(doc_id)
+            self._maybe_merge()
+            return removed
+
+    def _remove(self, doc_id):
+        if doc_id in self.doc_lengths:
+            for term in self.doc_terms.pop(doc_id):
+                posting = self.postings[term]
+                posting.pop(doc_id, None)
+                if not posting:
+                    del self.postings[term]
+            self.total_length -= self.doc_lengths.pop(doc_id)
+            self.doc_tags.pop(doc_id, None)
+            return True
+        row = self._main_row(doc_id)
+        if row is None:
+            return False
+        self.main_alive[row] = False
+        self.main_alive_count -= 1
+        self.total_length -= int(self.main_lengths[row])
+        self.removed += 1
+        return True
+
+    def _maybe_merge(self):
+        if len(self.doc_lengths) + self.removed > max(self.min_merge, self.merge_ratio * len(self)):
+            self.freeze()
+
+    def freeze(self):
+        """Сливает дельта-сегмент и удаления в новый основной сегмент."""
+        with self.lock:
+            if not self.doc_lengths and not self.removed:
+                return
+            alive = self.main_alive
+            delta_ids = list(self.doc_lengths)
+            ids = np.concatenate([self.main_ids[alive], np.array(delta_ids, dtype='int64')])
+            lengths = np.concatenate([
+                self.main_lengths[alive], np.array([self.doc_lengths[d] for d in delta_ids], dtype='float32')
+            ])
+            tags = np.concatenate([
+                self.main_tags[alive], np.array([self._tag_code(self.doc_tags[d]) for d in delta_ids], dtype='int32')
+            ])
+            by_id = np.argsort(ids, kind='stable')
+            ids, lengths, tags = ids[by_id], lengths[by_id], tags[by_id]
+
+            # Постинги основного сегмента без удаленных документов плюс постинги дельты
+            term_names = list(self.term_names)
+            terms = dict(self.terms)
+            main_terms = np.repeat(np.arange(len(term_names), dtype='int32'), np.diff(self.offsets))
+            keep = alive[self.order_rows]
+            delta_terms, delta_docs, delta_tfs = [], [], []
+            for term, posting in self.postings.items():
+                tid = terms.get(term)
+                if tid is None:
+                    tid = terms[term] = len(term_names)
+                    term_names.append(term)
+                delta_terms.extend([tid] * len(posting))
+                delta_docs.extend(posting)
+                delta_tfs.extend(posting.values())
+            p_terms = np.concatenate([main_terms[keep], np.array(delta_terms, dtype='int32')])
+            p_docs = np.concatenate([self.main_ids[self.order_rows[keep]], np.array(delta_docs, dtype='int64')])
+            p_tfs = np.concatenate([
+                self.order_tfs[keep], np.minimum(np.array(delta_tfs, dtype='int64'), 65535).astype('uint16')
+            ])
+            rows = np.searchsorted(ids, p_docs).astype('int32')
+
+            # Термины без документов в новый сегмент не попадают
+            df = np.bincount(p_terms, minlength=len(term_names))
+            used = df > 0
+            remap = np.cumsum(used) - 1
+            p_terms = remap[p_terms].astype('int32')
+            term_names = [term for term, is_used in zip(term_names, used) if is_used]
+            df = df[used]
+
+            n = len(ids)
+            avg_length = float(lengths.mean()) if n else 0.0
+            idf = np.log(1 + (n - df + 0.5) / (df + 0.5)).astype('float32')
+            tf = p_tfs.astype('float32')
+            norm = self.k1 * (1 - self.b + self.b * lengths[rows] / avg_length) if avg_length else self.k1
+            impacts = (idf[p_terms] * tf * (self.k1 + 1) / (tf + norm)).astype('float32')
+
+            by_impact = np.lexsort((-impacts, p_terms))
+            by_row = np.lexsort((rows, p_terms))
+            self._set_main(
+                ids, lengths, tags, term_names, np.concatenate([[0], np.cumsum(df)]).astype('int64'),
+                rows[by_impact], impacts[by_impact], p_tfs[by_impact], rows[by_row], impacts[by_row],
+                idf, avg_length
+            )
+            self._reset_delta()
+
+    def search(self, query, k=10, tags=None):
+        """Возвращает до k пар (ID, оценка BM25) по убыванию оценки."""
+        terms = set(tokenize(query))
+        with self.lock:
+            if not len(self) or not terms or k <= 0:
+                return []
+            results = self._search_main(terms, k, tags) + self._search_delta(terms, k, tags)
+        return heapq.nlargest(k, results, key=lambda item: item[1])
+
+    def _search_main(self, terms, k, tags):
+        lists = []
+        for term in terms:
+            tid = self.terms.get(term)
+            if tid is not None:
+                lists.append((int(self.offsets[tid]), int(self.offsets[tid + 1])))
+        if not lists or not self.main_alive_count:
+            return []
+        allowed = None
+        if tags is not None:
+            codes = [self.tag_codes[tag or ''] for tag in tags if (tag or '') in self.tag_codes]
+            if not codes:
+                return []
+            allowed = np.zeros(len(self.tag_names), dtype=bool)
+            allowed[codes] = True
+
+        visited = np.zeros(len(self.main_ids), dtype=bool)
+        best_rows = np.zeros(0, dtype='int32')
+        best_scores = np.zeros(0, dtype='float32')
+        depth = 0
+        block = max(4 * k, 256)
+        while True:
+            rows = np.unique(np.concatenate([self.order_rows[start + depth:min(start + depth + block, end)]
+                                             for start, end in lists]))
+            rows = rows[~visited[rows]]
+            visited[rows] = True
+            mask = self.main_alive[rows]
+            if allowed is not None:
+                mask &= allowed[self.main_tags[rows]]
+            rows = rows[mask]
+            if len(rows):
+                # Полная оценка новых кандидатов: вклад каждого термина ищется в списке по номеру строки
+                scores = np.zeros(len(rows), dtype='float32')
+                for start, end in lists:
+                    sorted_rows = self.sorted_rows[start:end]
+                    pos = np.minimum(np.searchsorted(sorted_rows, rows), end - start - 1)
+                    scores += np.where(sorted_rows[pos] == rows, self.sorted_impacts[start:end][pos], 0)
+                best_rows = np.concatenate([best_rows, rows])
+                best_scores = np.concatenate([best_scores, scores])
+                if len(best_scores) > k:
+                    top = np.argpartition(-best_scores, k - 1)[:k]
+                    best_rows, best_scores = best_rows[top], best_scores[top]
+
+            depth += block
+            bounds = [self.order_impacts[start + depth] for start, end in lists if start + depth < end]
+            if not bounds:
+                break
+            # Документ, еще не встреченный ни в одном списке, наберет не больше этой суммы
+            if len(best_scores) >= k and best_scores.min() >= sum(bounds):
+                break
+            block *= 2
+        return list(zip(self.main_ids[best_rows].tolist(), best_scores.tolist()))
+
+    def _search_delta(self, terms, k, tags):
+        if not self.doc_lengths:
+            return []
+        tags = set(tags) if tags is not None else None
+        n = len(self)
+        # Статистика основного сегмента, чтобы оценки обоих сегментов были сравнимы
+        avg_length = self.avg_length or self.total_length / n
+        scores = defaultdict(float)
+        for term in terms:
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            tid = self.terms.get(term)
+            if tid is not None:
+                idf = float(self.idf[tid])
+            else:
+                idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, tf in posting.items():
+                if tags is not None and self.doc_tags.get(doc_id) not in tags:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / avg_length)
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def save(self, path, seq=0):
+        """Сохраняет индекс (после слияния сегментов) атомарной заменой файла."""
+        with self.lock:
+            self.freeze()
+            tmp_path = f'{path}.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.savez(
+                    f,
+                    ids=self.main_ids, lengths=self.main_lengths, tags=self.main_tags,
+                    tag_names=np.array(self.tag_names, dtype=str), terms=np.array(self.term_names, dtype=str),
+                    offsets=self.offsets, order_rows=self.order_rows, order_impacts=self.order_impacts,
+                    order_tfs=self.order_tfs, sorted_rows=self.sorted_rows, sorted_impacts=self.sorted_impacts,
+                    idf=self.idf, params=np.array([self.k1, self.b, self.avg_length]), seq=np.array(seq)
+                )
+            replace_atomic(tmp_path, path)
+
+    def load(self, path):
+        """Загружает сохраненный индекс; возвращает номер журнала снимка или None."""
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            k1, b, avg_length = data['params'].tolist()
+            if (k1, b) != (self.k1, self.b):
+                return None
+            arrays = {name: data[name] for name in data.files}
+        with self.lock:
+            self.tag_names = arrays['tag_names'].tolist()
+            self.tag_codes = {tag: code for code, tag in enumerate(self.tag_names)}
+            self._set_main(
+                arrays['ids'], arrays['lengths'], arrays['tags'], arrays['terms'].tolist(), arrays['offsets'],
+                arrays['order_rows'], arrays['order_impacts'], arrays['order_tfs'], arrays['sorted_rows'],
+                arrays['sorted_impacts'], arrays['idf'], avg_length
+            )
+            self._reset_delta()
+        return int(arrays['seq'])
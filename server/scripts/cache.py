@@ -0,0 +1,85 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+def normalize_query(text):
+    # Запросы, отличающиеся только регистром и пробелами, считаем одинаковыми
+    return ' '.join(text.split()).casefold()
+
+
+class LRUCache:
+    """Потокобезопасный LRU-кэш с необязательным TTL и счетчиками попаданий.
+
+    Если задан ``max_bytes``, размер записей оценивается функцией ``sizeof``
+    и старые записи вытесняются также при превышении бюджета памяти.
+    """
+
+    def __init__(self, max_entries, ttl=None, max_bytes=0, sizeof=None):
+        self.max_entries = max_entries
+        self.ttl = ttl or None
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at, size = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self.entries[key]
+                self.bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        size = self.sizeof(value) if self.max_bytes and self.sizeof else 0
+        if self.max_bytes and size > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[2]
+            self.entries[key] = (value, expires_at, size)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.max_bytes and self.bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'max_entries': self.max_entries,
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
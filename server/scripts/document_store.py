@@ -0,0 +1,436 @@
+import os
+import json
+import struct
+import sqlite3
+import argparse
+import threading
+import logging
+import numpy as np
+
+from wal import fsync_path, replace_atomic
+
+logger = logging.getLogger('faiss-service')
+
+# Заголовок .npy фиксированной длины: число строк можно перезаписать на месте при дозаписи
+NPY_HEADER_LEN = 128
+METADATA_FIELDS = ('title', 'content', 'category')
+# Сколько байт базы SQLite читать через mmap в режиме только на чтение
+SQLITE_MMAP_SIZE = 1 << 30
+
+
+def npy_header(rows, dim):
+    header = "{'descr': '<f4', 'fortran_order': False, 'shape': (%d, %d), }" % (rows, dim)
+    header = header.ljust(NPY_HEADER_LEN - 11) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+class DocumentStore:
+    """Бинарное хранилище документов.
+
+    Состоит из трех частей:
+    - ``<name>_embeddings.npy`` - матрица float32, строки только дописываются
+      в конец, при чтении файл отображается в память через ``np.load(mmap_mode='r')``;
+    - ``<name>_log.jsonl`` - журнал соответствия ID документа строке матрицы,
+      записи только дописываются;
+    - ``<name>.db`` - таблица SQLite с title, content, category и прочими полями.
+
+    Удаление и замена embedding оставляют в матрице мертвые строки;
+    ``compact`` переписывает матрицу и журнал только с живыми строками.
+    Новые ID выдает монотонный счетчик ``allocate_ids``, удаленные ID
+    повторно не используются.
+
+    С ``read_only=True`` хранилище только читает файлы, которые пишет другой
+    процесс: матрица и база SQLite отображаются в память и делят страничный
+    кэш между процессами.
+    """
+
+    def __init__(self, data_dir, dim, name='documents', read_only=False):
+        self.dim = dim
+        self.read_only = read_only
+        self.embeddings_path = os.path.join(data_dir, f'{name}_embeddings.npy')
+        self.log_path = os.path.join(data_dir, f'{name}_log.jsonl')
+        self.db_path = os.path.join(data_dir, f'{name}.db')
+        self.rows = {}
+        self.num_rows = 0
+        self.next_id = 1
+        self.embeddings = None
+        self.lock = threading.RLock()
+        self.conn = None
+        self._embeddings_file = None
+        self._log_file = None
+
+    def open(self):
+        if self.read_only:
+            return self._open_read_only()
+        with self.lock:
+            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS documents (
+                    id INTEGER PRIMARY KEY,
+                    title TEXT,
+                    content TEXT,
+                    category TEXT,
+                    extra TEXT
+                )
+            ''')
+            self.conn.commit()
+
+            self._recover_compaction()
+            self._open_embeddings()
+            self._replay_log()
+            self._log_file = open(self.log_path, 'a', encoding='utf-8')
+            logger.info(f"Opened document store with {len(self.rows)} documents and {self.num_rows} embedding rows")
+
+    def _open_read_only(self):
+        with self.lock:
+            self.conn = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True, check_same_thread=False)
+            self.conn.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+            while True:
+                files = self._file_ids()
+                # Заголовок матрицы мог не успеть обновиться: число строк берем из размера файла
+                size = os.path.getsize(self.embeddings_path) if os.path.exists(self.embeddings_path) else NPY_HEADER_LEN
+                self.num_rows = max(0, size - NPY_HEADER_LEN) // (self.dim * 4)
+                self._map_embeddings()
+                self._replay_log()
+                # Если пишущий процесс в это время сжал хранилище, матрица и журнал
+                # могли оказаться из разных поколений - читаем заново
+                if self._file_ids() == files:
+                    break
+            logger.info(f"Opened read-only document store with {len(self.rows)} documents")
+
+    def close(self):
+        with self.lock:
+            if self._embeddings_file:
+                self._sync_header()
+                self._embeddings_file.close()
+                self._embeddings_file = None
+            if self._log_file:
+                self._log_file.close()
+                self._log_file = None
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+            self.embeddings = None
+
+    def _open_embeddings(self):
+        row_bytes = self.dim * 4
+        if not os.path.exists(self.embeddings_path):
+            with open(self.embeddings_path, 'wb') as f:
+                f.write(npy_header(0, self.dim))
+
+        # Число строк определяется по размеру файла: заголовок мог не успеть
+        # обновиться, а недописанная строка отбрасывается
+        size = os.path.getsize(self.embeddings_path)
+        self.num_rows = (size - NPY_HEADER_LEN) // row_bytes
+        self._embeddings_file = open(self.embeddings_path, 'r+b')
+        self._embeddings_file.truncate(NPY_HEADER_LEN + self.num_rows * row_bytes)
+        self._sync_header()
+        self._map_embeddings()
+        self._embeddings_file.seek(0, os.SEEK_END)
+
+    def _sync_header(self):
+        self._embeddings_file.seek(0)
+        self._embeddings_file.write(npy_header(self.num_rows, self.dim))
+        self._embeddings_file.seek(0, os.SEEK_END)
+        self._embeddings_file.flush()
+
+    def _map_embeddings(self):
+        if not self.read_only:
+            self.embeddings = np.load(self.embeddings_path, mmap_mode='r')
+        elif self.num_rows:
+            self.embeddings = np.memmap(self.embeddings_path, dtype='<f4', mode='r', offset=NPY_HEADER_LEN,
+                                        shape=(self.num_rows, self.dim))
+        else:
+            self.embeddings = np.zeros((0, self.dim), dtype='float32')
+
+    def _replay_log(self):
+        self.rows = {}
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Оборванная последняя запись после сбоя
+                    continue
+                self._apply(record)
+
+    def _file_ids(self):
+        return tuple(os.stat(path).st_ino if os.path.exists(path) else None
+                     for path in (self.embeddings_path, self.log_path))
+
+    def _apply(self, record):
+        if record['op'] == 'put' and record['row'] < self.num_rows:
+            self.rows[record['id']] = record['row']
+        elif record['op'] == 'delete':
+            self.rows.pop(record['id'], None)
+        elif record['op'] == 'counter':
+            self.next_id = max(self.next_id, record['next_id'])
+        if 'id' in record:
+            self.next_id = max(self.next_id, record['id'] + 1)
+
+    def _append_log(self, records):
+        self._log_file.write(''.join(json.dumps(r) + '\n' for r in records))
+        self._log_file.flush()
+        for record in records:
+            self._apply(record)
+
+    def _append_embeddings(self, embeddings):
+        embeddings = np.ascontiguousarray(embeddings, dtype='<f4').reshape(-1, self.dim)
+        first_row = self.num_rows
+        self._embeddings_file.write(embeddings.tobytes())
+        self._embeddings_file.flush()
+        self.num_rows += len(embeddings)
+        return range(first_row, self.num_rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.rows
+
+    def ids(self):
+        return self.rows.keys()
+
+    @property
+    def dead_rows(self):
+        # Строки матрицы, на которые не ссылается ни один живой документ
+        return self.num_rows - len(self.rows)
+
+    def allocate_ids(self, count=1):
+        """Выдает count новых ID подряд; счетчик восстанавливается из журнала."""
+        with self.lock:
+            first_id = self.next_id
+            self.next_id += count
+            return list(range(first_id, self.next_id))
+
+    def maybe_compact(self, min_dead_ratio=0.3, min_dead_rows=1000):
+        if self.read_only or self.dead_rows < max(1, min_dead_rows) or self.dead_rows < self.num_rows * min_dead_ratio:
+            return False
+        self.compact()
+        return True
+
+    def compact(self):
+        """Переписывает матрицу и журнал, оставляя только строки живых документов.
+
+        Сначала целиком пишутся и синхронизируются временные файлы, затем они
+        подменяют старые. Если процесс упадет между двумя rename, подмену
+        завершит ``_recover_compaction`` при следующем открытии.
+        """
+        self._check_writable()
+        with self.lock:
+            started_rows = self.num_rows
+            ids = sorted(self.rows)
+            embeddings_tmp = f'{self.embeddings_path}.compact'
+            log_tmp = f'{self.log_path}.compact'
+
+            with open(embeddings_tmp, 'wb') as f:
+                f.write(npy_header(len(ids), self.dim))
+                for start in range(0, len(ids), 65536):
+                    chunk = self.get_embeddings(ids[start:start + 65536])
+                    f.write(np.ascontiguousarray(chunk, dtype='<f4').tobytes())
+            fsync_path(embeddings_tmp)
+
+            with open(log_tmp, 'w', encoding='utf-8') as f:
+                f.write(json.dumps({'op': 'counter', 'next_id': self.next_id}) + '\n')
+                f.write(''.join(json.dumps({'op': 'put', 'id': doc_id, 'row': row}) + '\n'
+                                for row, doc_id in enumerate(ids)))
+                f.write(json.dumps({'op': 'compacted'}) + '\n')
+            fsync_path(log_tmp)
+
+            self._embeddings_file.close()
+            self._log_file.close()
+            self._finish_compaction()
+
+            self._open_embeddings()
+            self._replay_log()
+            self._log_file = open(self.log_path, 'a', encoding='utf-8')
+            logger.info(f"Compacted document store {self.db_path}: {started_rows} -> {self.num_rows} embedding rows")
+
+    def _finish_compaction(self):
+        embeddings_tmp = f'{self.embeddings_path}.compact'
+        if os.path.exists(embeddings_tmp):
+            replace_atomic(embeddings_tmp, self.embeddings_path)
+        replace_atomic(f'{self.log_path}.compact', self.log_path)
+
+    def _recover_compaction(self):
+        log_tmp = f'{self.log_path}.compact'
+        if not os.path.exists(log_tmp):
+            return
+        with open(log_tmp, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        if lines and lines[-1] == json.dumps({'op': 'compacted'}):
+            # Журнал нового поколения дописан до конца - завершаем подмену
+            self._finish_compaction()
+            logger.info(f"Finished interrupted compaction of {self.db_path}")
+        else:
+            for path in (log_tmp, f'{self.embeddings_path}.compact'):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def put(self, doc_id, document, embedding=None):
+        self.put_many([(doc_id, document, embedding)])
+
+    def put_many(self, items):
+        """Сохраняет пачку документов ``(id, document, embedding)``.
+
+        Если embedding равен None, документ сохраняет прежнюю строку матрицы.
+        """
+        self._check_writable()
+        with self.lock:
+            new_embeddings = [embedding for _, _, embedding in items if embedding is not None]
+            new_rows = iter(self._append_embeddings(np.array(new_embeddings)) if new_embeddings else ())
+
+            records = []
+            for doc_id, document, embedding in items:
+                row = next(new_rows) if embedding is not None else self.rows[doc_id]
+                records.append({'op': 'put', 'id': doc_id, 'row': row})
+
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO documents (id, title, content, category, extra) VALUES (?, ?, ?, ?, ?)',
+                [self._to_row(doc_id, document) for doc_id, document, _ in items]
+            )
+            self.conn.commit()
+            self._append_log(records)
+
+    def delete(self, doc_id):
+        return self.delete_many([doc_id]) == 1
+
+    def delete_many(self, doc_ids):
+        self._check_writable()
+        with self.lock:
+            doc_ids = [doc_id for doc_id in doc_ids if doc_id in self.rows]
+            if not doc_ids:
+                return 0
+            self.conn.executemany('DELETE FROM documents WHERE id = ?', [(doc_id,) for doc_id in doc_ids])
+            self.conn.commit()
+            self._append_log([{'op': 'delete', 'id': doc_id} for doc_id in doc_ids])
+            return len(doc_ids)
+
+    def _check_writable(self):
+        if self.read_only:
+            raise RuntimeError(f'Document store {self.db_path} is opened read-only')
+
+    def _to_row(self, doc_id, document):
+        extra = {k: v for k, v in document.items() if k not in METADATA_FIELDS and k not in ('id', 'embedding')}
+        return (
+            doc_id,
+            document.get('title', ''),
+            document.get('content', ''),
+            document.get('category', ''),
+            json.dumps(extra, ensure_ascii=False) if extra else None
+        )
+
+    def _from_row(self, row):
+        doc_id, title, content, category, extra = row
+        document = json.loads(extra) if extra else {}
+        document.update({'id': doc_id, 'title': title, 'content': content, 'category': category})
+        return document
+
+    def get(self, doc_id):
+        return self.get_many([doc_id]).get(doc_id)
+
+    def get_many(self, doc_ids, content_length=None):
+        """Читает документы по ID; content_length обрезает content на стороне SQLite."""
+        doc_ids = list(doc_ids)
+        if not doc_ids:
+            return {}
+        with self.lock:
+            placeholders = ','.join('?' * len(doc_ids))
+            content = 'content' if content_length is None else f'substr(content, 1, {int(content_length)})'
+            cursor = self.conn.execute(
+                f'SELECT id, title, {content}, category, extra FROM documents WHERE id IN ({placeholders})',
+                doc_ids
+            )
+            return {row[0]: self._from_row(row) for row in cursor}
+
+    def categories(self):
+        """Возвращает пары (ID, category) для всех живых документов."""
+        with self.lock:
+            cursor = self.conn.execute('SELECT id, category FROM documents')
+            return [(doc_id, category or '') for doc_id, category in cursor if doc_id in self.rows]
+
+    def iter_documents(self, batch_size=1000):
+        """Потоково перебирает живые документы без загрузки всей таблицы в память."""
+        last_id = None
+        while True:
+            with self.lock:
+                if last_id is None:
+                    cursor = self.conn.execute(
+                        'SELECT id, title, content, category, extra FROM documents ORDER BY id LIMIT ?',
+                        (batch_size,)
+                    )
+                else:
+                    cursor = self.conn.execute(
+                        'SELECT id, title, content, category, extra FROM documents WHERE id > ? ORDER BY id LIMIT ?',
+                        (last_id, batch_size)
+                    )
+                rows = cursor.fetchall()
+            if not rows:
+                return
+            for row in rows:
+                if row[0] in self.rows:
+                    yield self._from_row(row)
+            last_id = rows[-1][0]
+
+    def get_embedding(self, doc_id):
+        return self.get_embeddings([doc_id])[0]
+
+    def get_embeddings(self, doc_ids):
+        with self.lock:
+            rows = [self.rows[doc_id] for doc_id in doc_ids]
+            if rows and max(rows) >= len(self.embeddings):
+                # Отображение в память устарело после дозаписи строк
+                self._sync_header()
+                self._map_embeddings()
+            return np.asarray(self.embeddings[rows], dtype='float32')
+
+    def all_embeddings(self):
+        """Возвращает ID всех живых документов и их embeddings."""
+        with self.lock:
+            ids = np.fromiter(self.rows.keys(), dtype='int64', count=len(self.rows))
+            return ids, self.get_embeddings(ids.tolist())
+
+
+def migrate_from_json(json_path, store, batch_size=1000):
+    """Переносит документы из старого documents.json в бинарное хранилище."""
+    with open(json_path, 'r', encoding='utf-8') as f:
+        documents = json.load(f)
+
+    batch = []
+    migrated = 0
+    for document in documents:
+        embedding = document.get('embedding')
+        if 'id' not in document or not embedding or len(embedding) != store.dim:
+            logger.warning(f"Skipping document {document.get('id')} without a valid embedding")
+            continue
+        batch.append((document['id'], document, embedding))
+        if len(batch) >= batch_size:
+            store.put_many(batch)
+            migrated += len(batch)
+            batch = []
+    if batch:
+        store.put_many(batch)
+        migrated += len(batch)
+
+    logger.info(f"Migrated {migrated} documents from {json_path}")
+    return migrated
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Миграция documents.json в бинарное хранилище документов')
+    parser.add_argument('json_path', help='путь к documents.json')
+    parser.add_argument('--data-dir', help='каталог хранилища (по умолчанию рядом с documents.json)')
+    parser.add_argument('--dim', type=int, default=384, help='размерность embeddings')
+    args = parser.parse_args()
+
+    store = DocumentStore(args.data_dir or os.path.dirname(os.path.abspath(args.json_path)), args.dim)
+    store.open()
+    try:
+        migrate_from_json(args.json_path, store)
+    finally:
+        store.close()
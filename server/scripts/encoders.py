@@ -0,0 +1,191 @@
+import os
+import json
+import atexit
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+logger = logging.getLogger('faiss-service')
+
+# torch - исходная модель PyTorch в fp32; torch-int8 - та же модель с динамически
+# квантованными в int8 линейными слоями; onnx и onnx-int8 - экспортированная
+# модель в ONNX Runtime (нужен пакет onnxruntime)
+ENCODER_BACKENDS = ('torch', 'torch-int8', 'onnx', 'onnx-int8')
+
+
+class TorchEncoder:
+    def __init__(self, model_name, quantize=False, num_threads=None):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.model = SentenceTransformer(model_name, device='cpu')
+        if quantize:
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    def encode(self, texts, batch_size=32):
+        return self.model.encode(texts, batch_size=batch_size)
+
+
+class OnnxEncoder:
+    """Модель sentence-transformers, экспортированная в ONNX.
+
+    Поддерживаются модели вида Transformer + mean Pooling, как
+    distilbert-base-nli-mean-tokens. При первом запуске модель экспортируется
+    в ``model_dir`` (для этого нужны torch и sentence-transformers), дальше
+    используются только onnxruntime и токенизатор.
+    """
+
+    def __init__(self, model_name, model_dir, quantize=False, num_threads=None):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        path = prepare_onnx_model(model_name, model_dir, quantize)
+
+        with open(os.path.join(model_dir, 'encoder.json'), 'r', encoding='utf-8') as f:
+            self.max_seq_length = json.load(f)['max_seq_length']
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def encode(self, texts, batch_size=32):
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            inputs = self.tokenizer(
+                list(texts[start:start + batch_size]),
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors='np'
+            )
+            feeds = {name: inputs[name].astype('int64') for name in self.input_names}
+            token_embeddings = self.session.run(None, feeds)[0]
+
+            # Mean pooling по токенам без учета паддинга, как в модуле Pooling
+            mask = inputs['attention_mask'][..., None].astype('float32')
+            summed = (token_embeddings * mask).sum(axis=1)
+            batches.append(summed / np.clip(mask.sum(axis=1), 1e-9, None))
+        if not batches:
+            return np.zeros((0, 0), dtype='float32')
+        return np.vstack(batches).astype('float32')
+
+
+def prepare_onnx_model(model_name, model_dir, quantize=False):
+    """Экспортирует и при необходимости квантует модель, возвращает путь к файлу ONNX."""
+    fp32_path = os.path.join(model_dir, 'model.onnx')
+    if not os.path.exists(fp32_path):
+        export_onnx(model_name, model_dir)
+    if not quantize:
+        return fp32_path
+
+    path = os.path.join(model_dir, 'model-int8.onnx')
+    if not os.path.exists(path):
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(fp32_path, path, weight_type=QuantType.QInt8)
+        logger.info(f"Quantized ONNX model to {path}")
+    return path
+
+
+def export_onnx(model_name, model_dir):
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, device='cpu')
+    transformer, pooling = model[0], model[1]
+    if len(model) != 2 or not getattr(pooling, 'pooling_mode_mean_tokens', False):
+        raise ValueError(f"ONNX export supports Transformer + mean Pooling models only, got {model_name}")
+
+    os.makedirs(model_dir, exist_ok=True)
+    transformer.tokenizer.save_pretrained(model_dir)
+    with open(os.path.join(model_dir, 'encoder.json'), 'w', encoding='utf-8') as f:
+        json.dump({'model_name': model_name, 'max_seq_length': model.get_max_seq_length()}, f)
+
+    inputs = dict(transformer.tokenizer(['Пример текста для экспорта'], return_tensors='pt'))
+    names = list(inputs)
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in names}
+    dynamic_axes['last_hidden_state'] = {0: 'batch', 1: 'sequence'}
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer.auto_model,
+            (inputs,),
+            os.path.join(model_dir, 'model.onnx'),
+            input_names=names,
+            output_names=['last_hidden_state'],
+            dynamic_axes=dynamic_axes,
+            opset_version=14
+        )
+    logger.info(f"Exported {model_name} to ONNX in {model_dir}")
+
+
+def create_encoder(backend, model_name, model_dir=None, num_threads=None):
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f"Unknown encoder backend '{backend}', expected one of {', '.join(ENCODER_BACKENDS)}")
+    if backend in ('torch', 'torch-int8'):
+        return TorchEncoder(model_name, quantize=backend == 'torch-int8', num_threads=num_threads)
+    if model_dir is None:
+        raise ValueError('model_dir is required for ONNX backends')
+    return OnnxEncoder(model_name, model_dir, quantize=backend == 'onnx-int8', num_threads=num_threads)
+
+
+# Модель внутри процесса-воркера; загружается один раз при старте процесса
+_worker_encoder = None
+
+
+def _init_worker(backend, model_name, model_dir, num_threads):
+    global _worker_encoder
+    _worker_encoder = create_encoder(backend, model_name, model_dir, num_threads)
+
+
+def _encode_in_worker(texts, batch_size):
+    return np.asarray(_worker_encoder.encode(texts, batch_size=batch_size), dtype='float32')
+
+
+class EncoderPool:
+    """Пул процессов, каждый из которых держит свою копию модели.
+
+    Тексты передаются воркерам через очередь ProcessPoolExecutor, обратно
+    возвращаются только матрицы embeddings. Веса модели загружаются в каждом
+    воркере один раз при старте, а не на каждый запрос. FAISS-индекс остается
+    в основном процессе.
+    """
+
+    def __init__(self, workers, backend, model_name, model_dir=None, threads_per_worker=1, batch_size=32):
+        if backend not in ENCODER_BACKENDS:
+            raise ValueError(f"Unknown encoder backend '{backend}', expected one of {', '.join(ENCODER_BACKENDS)}")
+        # Экспорт ONNX выполняется один раз здесь, чтобы воркеры не делали его наперегонки
+        if backend in ('onnx', 'onnx-int8'):
+            prepare_onnx_model(model_name, model_dir, quantize=backend == 'onnx-int8')
+
+        self.workers = workers
+        self.batch_size = batch_size
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(backend, model_name, model_dir, threads_per_worker)
+        )
+        atexit.register(self.executor.shutdown, wait=False)
+
+    def warmup(self):
+        # Запускает все процессы и дожидается загрузки модели в каждом
+        futures = [self.submit(['Прогрев модели перед приемом запросов']) for _ in range(self.workers)]
+        for future in futures:
+            future.result()
+
+    def submit(self, texts):
+        return self.executor.submit(_encode_in_worker, list(texts), self.batch_size)
+
+    def encode(self, texts, batch_size=None):
+        # Большую пачку делим между всеми воркерами
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, 0), dtype='float32')
+        chunk = max(batch_size or self.batch_size, -(-len(texts) // self.workers))
+        futures = [self.submit(texts[start:start + chunk]) for start in range(0, len(texts), chunk)]
+        return np.vstack([future.result() for future in futures])
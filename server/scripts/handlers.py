@@ -0,0 +1,232 @@
+"""
+Общая логика эндпоинтов поискового сервиса.
+
+Flask (search_service.py) и FastAPI (search_api.py) только читают тело
+запроса и отдают ответ; проверка запроса, вызов FAISSService и формирование
+ответа находятся здесь. Обработчики синхронные и возвращают пару
+(тело ответа, HTTP-статус), FastAPI выполняет их в пуле потоков.
+"""
+
+import json
+import time
+import logging
+
+from index_factory import index_kind
+
+logger = logging.getLogger('faiss-service')
+
+
+def ok(**fields):
+    return {'status': 'ok', **fields}, 200
+
+
+def error(message, status_code, **extra):
+    return {'status': 'error', 'message': message, **extra}, status_code
+
+
+def not_ready(service):
+    message = f'Service failed to start: {service.load_error}' if service.load_error else 'Service is starting'
+    return error(message, 503, state=service.state())
+
+
+def read_only():
+    return error('Service is running as a read-only replica', 405)
+
+
+def health(service):
+    # Liveness: процесс отвечает, даже если модель еще загружается
+    return ok(version='1.0.0', state=service.state(), ready=service.ready.is_set())
+
+
+def readiness(service):
+    # Readiness: 200 только после загрузки модели и индекса
+    if service.ready.is_set():
+        return ok(state='ready')
+    return error(service.load_error, 503, state=service.state())
+
+
+def initialize(service):
+    try:
+        service.initialize()
+        return ok(message='FAISS service initialized')
+    except Exception as e:
+        return error(str(e), 500)
+
+
+def rebuild_index(service):
+    try:
+        if not service.initialized:
+            service.initialize()
+        # Переобучение индекса на текущих данных, например после массовой загрузки
+        service.rebuild_index()
+        return ok(type=index_kind(service.index), size=len(service.vectors))
+    except Exception as e:
+        return error(str(e), 500)
+
+
+def cache_stats(service):
+    return ok(
+        query_embeddings=service.query_cache.stats(),
+        search_results={**service.result_cache.stats(), 'generation': service.generation}
+    )
+
+
+def batching_stats(service, embed_workers, **extra):
+    if service.batcher is None:
+        return ok(**extra, enabled=False)
+    return ok(**extra, enabled=True, embed_workers=embed_workers, **service.batcher.stats())
+
+
+def wal_stats(service):
+    return ok(**service.wal.stats(), ops_since_snapshot=service.ops_since_snapshot)
+
+
+def embed(service, data):
+    if not data or 'text' not in data:
+        return error('Missing text field', 400)
+
+    try:
+        return ok(embedding=service.generate_embedding(data['text']))
+    except Exception as e:
+        return error(str(e), 500)
+
+
+def search(service, data):
+    if not data:
+        return error('Missing request body', 400)
+
+    try:
+        limit = int(data.get('limit', 5))
+        fields = data.get('fields', 'full')
+        if 'query' in data:
+            # Поиск по текстовому запросу
+            results = service.search(data['query'], limit, fields, data.get('filters'), data.get('mode', 'vector'))
+        elif 'embedding' in data:
+            # Поиск по embedding
+            results = service.search_by_embedding(data['embedding'], limit, fields, data.get('filters'))
+        else:
+            return error('Missing query or embedding field', 400)
+        return ok(results=results)
+    except ValueError as e:
+        return error(str(e), 400)
+    except Exception as e:
+        return error(str(e), 500)
+
+
+def search_batch(service, data):
+    if not data:
+        return error('Missing request body', 400)
+
+    try:
+        limit = int(data.get('limit', 5))
+        fields = data.get('fields', 'full')
+        if 'queries' in data:
+            # Пакетный поиск по текстовым запросам
+            results = service.search_batch(data['queries'], limit, fields, data.get('filters'), data.get('mode', 'vector'))
+        elif 'embeddings' in data:
+            # Пакетный поиск по embeddings
+            results = service.search_embeddings(data['embeddings'], limit, fields, data.get('filters')) if data['embeddings'] else []
+        else:
+            return error('Missing queries or embeddings field', 400)
+        return ok(results=results)
+    except ValueError as e:
+        return error(str(e), 400)
+    except Exception as e:
+        return error(str(e), 500)
+
+
+def add_document(service, data):
+    if not data or 'content' not in data or 'title' not in data:
+        return error('Missing required fields', 400)
+
+    try:
+        return ok(id=service.add_document(data))
+    except Exception as e:
+        return error(str(e), 500)
+
+
+def update_document(service, doc_id, data):
+    if not data:
+        return error('Missing request body', 400)
+
+    try:
+        service.update_document(doc_id, data)
+        return ok(id=doc_id)
+    except ValueError as e:
+        return error(str(e), 404)
+    except Exception as e:
+        return error(str(e), 500)
+
+
+def delete_document(service, doc_id):
+    try:
+        if service.delete_document(doc_id):
+            return ok()
+        return error(f'Document with ID {doc_id} not found', 404)
+    except Exception as e:
+        return error(str(e), 500)
+
+
+class BulkIngest:
+    """Потоковая загрузка NDJSON, по одному документу на строку.
+
+    Фреймворк читает тело запроса и передает строки в ``feed``; когда набирается
+    пачка из batch_size документов, ``feed`` возвращает ее для ``write``.
+    Строки с ошибками не прерывают загрузку и попадают в ``errors``.
+    """
+
+    def __init__(self, service, batch_size):
+        self.service = service
+        self.batch_size = batch_size
+        self.started = time.perf_counter()
+        self.ids = []
+        self.errors = []
+        self.batch = []
+        self.line_no = 0
+
+    def feed(self, line):
+        self.line_no += 1
+        line = line.strip()
+        if not line:
+            return None
+        try:
+            document = json.loads(line)
+        except ValueError as e:
+            self.errors.append({'line': self.line_no, 'message': f'Invalid JSON: {e}'})
+            return None
+        if not isinstance(document, dict) or 'content' not in document or 'title' not in document:
+            self.errors.append({'line': self.line_no, 'message': 'Missing required fields'})
+            return None
+
+        self.batch.append(document)
+        if len(self.batch) < self.batch_size:
+            return None
+        batch, self.batch = self.batch, []
+        return batch
+
+    def write(self, batch):
+        self.ids.extend(self.service.add_documents(batch, persist=False))
+
+    def finish(self):
+        if self.batch:
+            batch, self.batch = self.batch, []
+            self.write(batch)
+        # Снимок индекса - по общим правилам, после всей загрузки
+        if self.ids:
+            self.service.maybe_snapshot()
+
+    def failed(self, e):
+        logger.error(f"Bulk ingestion failed after {len(self.ids)} documents: {str(e)}")
+        return error(str(e), 500, ids=self.ids, errors=self.errors)
+
+    def result(self):
+        elapsed = time.perf_counter() - self.started
+        docs_per_sec = len(self.ids) / elapsed if elapsed > 0 else 0.0
+        logger.info(f"Bulk ingested {len(self.ids)} documents in {elapsed:.2f}s ({docs_per_sec:.1f} docs/sec)")
+        return ok(
+            count=len(self.ids),
+            ids=self.ids,
+            errors=self.errors,
+            elapsed_sec=round(elapsed, 3),
+            docs_per_sec=round(docs_per_sec, 1)
+        )
@@ -0,0 +1,330 @@
+import logging
+import numpy as np
+import faiss
+
+logger = logging.getLogger('faiss-service')
+
+INDEX_TYPES = ('flat', 'ivf', 'ivfpq', 'hnsw')
+
+# Минимум обучающих векторов на один центроид, при котором k-means в FAISS не ругается
+MIN_POINTS_PER_CENTROID = 39
+
+
+def trained_nlist(kind, n, nlist=1024, pq_nbits=8):
+    """Число списков IVF для n обучающих векторов или 0, если их недостаточно."""
+    nlist = min(nlist, n // MIN_POINTS_PER_CENTROID)
+    min_points = MIN_POINTS_PER_CENTROID * (2 ** pq_nbits) if kind == 'ivfpq' else MIN_POINTS_PER_CENTROID
+    return nlist if nlist >= 1 and n >= min_points else 0
+
+
+def expected_kind(kind, train_size, nlist=1024, pq_nbits=8, **params):
+    """Тип индекса, который build_index создаст из train_size обучающих векторов.
+
+    Для маленького корпуса IVF заменяется на flat, и такой индекс считается
+    соответствующим запрошенному типу, пока корпус не вырастет.
+    """
+    if kind in ('ivf', 'ivfpq') and not trained_nlist(kind, train_size, nlist, pq_nbits):
+        return 'flat'
+    return kind
+
+
+def build_index(kind, dim, train_embeddings=None, nlist=1024, pq_m=48, pq_nbits=8,
+                hnsw_m=32, ef_construction=80):
+    """Создает пустой индекс заданного типа, при необходимости обученный.
+
+    Все индексы принимают векторы через ``add_with_ids``: flat и HNSW обернуты
+    в ``IndexIDMap2``, IVF хранит ID документов сам. Если обучающих данных
+    недостаточно для IVF, возвращается flat-индекс.
+    """
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{kind}', expected one of {', '.join(INDEX_TYPES)}")
+
+    if kind == 'flat':
+        return faiss.IndexIDMap2(faiss.IndexFlatL2(dim))
+
+    if kind == 'hnsw':
+        index = faiss.IndexHNSWFlat(dim, hnsw_m)
+        index.hnsw.efConstruction = ef_construction
+        return faiss.IndexIDMap2(index)
+
+    n = 0 if train_embeddings is None else len(train_embeddings)
+    nlist = trained_nlist(kind, n, nlist, pq_nbits)
+    if not nlist:
+        logger.warning(f"Not enough vectors to train '{kind}' index ({n}), falling back to flat")
+        return build_index('flat', dim)
+
+    if kind == 'ivf':
+        index = faiss.index_factory(dim, f'IVF{nlist},Flat')
+    else:
+        index = faiss.index_factory(dim, f'IVF{nlist},PQ{pq_m}x{pq_nbits}')
+    index.train(np.ascontiguousarray(train_embeddings, dtype='float32'))
+    # Хэш-таблица ID позволяет удалять векторы без полного обхода инвертированных списков
+    index.set_direct_map_type(faiss.DirectMap.Hashtable)
+    logger.info(f"Trained '{kind}' index with nlist={nlist} on {n} vectors")
+    return index
+
+
+def index_kind(index):
+    """Определяет тип индекса, созданного build_index, или None для чужих индексов."""
+    if isinstance(index, faiss.IndexIDMap2):
+        inner = faiss.downcast_index(index.index)
+        if isinstance(inner, faiss.IndexFlat):
+            return 'flat'
+        if isinstance(inner, faiss.IndexHNSWFlat):
+            return 'hnsw'
+        return None
+    if isinstance(index, faiss.IndexIVFPQ):
+        return 'ivfpq'
+    if isinstance(index, faiss.IndexIVFFlat):
+        return 'ivf'
+    return None
+
+
+class TombstoneIndex:
+    """Добавление, удаление и поиск по индексу build_index с отложенным удалением.
+
+    Для flat и HNSW (IndexIDMap2) remove_ids стоит O(размер индекса): он
+    сдвигает все последующие векторы и заново строит обратную карту ID, а
+    граф HNSW удаление не поддерживает вовсе. Поэтому позиция удаленного
+    вектора только помечается мертвой, новый вектор документа добавляется
+    под тем же ID в конец, а поиск берет кандидатов с запасом и отбрасывает
+    мертвые позиции. Индекс пересобирается вызывающим, когда dead_ratio()
+    превышает порог. IVF с хэш-таблицей ID удаляет векторы сам.
+    """
+
+    def __init__(self, index, live_ids=None):
+        self.index = index
+        self.tombstones = isinstance(index, faiss.IndexIDMap2)
+        self.size = 0
+        self.dead_count = 0
+        if not self.tombstones:
+            return
+        # Позиция во вложенном индексе -> ID документа
+        self.labels = faiss.vector_to_array(index.id_map).astype('int64')
+        self.size = len(self.labels)
+        # Актуален последний вектор каждого ID, более ранние - прежние версии
+        _, last = np.unique(self.labels[::-1], return_index=True)
+        self.dead = np.ones(self.size, dtype=bool)
+        self.dead[self.size - 1 - last] = False
+        if live_ids is not None:
+            live_ids = np.fromiter(live_ids, dtype='int64')
+            self.dead |= ~np.isin(self.labels, live_ids)
+        self.dead_count = int(self.dead.sum())
+
+    def __len__(self):
+        return self.size - self.dead_count if self.tombstones else self.index.ntotal
+
+    def dead_ratio(self):
+        return self.dead_count / self.size if self.size else 0.0
+
+    def ids(self):
+        """ID живых векторов."""
+        if not self.tombstones:
+            # IVF хранит ID в инвертированных списках
+            invlists = faiss.extract_index_ivf(self.index).invlists
+            ids = [np.zeros(0, dtype='int64')]
+            for list_no in range(invlists.nlist):
+                size = invlists.list_size(list_no)
+                if size:
+                    list_ids = invlists.get_ids(list_no)
+                    ids.append(faiss.rev_swig_ptr(list_ids, size).copy())
+                    invlists.release_ids(list_no, list_ids)
+            return np.concatenate(ids)
+        return self.labels[:self.size][~self.dead[:self.size]]
+
+    def add(self, embeddings, ids):
+        """Добавляет векторы новых ID; для замены существующих есть replace."""
+        ids = np.asarray(ids, dtype='int64')
+        embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+        self.index.add_with_ids(embeddings, ids)
+        if not self.tombstones:
+            return
+        size = self.size + len(ids)
+        if size > len(self.labels):
+            capacity = max(size, 2 * len(self.labels))
+            self.labels = np.concatenate([self.labels, np.zeros(capacity - len(self.labels), dtype='int64')])
+            self.dead = np.concatenate([self.dead, np.ones(capacity - len(self.dead), dtype=bool)])
+        self.labels[self.size:size] = ids
+        self.dead[self.size:size] = False
+        self.size = size
+
+    def replace(self, embeddings, ids):
+        """Заменяет векторы существующих ID (или добавляет новые)."""
+        self.remove(ids)
+        self.add(embeddings, ids)
+
+    def remove(self, ids):
+        ids = np.asarray(ids, dtype='int64')
+        if not self.tombstones:
+            return self.index.remove_ids(ids)
+        positions = np.flatnonzero(np.isin(self.labels[:self.size], ids) & ~self.dead[:self.size])
+        self.dead[positions] = True
+        self.dead_count += len(positions)
+        return len(positions)
+
+    def search(self, queries, k):
+        """Как index.search: матрицы N x k, пустые позиции заполнены -1 и inf."""
+        queries = np.ascontiguousarray(queries, dtype='float32')
+        if not self.tombstones:
+            return self.index.search(queries, k)
+        distances = np.full((len(queries), k), np.inf, dtype='float32')
+        labels = np.full((len(queries), k), -1, dtype='int64')
+        wanted = min(k, len(self))
+        if wanted == 0:
+            return distances, labels
+
+        # Кандидатов берем с запасом на мертвые позиции и удваиваем запас,
+        # пока каждому запросу не хватит живых результатов
+        inner = faiss.downcast_index(self.index.index)
+        fetch = min(self.size, k + min(self.dead_count, max(k, 16)))
+        while True:
+            found, positions = inner.search(queries, fetch)
+            valid = positions >= 0
+            valid[valid] = ~self.dead[positions[valid]]
+            if fetch >= self.size or valid.sum(axis=1).min() >= wanted:
+                break
+            fetch = min(self.size, fetch * 2)
+
+        for row, row_valid in enumerate(valid):
+            keep = np.flatnonzero(row_valid)[:k]
+            distances[row, :len(keep)] = found[row, keep]
+            labels[row, :len(keep)] = self.labels[positions[row, keep]]
+        return distances, labels
+
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    kind = index_kind(index)
+    if kind in ('ivf', 'ivfpq') and nprobe is not None:
+        faiss.extract_index_ivf(index).nprobe = nprobe
+    elif kind == 'hnsw' and ef_search is not None:
+        faiss.downcast_index(index.index).hnsw.efSearch = ef_search
+
+
+def read_index_mmap(path):
+    """Открывает индекс только на чтение с отображением файла в память.
+
+    Несколько процессов, открывших один файл, делят страничный кэш ОС.
+    В новых версиях FAISS IO_FLAG_MMAP_IFC отображает весь файл, включая
+    коды flat и HNSW. В старых (в том числе закрепленной в requirements.txt
+    1.7.2) есть только IO_FLAG_MMAP: он отображает инвертированные списки
+    IVF, а flat и HNSW каждая реплика читает в свою память.
+    Вместе эти флаги использовать нельзя.
+    """
+    if hasattr(faiss, 'IO_FLAG_MMAP_IFC'):
+        return faiss.read_index(path, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+    index = faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    if index_kind(index) not in ('ivf', 'ivfpq'):
+        logger.warning(f"FAISS {faiss.__version__} cannot mmap '{index_kind(index)}' indexes, "
+                       f"{path} is loaded into process memory")
+    return index
+
+
+def sample_embeddings(embeddings, sample_size, seed=0):
+    """Случайная выборка строк для обучения квантизаторов."""
+    if len(embeddings) <= sample_size:
+        return np.ascontiguousarray(embeddings, dtype='float32')
+    rows = np.sort(np.random.RandomState(seed).choice(len(embeddings), sample_size, replace=False))
+    return np.ascontiguousarray(embeddings[rows], dtype='float32')
+
+
+class CategoryIndexes:
+    """Отдельный flat-индекс на каждую категорию документов.
+
+    Поиск с фильтром по категории обходит только векторы этой категории,
+    поэтому его стоимость пропорциональна размеру категории, а не корпуса.
+    """
+
+    def __init__(self, dim):
+        self.dim = dim
+        self.indexes = {}
+
+    def clear(self):
+        self.indexes = {}
+
+    def add(self, ids, embeddings, categories):
+        ids = np.asarray(ids, dtype='int64')
+        embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+        categories = np.asarray(categories, dtype=object)
+        for category in set(categories.tolist()):
+            mask = categories == category
+            if category not in self.indexes:
+                self.indexes[category] = faiss.IndexIDMap2(faiss.IndexFlatL2(self.dim))
+            self.indexes[category].add_with_ids(embeddings[mask], ids[mask])
+
+    def remove(self, doc_id, category):
+        index = self.indexes.get(category)
+        if index is None:
+            return
+        index.remove_ids(np.array([doc_id], dtype='int64'))
+        if index.ntotal == 0:
+            del self.indexes[category]
+
+    def search(self, queries, k, categories):
+        """Ищет по объединению категорий, возвращая общий top-k как index.search."""
+        indexes = [self.indexes[c] for c in categories if c in self.indexes and self.indexes[c].ntotal]
+        distances = np.full((len(queries), k), np.inf, dtype='float32')
+        labels = np.full((len(queries), k), -1, dtype='int64')
+        if not indexes:
+            return distances, labels
+
+        parts = [index.search(queries, min(k, index.ntotal)) for index in indexes]
+        all_distances = np.hstack([d for d, _ in parts])
+        all_labels = np.hstack([l for _, l in parts])
+        if len(parts) > 1:
+            order = np.argsort(all_distances, axis=1, kind='stable')[:, :k]
+            all_distances = np.take_along_axis(all_distances, order, axis=1)
+            all_labels = np.take_along_axis(all_labels, order, axis=1)
+
+        found = all_distances.shape[1]
+        distances[:, :found] = all_distances
+        labels[:, :found] = all_labels
+        return distances, labels
+
+    def sizes(self):
+        return {category: index.ntotal for category, index in self.indexes.items()}
+
+
+class MappedCategoryIndexes:
+    """Поиск по категориям для реплик только на чтение.
+
+    В отличие от CategoryIndexes векторы не копируются в память процесса:
+    для каждой категории хранятся только ID, а сами embeddings читаются из
+    отображенной в память матрицы DocumentStore частями по chunk_size.
+    """
+
+    def __init__(self, store, chunk_size=65536):
+        self.store = store
+        self.chunk_size = chunk_size
+        self.indexes = {}
+
+    def clear(self):
+        self.indexes = {}
+
+    def assign(self, ids, categories):
+        ids = np.asarray(ids, dtype='int64')
+        categories = np.asarray(categories, dtype=object)
+        for category in set(categories.tolist()):
+            self.indexes[category] = ids[categories == category]
+
+    def search(self, queries, k, categories):
+        """Точный поиск по объединению категорий, результат как у index.search."""
+        queries = np.ascontiguousarray(queries, dtype='float32')
+        distances = np.full((len(queries), k), np.inf, dtype='float32')
+        labels = np.full((len(queries), k), -1, dtype='int64')
+        ids = [self.indexes[c] for c in categories if c in self.indexes]
+        ids = np.concatenate(ids) if ids else np.zeros(0, dtype='int64')
+
+        for start in range(0, len(ids), self.chunk_size):
+            chunk_ids = ids[start:start + self.chunk_size]
+            chunk = faiss.IndexFlatL2(self.store.dim)
+            chunk.add(self.store.get_embeddings(chunk_ids.tolist()))
+            chunk_distances, positions = chunk.search(queries, min(k, len(chunk_ids)))
+            all_distances = np.hstack([distances, chunk_distances])
+            all_labels = np.hstack([labels, chunk_ids[positions]])
+            order = np.argsort(all_distances, axis=1, kind='stable')[:, :k]
+            distances = np.take_along_axis(all_distances, order, axis=1)
+            labels = np.take_along_axis(all_labels, order, axis=1)
+        return distances, labels
+
+    def sizes(self):
+        return {category: len(ids) for category, ids in self.indexes.items()}
@@ -0,0 +1,215 @@
+import os
+import re
+import logging
+from collections import Counter, deque
+from itertools import islice
+
+import numpy as np
+import faiss
+
+from document_store import DocumentStore
+from index_factory import TombstoneIndex, expected_kind, index_kind, sample_embeddings, read_index_mmap
+from wal import write_index_atomic
+
+logger = logging.getLogger('faiss-service')
+
+# ID фрагмента: doc_id * PASSAGE_ID_STRIDE + порядковый номер фрагмента в документе
+PASSAGE_ID_STRIDE = 1 << 16
+PASSAGE_AGGREGATIONS = ('max', 'sum')
+WORD_RE = re.compile(r'\S+')
+
+
+def iter_passages(text, size=120, overlap=30):
+    """Лениво режет текст на перекрывающиеся фрагменты по ``size`` слов.
+
+    Возвращает пары (start, end) - границы фрагмента в исходной строке.
+    В памяти держится только текущее окно слов.
+    """
+    step = max(1, size - min(overlap, size - 1))
+    window = deque()
+    fresh = 0
+    for match in WORD_RE.finditer(text):
+        window.append(match.span())
+        fresh += 1
+        if len(window) == size:
+            yield window[0][0], window[-1][1]
+            for _ in range(step):
+                window.popleft()
+            fresh = 0
+    # Хвост документа, не вошедший целиком в предыдущие окна
+    if fresh:
+        yield window[0][0], window[-1][1]
+
+
+class PassageIndex:
+    """Индекс фрагментов длинных документов.
+
+    Фрагменты хранятся в отдельном DocumentStore ("passages") и в отдельном
+    индексе FAISS. При поиске найденные фрагменты сворачиваются обратно
+    в документы по максимуму или сумме лучших оценок.
+    """
+
+    def __init__(self, data_dir, dim, index_path, create_index, index_type, index_params=None,
+                 passage_size=120, overlap=30, batch_size=256, train_sample_size=100000, read_only=False):
+        self.store = DocumentStore(data_dir, dim, name='passages', read_only=read_only)
+        self.read_only = read_only
+        self.index_path = index_path
+        self.create_index = create_index
+        self.index_type = index_type
+        self.index_params = index_params or {}
+        self.passage_size = passage_size
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.train_sample_size = train_sample_size
+        self.index = None
+        self.vectors = None
+        self.passage_counts = Counter()
+
+    def __len__(self):
+        return len(self.store)
+
+    def use_index(self, index):
+        # Векторы фрагментов, которых уже нет в хранилище, сразу считаются удаленными
+        self.index = index
+        self.vectors = TombstoneIndex(index, self.store.ids())
+
+    def open(self, replay_doc_ids=()):
+        """Открывает индекс; фрагменты документов replay_doc_ids берутся из хранилища заново."""
+        if self.store.conn is None:
+            self.store.open()
+        self.passage_counts = Counter(passage_id // PASSAGE_ID_STRIDE for passage_id in self.store.ids())
+
+        if self.read_only:
+            # Реплика обслуживает снимок как есть, перестраивает его основной процесс
+            self.use_index(read_index_mmap(self.index_path))
+        elif os.path.exists(self.index_path):
+            self.use_index(faiss.read_index(self.index_path))
+            kind = index_kind(self.index)
+            expected = expected_kind(self.index_type, min(len(self.store), self.train_sample_size), **self.index_params)
+            if kind == expected and replay_doc_ids:
+                self.replay(replay_doc_ids)
+            if kind != expected or len(self.vectors) != len(self.store):
+                logger.info("Passage index does not match stored passages, rebuilding")
+                self.rebuild()
+        else:
+            self.rebuild()
+
+    def save(self):
+        write_index_atomic(self.index, self.index_path)
+
+    def replay(self, doc_ids):
+        doc_ids = set(doc_ids)
+        if self.vectors.tombstones:
+            ids = self.vectors.ids()
+            self.vectors.remove(ids[np.isin(ids // PASSAGE_ID_STRIDE, list(doc_ids))])
+        else:
+            # IVF с хэш-таблицей ID удаляет только по списку ID, а не по диапазону
+            for doc_id in doc_ids:
+                self.vectors.remove(np.arange(doc_id * PASSAGE_ID_STRIDE, (doc_id + 1) * PASSAGE_ID_STRIDE))
+        passage_ids = [passage_id for passage_id in self.store.ids() if passage_id // PASSAGE_ID_STRIDE in doc_ids]
+        if passage_ids:
+            self.vectors.add(self.store.get_embeddings(passage_ids), passage_ids)
+
+    def rebuild(self):
+        ids, embeddings = self.store.all_embeddings()
+        self.use_index(self.create_index(sample_embeddings(embeddings, self.train_sample_size)))
+        if len(ids):
+            self.vectors.add(embeddings, ids)
+        self.save()
+        logger.info(f"Passage index rebuilt ({index_kind(self.index)}, {self.index.ntotal} vectors)")
+
+    def _iter_document_passages(self, documents):
+        for document in documents:
+            content = document.get('content') or ''
+            spans = islice(iter_passages(content, self.passage_size, self.overlap), PASSAGE_ID_STRIDE)
+            for n, (start, end) in enumerate(spans):
+                passage_id = document['id'] * PASSAGE_ID_STRIDE + n
+                yield passage_id, {'content': content[start:end], 'start': start, 'end': end}
+
+    def encode_batches(self, documents, encode_fn):
+        """Режет документы на фрагменты и кодирует их пачками по batch_size; индекс не меняется."""
+        passages = self._iter_document_passages(documents)
+        while True:
+            batch = list(islice(passages, self.batch_size))
+            if not batch:
+                break
+            embeddings = np.asarray(encode_fn([passage['content'] for _, passage in batch]), dtype='float32')
+            yield batch, embeddings
+
+    def add_encoded(self, batches):
+        """Добавляет пачки фрагментов, закодированные encode_batches."""
+        added = 0
+        for batch, embeddings in batches:
+            ids = [passage_id for passage_id, _ in batch]
+            self.store.put_many([(passage_id, passage, embedding)
+                                 for (passage_id, passage), embedding in zip(batch, embeddings)])
+            self.vectors.add(embeddings, ids)
+            for passage_id in ids:
+                self.passage_counts[passage_id // PASSAGE_ID_STRIDE] += 1
+            added += len(batch)
+        return added
+
+    def add_documents(self, documents, encode_fn):
+        """Режет документы на фрагменты и индексирует их пачками по batch_size.
+
+        Документы и фрагменты обрабатываются потоком, поэтому память
+        ограничена одной пачкой фрагментов. Индекс на диск не сохраняется.
+        """
+        return self.add_encoded(self.encode_batches(documents, encode_fn))
+
+    def remove_documents(self, doc_ids):
+        passage_ids = [
+            doc_id * PASSAGE_ID_STRIDE + n
+            for doc_id in doc_ids
+            for n in range(self.passage_counts.pop(doc_id, 0))
+        ]
+        if not passage_ids:
+            return 0
+        self.store.delete_many(passage_ids)
+        self.vectors.remove(passage_ids)
+        return len(passage_ids)
+
+    def search(self, embeddings, limit, aggregation='max', top_n=3, candidates=5):
+        """Ищет фрагменты и сворачивает их в документы.
+
+        Возвращает матрицы оценок документов, ID документов, ID лучших
+        фрагментов и L2-расстояний до лучшего фрагмента размером N x limit;
+        пустые позиции заполнены -1 (расстояния - inf).
+        """
+        if aggregation not in PASSAGE_AGGREGATIONS:
+            raise ValueError(f"Unknown aggregation '{aggregation}', expected one of {', '.join(PASSAGE_AGGREGATIONS)}")
+
+        queries = np.asarray(embeddings, dtype='float32').reshape(len(embeddings), -1)
+        scores = np.zeros((len(queries), limit), dtype='float32')
+        doc_ids = np.full((len(queries), limit), -1, dtype='int64')
+        best_passages = np.full((len(queries), limit), -1, dtype='int64')
+        best_distances = np.full((len(queries), limit), np.inf, dtype='float32')
+        k = min(limit * candidates, len(self.vectors))
+        if k == 0:
+            return scores, doc_ids, best_passages, best_distances
+
+        distances, passage_ids = self.vectors.search(queries, k)
+        similarities = 1.0 / (1.0 + distances)
+        for row, (row_similarities, row_distances, row_passages) in enumerate(
+                zip(similarities.tolist(), distances.tolist(), passage_ids.tolist())):
+            # Фрагменты уже упорядочены по убыванию сходства
+            hits = {}
+            for similarity, distance, passage_id in zip(row_similarities, row_distances, row_passages):
+                if passage_id != -1:
+                    hits.setdefault(passage_id // PASSAGE_ID_STRIDE, []).append((similarity, passage_id, distance))
+
+            ranked = []
+            for doc_id, doc_hits in hits.items():
+                if aggregation == 'max':
+                    score = doc_hits[0][0]
+                else:
+                    score = sum(similarity for similarity, _, _ in doc_hits[:top_n])
+                ranked.append((score, doc_id, doc_hits[0][1], doc_hits[0][2]))
+            ranked.sort(reverse=True)
+
+            for col, (score, doc_id, passage_id, distance) in enumerate(ranked[:limit]):
+                scores[row, col] = score
+                doc_ids[row, col] = doc_id
+                best_passages[row, col] = passage_id
+                best_distances[row, col] = distance
+        return scores, doc_ids, best_passages, best_distances
@@ -0,0 +1,81 @@
+"""
+Блокировка чтения-записи для индексов FAISSService.
+
+Индексы FAISS (IndexIDMap2, индексы категорий) не потокобезопасны при
+изменении: запись должна идти одна и без параллельных поисков, а поиски
+между собой совместимы. Ожидающий писатель не пропускает новых читателей
+вперед, поэтому поток поисков не может бесконечно откладывать запись.
+"""
+
+import threading
+from contextlib import contextmanager
+
+
+class ReadWriteLock:
+    """Много читателей или один писатель.
+
+    Писатель может повторно брать блокировку записи и брать блокировку
+    чтения (например, save_index внутри rebuild_index). Читатель может
+    повторно брать блокировку чтения, но не может перейти к записи.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = None
+        self.write_depth = 0
+        self.waiting_writers = 0
+        self.local = threading.local()
+
+    @contextmanager
+    def reading(self):
+        me = threading.get_ident()
+        depth = getattr(self.local, 'depth', 0)
+        # Вложенное чтение и чтение внутри своей записи не ждут
+        if depth or self.writer == me:
+            self.local.depth = depth + 1
+            try:
+                yield
+            finally:
+                self.local.depth = depth
+            return
+
+        with self.cond:
+            while self.writer is not None or self.waiting_writers:
+                self.cond.wait()
+            self.readers += 1
+        self.local.depth = 1
+        try:
+            yield
+        finally:
+            self.local.depth = 0
+            with self.cond:
+                self.readers -= 1
+                if not self.readers:
+                    self.cond.notify_all()
+
+    @contextmanager
+    def writing(self):
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.write_depth += 1
+            else:
+                if getattr(self.local, 'depth', 0):
+                    raise RuntimeError('Cannot upgrade a read lock to a write lock')
+                self.waiting_writers += 1
+                try:
+                    while self.writer is not None or self.readers:
+                        self.cond.wait()
+                finally:
+                    self.waiting_writers -= 1
+                self.writer = me
+                self.write_depth = 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.write_depth -= 1
+                if not self.write_depth:
+                    self.writer = None
+                    self.cond.notify_all()
@@ -0,0 +1,233 @@
+"""
+ASGI-версия поискового сервиса на FastAPI.
+
+Использует тот же FAISSService и те же обработчики handlers.py, что и
+search_service.py, но модель и поиск по индексу выполняются в ограниченном
+пуле потоков, поэтому цикл событий продолжает принимать соединения во время
+прямого прохода модели.
+
+Запуск отдельно:
+    uvicorn search_api:app --port 5000
+или внутри основного API (server/main.py) при SEARCH_API_MOUNT=1 по пути /faiss.
+"""
+
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from fastapi.middleware.cors import CORSMiddleware
+
+from search_service import (
+    service, logger, BACKGROUND_LOADING, READY_WAIT_TIMEOUT, BULK_BATCH_SIZE, EMBED_WORKERS, READ_ONLY
+)
+import handlers
+
+# Число потоков для модели и index.search. SEARCH_MAX_PENDING ограничивает
+# очередь задач: сверх нее запросы сразу получают 503, а не копятся в памяти.
+# Записи и поиски из разных потоков упорядочивает FAISSService.index_lock
+SEARCH_EXECUTOR_THREADS = int(os.environ.get('SEARCH_EXECUTOR_THREADS', os.cpu_count() or 4))
+SEARCH_MAX_PENDING = int(os.environ.get('SEARCH_MAX_PENDING', 256))
+
+executor = ThreadPoolExecutor(max_workers=SEARCH_EXECUTOR_THREADS, thread_name_prefix='search')
+# Счетчик меняется только в потоке цикла событий, блокировка не нужна
+pending = 0
+
+app = FastAPI(title='LawTech Search API', version='1.0.0')
+app.add_middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])
+
+# Пути, доступные до окончания загрузки модели и индекса
+NOT_GATED_PATHS = {'/health', '/ready', '/cache/stats', '/batching/stats', '/wal/stats'}
+
+
+class Overloaded(Exception):
+    pass
+
+
+async def run_blocking(fn, *args):
+    """Выполняет CPU-нагруженную функцию в пуле потоков, не блокируя цикл событий."""
+    global pending
+    if SEARCH_MAX_PENDING > 0 and pending >= SEARCH_MAX_PENDING:
+        raise Overloaded()
+    pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+    finally:
+        pending -= 1
+
+
+def respond(result):
+    body, status_code = result
+    return JSONResponse(body, status_code=status_code)
+
+
+async def handle(handler, *args):
+    """Выполняет общий обработчик из handlers.py в пуле потоков."""
+    return respond(await run_blocking(handler, service, *args))
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+def start_service():
+    """Запускает загрузку модели и индекса; вызывается при старте приложения."""
+    if service.ready.is_set() or service.loading:
+        return
+    if BACKGROUND_LOADING:
+        service.start_background_loading()
+    else:
+        try:
+            service.load_model()
+            service.initialize()
+            service.mark_ready()
+        except Exception as e:
+            logger.error(f"Failed to initialize service: {str(e)}")
+
+
+@app.on_event('startup')
+async def startup():
+    start_service()
+
+
+@app.on_event('shutdown')
+async def shutdown():
+    executor.shutdown(wait=False)
+    # Снимок при штатной остановке, чтобы следующий запуск не догонял журнал
+    if service.initialized and service.ops_since_snapshot and not READ_ONLY:
+        service.save_index()
+
+
+@app.middleware('http')
+async def wait_until_ready(request, call_next):
+    if request.url.path in NOT_GATED_PATHS or not service.loading and service.load_error is None:
+        return await call_next(request)
+    ready = await asyncio.get_running_loop().run_in_executor(None, service.ready.wait, READY_WAIT_TIMEOUT)
+    if ready:
+        return await call_next(request)
+
+    response = respond(handlers.not_ready(service))
+    response.headers['Retry-After'] = '5'
+    return response
+
+
+@app.middleware('http')
+async def reject_writes(request, call_next):
+    # Реплика только на чтение отклоняет изменения индекса
+    if READ_ONLY and request.method in ('POST', 'PUT', 'DELETE') and (
+            request.url.path.startswith('/documents') or request.url.path == '/index/rebuild'):
+        return respond(handlers.read_only())
+    return await call_next(request)
+
+
+@app.exception_handler(Overloaded)
+async def overloaded(request, exc):
+    response = respond(handlers.error('Too many pending requests', 503))
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+@app.get('/health')
+async def health_check():
+    return respond(handlers.health(service))
+
+
+@app.get('/ready')
+async def readiness():
+    return respond(handlers.readiness(service))
+
+
+@app.post('/initialize')
+async def initialize():
+    return await handle(handlers.initialize)
+
+
+@app.post('/index/rebuild')
+async def rebuild_index():
+    return await handle(handlers.rebuild_index)
+
+
+@app.get('/cache/stats')
+async def cache_stats():
+    return respond(handlers.cache_stats(service))
+
+
+@app.get('/batching/stats')
+async def batching_stats():
+    return respond(handlers.batching_stats(
+        service, EMBED_WORKERS, executor_threads=SEARCH_EXECUTOR_THREADS, pending=pending
+    ))
+
+
+@app.get('/wal/stats')
+async def wal_stats():
+    return respond(handlers.wal_stats(service))
+
+
+@app.post('/embed')
+async def embed(request: Request):
+    return await handle(handlers.embed, await read_json(request))
+
+
+@app.post('/search')
+async def search(request: Request):
+    return await handle(handlers.search, await read_json(request))
+
+
+@app.post('/search/batch')
+async def search_batch(request: Request):
+    return await handle(handlers.search_batch, await read_json(request))
+
+
+@app.post('/documents')
+async def add_document(request: Request):
+    return await handle(handlers.add_document, await read_json(request))
+
+
+async def iter_lines(request):
+    buffer = b''
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
+
+
+@app.post('/documents/bulk')
+async def add_documents_bulk(request: Request):
+    # Тело запроса - NDJSON, по одному документу на строку; читаем его потоком
+    ingest = handlers.BulkIngest(service, int(request.query_params.get('batch_size', BULK_BATCH_SIZE)))
+    try:
+        async for line in iter_lines(request):
+            batch = ingest.feed(line)
+            if batch:
+                await run_blocking(ingest.write, batch)
+        await run_blocking(ingest.finish)
+    except Overloaded:
+        raise
+    except Exception as e:
+        return respond(ingest.failed(e))
+    return respond(ingest.result())
+
+
+@app.put('/documents/{doc_id}')
+async def update_document(doc_id: int, request: Request):
+    return await handle(handlers.update_document, doc_id, await read_json(request))
+
+
+@app.delete('/documents/{doc_id}')
+async def delete_document(doc_id: int):
+    return await handle(handlers.delete_document, doc_id)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    # Один процесс держит индекс; параллелизм дают пул потоков и EMBED_WORKERS
+    uvicorn.run(app, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
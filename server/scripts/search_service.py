@@ -1,11 +1,26 @@
 import os
 import json
+import time
+import threading
+from contextlib import contextmanager
 import numpy as np
 import faiss
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from sentence_transformers import SentenceTransformer
 import logging
+from document_store import DocumentStore, migrate_from_json
+from batching import MicroBatcher
+from encoders import create_encoder, EncoderPool
+from bm25_index import BM25Index, reciprocal_rank_fusion
+from cache import LRUCache, normalize_query
+from passages import PassageIndex
+from rwlock import ReadWriteLock
+import handlers
+from wal import WriteAheadLog, write_index_atomic, write_json_atomic, read_snapshot_seq
+from index_factory import CategoryIndexes, MappedCategoryIndexes, TombstoneIndex, read_index_mmap, build_index, expected_kind, index_kind, set_search_params, sample_embeddings
+
+# Момент запуска процесса для измерения времени до первого ответа и до готовности
+PROCESS_STARTED = time.monotonic()
 
 app = Flask(__name__)
 CORS(app)
@@ -14,309 +29,987 @@ logging.basicConfig(level=logging.INFO,
                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('faiss-service')
 
-DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
+DATA_DIR = os.environ.get('FAISS_DATA_DIR', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data'))
 INDEX_PATH = os.path.join(DATA_DIR, 'faiss_index.bin')
+PASSAGE_INDEX_PATH = os.path.join(DATA_DIR, 'faiss_passages.bin')
 DOCUMENTS_PATH = os.path.join(DATA_DIR, 'documents.json')
-EMBEDDING_SIZE = 384
+WAL_PATH = os.path.join(DATA_DIR, 'faiss_wal.jsonl')
+SNAPSHOT_PATH = os.path.join(DATA_DIR, 'faiss_snapshot.json')
+LEXICAL_INDEX_PATH = os.path.join(DATA_DIR, 'bm25_index.npz')
+# Размерность embeddings модели; другое значение нужно вместе с другой моделью
+# (или заглушкой в benchmark_service.py --dim)
+EMBEDDING_SIZE = int(os.environ.get('EMBEDDING_SIZE', 384))
+MODEL_NAME = os.environ.get('MODEL_NAME', 'distilbert-base-nli-mean-tokens')
+
+# Бэкенд модели: torch, torch-int8, onnx или onnx-int8 (см. encoders.py)
+ENCODER_BACKEND = os.environ.get('ENCODER_BACKEND', 'torch')
+ENCODER_THREADS = int(os.environ.get('ENCODER_THREADS', 0))
+ONNX_MODEL_DIR = os.path.join(DATA_DIR, 'onnx', MODEL_NAME.replace('/', '_'))
+# EMBED_WORKERS > 0 выносит модель в пул отдельных процессов, индекс FAISS остается
+# в этом процессе. EMBED_WORKER_THREADS - число потоков torch/onnxruntime в каждом воркере
+EMBED_WORKERS = int(os.environ.get('EMBED_WORKERS', 0))
+EMBED_WORKER_THREADS = int(os.environ.get('EMBED_WORKER_THREADS', 1))
+
+# Модель и индекс загружаются в фоне, пока Flask уже принимает соединения.
+# MODEL_WARMUP прогоняет пробный текст через модель до объявления готовности,
+# READY_WAIT_TIMEOUT - сколько секунд запрос ждет готовности, прежде чем получить 503
+BACKGROUND_LOADING = os.environ.get('BACKGROUND_LOADING', '1') == '1'
+MODEL_WARMUP = os.environ.get('MODEL_WARMUP', '1') == '1'
+READY_WAIT_TIMEOUT = float(os.environ.get('READY_WAIT_TIMEOUT', 0))
+# Размер пачки документов при массовой загрузке и размер пачки для model.encode
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 512))
+ENCODE_BATCH_SIZE = int(os.environ.get('ENCODE_BATCH_SIZE', 64))
+
+# Изменения индекса пишутся в журнал (WAL) с групповой фиксацией за WAL_GROUP_COMMIT_MS,
+# а сам индекс сохраняется атомарным снимком раз в SNAPSHOT_EVERY_OPS документов
+# или SNAPSHOT_INTERVAL секунд; при запуске журнал догоняет снимок
+WAL_GROUP_COMMIT_MS = float(os.environ.get('WAL_GROUP_COMMIT_MS', 2))
+WAL_FSYNC = os.environ.get('WAL_FSYNC', '1') == '1'
+SNAPSHOT_EVERY_OPS = int(os.environ.get('SNAPSHOT_EVERY_OPS', 1000))
+SNAPSHOT_INTERVAL = float(os.environ.get('SNAPSHOT_INTERVAL', 300))
+# Вместе со снимком хранилище сжимается, если мертвых строк матрицы (после удалений
+# и замены embeddings) не меньше STORE_COMPACT_MIN_ROWS и доли STORE_COMPACT_RATIO
+STORE_COMPACT_RATIO = float(os.environ.get('STORE_COMPACT_RATIO', 0.3))
+STORE_COMPACT_MIN_ROWS = int(os.environ.get('STORE_COMPACT_MIN_ROWS', 1000))
+# Flat и HNSW не удаляют векторы сразу, а помечают их мертвыми (index_factory.TombstoneIndex);
+# индекс пересобирается вместе со снимком, когда мертвых позиций больше этой доли
+TOMBSTONE_REBUILD_RATIO = float(os.environ.get('TOMBSTONE_REBUILD_RATIO', 0.2))
+
+# READ_ONLY=1 - реплика только для поиска рядом с основным процессом: индекс
+# открывается через mmap, хранилище только читается, изменения отклоняются.
+# Новый снимок основного процесса подхватывается без остановки, файлы
+# проверяются раз в RELOAD_INTERVAL секунд
+READ_ONLY = os.environ.get('READ_ONLY', '0') == '1'
+RELOAD_INTERVAL = float(os.environ.get('RELOAD_INTERVAL', 5))
+
+# Тип индекса: flat (точный перебор), ivf, ivfpq или hnsw
+INDEX_TYPE = os.environ.get('INDEX_TYPE', 'flat')
+INDEX_PARAMS = {
+    'nlist': int(os.environ.get('IVF_NLIST', 1024)),
+    'pq_m': int(os.environ.get('PQ_M', 48)),
+    'pq_nbits': int(os.environ.get('PQ_NBITS', 8)),
+    'hnsw_m': int(os.environ.get('HNSW_M', 32)),
+    'ef_construction': int(os.environ.get('HNSW_EF_CONSTRUCTION', 80)),
+}
+IVF_NPROBE = int(os.environ.get('IVF_NPROBE', 16))
+HNSW_EF_SEARCH = int(os.environ.get('HNSW_EF_SEARCH', 64))
+TRAIN_SAMPLE_SIZE = int(os.environ.get('TRAIN_SAMPLE_SIZE', 100000))
+
+# Кэш embeddings поисковых запросов; TTL в секундах, 0 - без ограничения
+QUERY_CACHE_SIZE = int(os.environ.get('QUERY_CACHE_SIZE', 10000))
+QUERY_CACHE_TTL = float(os.environ.get('QUERY_CACHE_TTL', 0))
+# Кэш готовых результатов /search по запросу, limit, fields, фильтрам и режиму.
+# Ключ включает поколение индекса, поэтому любое изменение индекса делает старые
+# записи недостижимыми, и они вытесняются по LRU в пределах RESULT_CACHE_MAX_MB
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', 10000))
+RESULT_CACHE_MAX_MB = float(os.environ.get('RESULT_CACHE_MAX_MB', 64))
+RESULT_CACHE_TTL = float(os.environ.get('RESULT_CACHE_TTL', 0))
+
+# Объединение одновременных запросов /embed и /search в пачки для модели. Свободная
+# модель получает запрос сразу; до MICRO_BATCH_WAIT_MS новые запросы ждут только пока
+# модель занята предыдущими пачками (с EMBED_WORKERS > 0)
+MICRO_BATCH_ENABLED = os.environ.get('MICRO_BATCH_ENABLED', '1') == '1'
+MICRO_BATCH_MAX_SIZE = int(os.environ.get('MICRO_BATCH_MAX_SIZE', 32))
+MICRO_BATCH_WAIT_MS = float(os.environ.get('MICRO_BATCH_WAIT_MS', 5))
+
+# Состав результатов поиска: full - документ целиком, snippet - начало content,
+# ids - только ID и оценки в колоночном виде
+RESULT_FIELDS = ('full', 'snippet', 'ids')
+SNIPPET_LENGTH = int(os.environ.get('SNIPPET_LENGTH', 300))
+
+# Поля документа, по которым поддерживается фильтрация в /search
+SEARCH_FILTERS = ('category',)
+
+# Режимы поиска: vector - по embeddings, lexical - BM25, hybrid - объединение через RRF
+SEARCH_MODES = ('vector', 'lexical', 'hybrid')
+HYBRID_CANDIDATES = int(os.environ.get('HYBRID_CANDIDATES', 4))
+RRF_K = int(os.environ.get('RRF_K', 60))
+
+# Разбиение длинных документов на перекрывающиеся фрагменты (в словах).
+# Векторный поиск без фильтров идет по фрагментам, оценка документа -
+# максимум (max) или сумма PASSAGE_TOP_N лучших (sum) оценок его фрагментов
+CHUNKING_ENABLED = os.environ.get('CHUNKING_ENABLED', '0') == '1'
+PASSAGE_SIZE = int(os.environ.get('PASSAGE_SIZE', 120))
+PASSAGE_OVERLAP = int(os.environ.get('PASSAGE_OVERLAP', 30))
+PASSAGE_BATCH_SIZE = int(os.environ.get('PASSAGE_BATCH_SIZE', 256))
+PASSAGE_AGGREGATION = os.environ.get('PASSAGE_AGGREGATION', 'max')
+PASSAGE_TOP_N = int(os.environ.get('PASSAGE_TOP_N', 3))
+PASSAGE_CANDIDATES = int(os.environ.get('PASSAGE_CANDIDATES', 5))
 
 # Создаем директорию для данных, если она не существует
 os.makedirs(DATA_DIR, exist_ok=True)
 
+def snapshot_signature():
+    # save_index пишет faiss_snapshot.json последним, после индекса, фрагментов
+    # и BM25, поэтому его смена означает, что снимок записан целиком. rename при
+    # записи создает новый файл, поэтому меняется inode. Пока основной процесс
+    # не сохранил ни одного снимка после запуска, следим за самим индексом
+    path = SNAPSHOT_PATH if os.path.exists(SNAPSHOT_PATH) else INDEX_PATH
+    stat = os.stat(path)
+    return path, stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+# Все, что реплика берет из снимка и подменяет при перезагрузке
+SNAPSHOT_ATTRIBUTES = ('store', 'index', 'vectors', 'category_indexes', 'lexical_index', 'passages', 'snapshot_signature')
+
 class FAISSService:
     def __init__(self):
         self.index = None
-        self.documents = []
-        self.model = SentenceTransformer('distilbert-base-nli-mean-tokens')
+        self.vectors = None
+        self.store = DocumentStore(DATA_DIR, EMBEDDING_SIZE, read_only=READ_ONLY)
+        self.category_indexes = MappedCategoryIndexes(self.store) if READ_ONLY else CategoryIndexes(EMBEDDING_SIZE)
+        self.lexical_index = BM25Index()
+        self.passages = PassageIndex(
+            DATA_DIR,
+            EMBEDDING_SIZE,
+            PASSAGE_INDEX_PATH,
+            self.create_index,
+            INDEX_TYPE,
+            index_params=INDEX_PARAMS,
+            passage_size=PASSAGE_SIZE,
+            overlap=PASSAGE_OVERLAP,
+            batch_size=PASSAGE_BATCH_SIZE,
+            train_sample_size=TRAIN_SAMPLE_SIZE,
+            read_only=READ_ONLY
+        ) if CHUNKING_ENABLED else None
+        self.snapshot_signature = None
+        self.wal = WriteAheadLog(WAL_PATH, WAL_GROUP_COMMIT_MS, WAL_FSYNC)
+        self.ops_since_snapshot = 0
+        self.last_snapshot = time.monotonic()
+        self.model = None
+        self.model_lock = threading.Lock()
+        self.init_lock = threading.RLock()
+        # Индексы FAISS не потокобезопасны при изменении: записи идут под
+        # блокировкой записи, поиски и снимки - под блокировкой чтения
+        self.index_lock = ReadWriteLock()
+        self.snapshot_lock = threading.Lock()
+        self.ready = threading.Event()
+        self.loading = False
+        self.load_error = None
+        self.query_cache = LRUCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+        self.result_cache = LRUCache(
+            RESULT_CACHE_SIZE,
+            RESULT_CACHE_TTL,
+            max_bytes=int(RESULT_CACHE_MAX_MB * 1024 * 1024),
+            # Оценка по размеру ответа в JSON
+            sizeof=lambda result: len(json.dumps(result, ensure_ascii=False))
+        )
+        self.generation = 0
+        self.batcher = MicroBatcher(
+            lambda texts: self.get_model().encode(texts, batch_size=len(texts)),
+            MICRO_BATCH_MAX_SIZE,
+            MICRO_BATCH_WAIT_MS,
+            # С пулом воркеров пачки отправляются без ожидания, по две на воркер
+            submit_fn=(lambda texts: self.get_model().submit(texts)) if EMBED_WORKERS > 0 else None,
+            max_in_flight=max(1, EMBED_WORKERS * 2)
+        ) if MICRO_BATCH_ENABLED else None
         self.initialized = False
         
     def initialize(self):
+        with self.init_lock:
+            if self.initialized:
+                return
+            try:
+                self.load_documents()
+                if READ_ONLY:
+                    records = ()
+                    self.load_snapshot()
+                else:
+                    records = self.wal.open(read_snapshot_seq(SNAPSHOT_PATH))
+                    self.load_or_create_index(records)
+                self.build_category_indexes()
+                self.build_lexical_index(records)
+                if self.passages is not None:
+                    self.load_passages(records)
+                self.initialized = True
+                if records:
+                    # Догнанные по журналу индексы сразу сохраняем новым снимком
+                    self.save_index()
+                logger.info(f"FAISS service initialized with {len(self.store)} documents")
+            except Exception as e:
+                logger.error(f"Error initializing FAISS service: {str(e)}")
+                raise
+    
+    def start_background_loading(self):
+        self.loading = True
+        threading.Thread(target=self.load_in_background, name='service-loader', daemon=True).start()
+    
+    def load_in_background(self):
         try:
-            self.load_documents()
-            self.load_or_create_index()
-            self.initialized = True
-            logger.info(f"FAISS service initialized with {len(self.documents)} documents")
+            self.load_model()
+            self.initialize()
+            self.mark_ready()
+            logger.info(f"Service ready in {time.monotonic() - PROCESS_STARTED:.2f}s after process start")
         except Exception as e:
-            logger.error(f"Error initializing FAISS service: {str(e)}")
-            raise
+            self.load_error = str(e)
+            logger.error(f"Background loading failed: {str(e)}")
+        finally:
+            self.loading = False
     
-    def load_documents(self):
-        if os.path.exists(DOCUMENTS_PATH):
-            with open(DOCUMENTS_PATH, 'r', encoding='utf-8') as f:
-                self.documents = json.load(f)
-            logger.info(f"Loaded {len(self.documents)} documents from {DOCUMENTS_PATH}")
-        else:
-            self.documents = []
-            logger.info("No document file found, starting with empty document list")
+    def mark_ready(self):
+        self.ready.set()
+        if READ_ONLY and RELOAD_INTERVAL > 0:
+            threading.Thread(target=self.watch_snapshots, name='snapshot-watcher', daemon=True).start()
+        elif not READ_ONLY and SNAPSHOT_INTERVAL > 0:
+            threading.Thread(target=self.snapshot_periodically, name='snapshot-timer', daemon=True).start()
+    
+    def snapshot_periodically(self):
+        # maybe_snapshot вызывается из записей; без таймера изменения после
+        # последней записи не попадут в снимок (и в реплики), пока не придет следующая
+        while True:
+            time.sleep(max(1.0, self.last_snapshot + SNAPSHOT_INTERVAL - time.monotonic()))
+            try:
+                self.maybe_snapshot()
+            except Exception as e:
+                logger.error(f"Periodic snapshot failed: {str(e)}")
+    
+    def watch_snapshots(self):
+        while True:
+            time.sleep(RELOAD_INTERVAL)
+            try:
+                if snapshot_signature() != self.snapshot_signature:
+                    self.reload_snapshot()
+            except Exception as e:
+                logger.error(f"Snapshot reload failed: {str(e)}")
+    
+    def reload_snapshot(self):
+        # Новый снимок открывается рядом со старым, затем ссылки подменяются разом;
+        # запросы, начатые до подмены, дочитывают старый снимок
+        started = time.perf_counter()
+        replica = FAISSService()
+        replica.initialize()
+        with self.index_lock.writing():
+            # Старые ссылки переходят в replica, чтобы закрыть их после подмены
+            for name in SNAPSHOT_ATTRIBUTES:
+                current = getattr(self, name)
+                setattr(self, name, getattr(replica, name))
+                setattr(replica, name, current)
+            self.generation += 1
+        # Поиски читают снимок под блокировкой чтения, после подмены старый снимок
+        # никто не использует: закрываем хранилища и отпускаем отображенные файлы
+        replica.close()
+        logger.info(f"Reloaded index snapshot ({len(self.vectors)} vectors) in {time.perf_counter() - started:.2f}s")
+    
+    def close(self):
+        self.store.close()
+        if self.passages is not None:
+            self.passages.store.close()
+        self.wal.close()
+        self.index = self.vectors = None
     
-    def save_documents(self):
-        with open(DOCUMENTS_PATH, 'w', encoding='utf-8') as f:
-            json.dump(self.documents, f, ensure_ascii=False, indent=2)
-        logger.info(f"Saved {len(self.documents)} documents to {DOCUMENTS_PATH}")
+    def check_writable(self):
+        if READ_ONLY:
+            raise RuntimeError('Service is running as a read-only replica')
     
-    def load_or_create_index(self):
+    def state(self):
+        if self.ready.is_set():
+            return 'ready'
+        if self.load_error is not None:
+            return 'failed'
+        return 'loading' if self.loading else 'idle'
+    
+    def load_model(self):
+        with self.model_lock:
+            if self.model is None:
+                started = time.perf_counter()
+                if EMBED_WORKERS > 0:
+                    model = EncoderPool(EMBED_WORKERS, ENCODER_BACKEND, MODEL_NAME, ONNX_MODEL_DIR,
+                                        EMBED_WORKER_THREADS or None, batch_size=ENCODE_BATCH_SIZE)
+                    # Воркеры загружают модель при старте, дожидаемся всех
+                    model.warmup()
+                else:
+                    model = create_encoder(ENCODER_BACKEND, MODEL_NAME, ONNX_MODEL_DIR, ENCODER_THREADS or None)
+                    if MODEL_WARMUP:
+                        # Первый вызов encode инициализирует ленивые структуры модели
+                        model.encode(['Прогрев модели перед приемом запросов'])
+                self.model = model
+                workers = f", {EMBED_WORKERS} worker processes" if EMBED_WORKERS > 0 else ''
+                logger.info(f"Loaded model {MODEL_NAME} ({ENCODER_BACKEND}{workers}) in {time.perf_counter() - started:.2f}s")
+        return self.model
+    
+    def get_model(self):
+        return self.model if self.model is not None else self.load_model()
+    
+    def load_documents(self):
+        if self.store.conn is None:
+            self.store.open()
+        
+        # Однократная миграция из старого documents.json
+        if not READ_ONLY and len(self.store) == 0 and os.path.exists(DOCUMENTS_PATH):
+            migrate_from_json(DOCUMENTS_PATH, self.store)
+            os.replace(DOCUMENTS_PATH, DOCUMENTS_PATH + '.migrated')
+        
+        logger.info(f"Loaded {len(self.store)} documents from {DATA_DIR}")
+    
+    def load_or_create_index(self, records=()):
         if os.path.exists(INDEX_PATH):
-            self.index = faiss.read_index(INDEX_PATH)
+            self.use_index(faiss.read_index(INDEX_PATH))
             logger.info(f"Loaded FAISS index from {INDEX_PATH}")
-        else:
-            self.index = faiss.IndexFlatL2(EMBEDDING_SIZE)
             
-            # Если есть документы, добавляем их в индекс
-            if self.documents:
-                embeddings = [np.array(doc.get('embedding', [])) for doc in self.documents]
-                if embeddings and len(embeddings[0]) == EMBEDDING_SIZE:
-                    embeddings_array = np.array(embeddings).astype('float32')
-                    self.index.add(embeddings_array)
-            
-            faiss.write_index(self.index, INDEX_PATH)
+            # Старые индексы хранили векторы по позиции в списке документов,
+            # переводим их на индекс с привязкой к ID документа.
+            # Индекс также пересобирается при смене INDEX_TYPE (flat вместо IVF
+            # на маленьком корпусе сменой не считается)
+            kind = index_kind(self.index)
+            expected = expected_kind(INDEX_TYPE, min(len(self.store), TRAIN_SAMPLE_SIZE), **INDEX_PARAMS)
+            if kind == expected:
+                self.replay_wal(records)
+            if kind != expected or len(self.vectors) != len(self.store):
+                logger.info(f"FAISS index ({kind}) does not match INDEX_TYPE={INDEX_TYPE} or documents, rebuilding")
+                self.rebuild_index()
+            else:
+                set_search_params(self.index, nprobe=IVF_NPROBE, ef_search=HNSW_EF_SEARCH)
+        else:
+            self.rebuild_index()
             logger.info(f"Created new FAISS index at {INDEX_PATH}")
     
+    def load_snapshot(self):
+        if not os.path.exists(INDEX_PATH):
+            raise RuntimeError(f"No index snapshot at {INDEX_PATH} to serve read-only")
+        self.snapshot_signature = snapshot_signature()
+        self.use_index(read_index_mmap(INDEX_PATH))
+        set_search_params(self.index, nprobe=IVF_NPROBE, ef_search=HNSW_EF_SEARCH)
+        logger.info(f"Mapped FAISS index snapshot from {INDEX_PATH} ({len(self.vectors)} vectors)")
+    
+    def replay_wal(self, records):
+        # Журнал хранит только ID измененных документов, актуальные векторы
+        # берутся из хранилища, поэтому повторное применение записей безопасно
+        touched = sorted({doc_id for record in records for doc_id in record['ids']})
+        if not touched:
+            return
+        alive = [doc_id for doc_id in touched if doc_id in self.store]
+        self.vectors.remove(touched)
+        if alive:
+            self.vectors.add(self.store.get_embeddings(alive), alive)
+        logger.info(f"Replayed {len(records)} WAL records ({len(touched)} documents) onto the index snapshot")
+    
+    def build_category_indexes(self):
+        # Индексы категорий всегда точные и строятся из хранилища при запуске
+        self.category_indexes.clear()
+        pairs = self.store.categories()
+        if pairs:
+            ids, categories = zip(*pairs)
+            if READ_ONLY:
+                # Реплика ищет по категориям только среди документов снимка,
+                # векторы читаются из отображенной в память матрицы
+                ids, categories = np.asarray(ids, dtype='int64'), np.asarray(categories, dtype=object)
+                in_snapshot = np.isin(ids, self.vectors.ids())
+                self.category_indexes.assign(ids[in_snapshot], categories[in_snapshot])
+            else:
+                self.category_indexes.add(ids, self.store.get_embeddings(ids), categories)
+        logger.info(f"Built {len(self.category_indexes.indexes)} category indexes")
+    
+    def load_passages(self, records=()):
+        self.passages.open({doc_id for record in records for doc_id in record['ids']})
+        
+        # Документы, загруженные до включения CHUNKING_ENABLED, режем один раз
+        if not READ_ONLY and len(self.passages) == 0 and len(self.store):
+            added = self.passages.add_documents(self.store.iter_documents(), self.generate_embeddings)
+            self.passages.save()
+            logger.info(f"Indexed {added} passages for existing documents")
+        logger.info(f"Loaded passage index with {len(self.passages)} passages")
+    
+    def build_lexical_index(self, records=()):
+        # Снимок BM25 пишется вместе со снимком FAISS; если он не старше,
+        # догоняем его по журналу вместо токенизации всего хранилища
+        started = time.perf_counter()
+        seq = self.lexical_index.load(LEXICAL_INDEX_PATH)
+        if seq is not None and READ_ONLY:
+            # Реплика не догоняет журнал: BM25 берется из того же снимка, что и векторы
+            logger.info(f"Loaded BM25 snapshot from {LEXICAL_INDEX_PATH} with {len(self.lexical_index)} documents "
+                        f"in {time.perf_counter() - started:.2f}s")
+            return
+        if seq is not None and seq >= read_snapshot_seq(SNAPSHOT_PATH):
+            touched = {doc_id for record in records for doc_id in record['ids']}
+            documents = self.store.get_many(touched)
+            for doc_id in touched:
+                if doc_id in documents:
+                    self.index_lexical(documents[doc_id])
+                else:
+                    self.lexical_index.remove(doc_id)
+            if len(self.lexical_index) == len(self.store):
+                logger.info(f"Loaded BM25 index from {LEXICAL_INDEX_PATH} with {len(self.lexical_index)} documents "
+                            f"({len(touched)} replayed from WAL) in {time.perf_counter() - started:.2f}s")
+                return
+            logger.warning("BM25 snapshot does not match the document store, rebuilding")
+            self.lexical_index = BM25Index()
+        self.lexical_index.build(
+            (document['id'], self.lexical_text(document), document.get('category') or '')
+            for document in self.store.iter_documents()
+        )
+        logger.info(f"Built BM25 index with {len(self.lexical_index)} documents "
+                    f"in {time.perf_counter() - started:.2f}s")
+    
+    def lexical_text(self, document):
+        return f"{document.get('title') or ''} {document.get('content') or ''}"
+
+    def index_lexical(self, document):
+        self.lexical_index.add(document['id'], self.lexical_text(document), document.get('category') or '')
+    
+    def use_index(self, index):
+        # Векторы документов, которых уже нет в хранилище, сразу считаются удаленными
+        self.index = index
+        self.vectors = TombstoneIndex(index, self.store.ids())
+    
+    def create_index(self, train_embeddings=None):
+        # Векторы хранятся под ID документа, что позволяет точечно удалять и добавлять их
+        index = build_index(INDEX_TYPE, EMBEDDING_SIZE, train_embeddings, **INDEX_PARAMS)
+        set_search_params(index, nprobe=IVF_NPROBE, ef_search=HNSW_EF_SEARCH)
+        return index
+    
     def generate_embedding(self, text):
-        embedding = self.model.encode([text])[0]
+        if self.batcher is not None:
+            return self.batcher.encode(text).tolist()
+        embedding = self.get_model().encode([text])[0]
         return embedding.tolist()
     
+    def embed_query(self, query):
+        # Повторные запросы берутся из кэша без обращения к модели; нормализованная
+        # строка служит только ключом кэша, модель получает исходный текст
+        key = normalize_query(query)
+        embedding = self.query_cache.get(key)
+        if embedding is None:
+            embedding = self.generate_embedding(query)
+            self.query_cache.put(key, embedding)
+        return embedding
+    
+    def generate_embeddings(self, texts):
+        return self.get_model().encode(texts, batch_size=ENCODE_BATCH_SIZE)
+    
     def add_document(self, document):
+        self.check_writable()
         if not self.initialized:
             self.initialize()
         
-        # Генерируем ID для нового документа
-        doc_id = max([doc.get('id', 0) for doc in self.documents], default=0) + 1
+        # Новый ID выдает счетчик хранилища, без обхода всех документов
+        doc_id = self.store.allocate_ids(1)[0]
         
         # Генерируем embedding, если его нет
-        if 'embedding' not in document:
-            document['embedding'] = self.generate_embedding(document['content'])
+        embedding = document.pop('embedding', None)
+        if embedding is None:
+            embedding = self.generate_embedding(document['content'])
         
-        # Добавляем ID и сохраняем документ
         document['id'] = doc_id
-        self.documents.append(document)
-        self.save_documents()
+        passage_batches = self.encode_passages([document])
         
-        # Добавляем embedding в индекс
-        embedding = np.array([document['embedding']]).astype('float32')
-        self.index.add(embedding)
-        faiss.write_index(self.index, INDEX_PATH)
+        with self.logged('add', [doc_id]):
+            # Сохраняем документ: embedding дописывается в матрицу, поля - в SQLite
+            self.store.put(doc_id, document, embedding)
+            
+            # Добавляем embedding в индекс
+            embedding = np.array([embedding]).astype('float32')
+            self.vectors.add(embedding, [doc_id])
+            self.category_indexes.add([doc_id], embedding, [document.get('category') or ''])
+            self.index_lexical(document)
+            if passage_batches is not None:
+                self.passages.add_encoded(passage_batches)
+        self.maybe_snapshot()
         
         return doc_id
     
-    def update_document(self, doc_id, document):
+    def add_documents(self, documents, persist=True):
+        self.check_writable()
         if not self.initialized:
             self.initialize()
         
-        # Находим документ по ID
-        for i, doc in enumerate(self.documents):
-            if doc.get('id') == doc_id:
-                # Если контент изменился, обновляем embedding
-                if document.get('content') and document['content'] != doc.get('content'):
-                    document['embedding'] = self.generate_embedding(document['content'])
-                
-                # Обновляем документ, сохраняя ID
-                updated_doc = {**doc, **document, 'id': doc_id}
-                self.documents[i] = updated_doc
-                self.save_documents()
-                
-                # Пересоздаем индекс (в FAISS нельзя обновить отдельный вектор)
-                self.rebuild_index()
-                
-                return doc_id
+        # Выделяем ID подряд для всей пачки
+        doc_ids = self.store.allocate_ids(len(documents))
+        
+        # Кодируем все тексты без embedding одним вызовом модели
+        embeddings = [document.pop('embedding', None) for document in documents]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            encoded = self.generate_embeddings([documents[i]['content'] for i in missing])
+            for i, embedding in zip(missing, encoded):
+                embeddings[i] = embedding
+        embeddings_array = np.array(embeddings).astype('float32')
+        for doc_id, document in zip(doc_ids, documents):
+            document['id'] = doc_id
+        passage_batches = self.encode_passages(documents)
+        
+        # Вся пачка - одна запись журнала
+        with self.logged('add', doc_ids):
+            self.store.put_many(list(zip(doc_ids, documents, embeddings_array)))
+            
+            # Добавляем всю пачку в индекс одним вызовом
+            self.vectors.add(embeddings_array, doc_ids)
+            self.category_indexes.add(doc_ids, embeddings_array, [document.get('category') or '' for document in documents])
+            for document in documents:
+                self.index_lexical(document)
+            if passage_batches is not None:
+                self.passages.add_encoded(passage_batches)
+        if persist:
+            self.maybe_snapshot()
         
-        # Если документ не найден
-        raise ValueError(f"Document with ID {doc_id} not found")
+        return doc_ids
     
-    def delete_document(self, doc_id):
+    @contextmanager
+    def logged(self, op, doc_ids):
+        # Запись попадает в журнал до изменения хранилища и индексов; пока она
+        # не применена, снимок не отрезает ее из журнала
+        seq = self.wal.append(op, doc_ids)
+        try:
+            # Журнал пишется до блокировки, чтобы параллельные записи попадали
+            # в одну групповую фиксацию; индексы меняются по одной записи
+            with self.index_lock.writing():
+                try:
+                    yield seq
+                finally:
+                    self.generation += 1
+        finally:
+            self.wal.applied(seq)
+        self.ops_since_snapshot += len(doc_ids)
+    
+    def encode_passages(self, documents):
+        # Фрагменты кодируются моделью до блокировки записи, чтобы не задерживать поиски
+        if self.passages is None:
+            return None
+        return list(self.passages.encode_batches(documents, self.generate_embeddings))
+    
+    def maybe_snapshot(self):
+        # Мертвые позиции flat/HNSW вычищает пересборка, она же пишет снимок
+        dead_ratio = self.vectors.dead_ratio()
+        if self.passages is not None:
+            dead_ratio = max(dead_ratio, self.passages.vectors.dead_ratio())
+        if dead_ratio > TOMBSTONE_REBUILD_RATIO:
+            self.rebuild_index()
+        elif (self.ops_since_snapshot >= SNAPSHOT_EVERY_OPS
+                or self.ops_since_snapshot and time.monotonic() - self.last_snapshot >= SNAPSHOT_INTERVAL):
+            self.save_index()
+    
+    def save_index(self):
+        # Снимок пишется во временный файл и подменяет старый через rename.
+        # Блокировка чтения не пускает записи, поиски при этом продолжаются
+        with self.index_lock.reading(), self.snapshot_lock:
+            seq = self.wal.checkpoint_seq()
+            write_index_atomic(self.index, INDEX_PATH)
+            if self.passages is not None and self.passages.index is not None:
+                self.passages.save()
+            # До конца инициализации журнал еще нужен для фрагментов
+            if self.initialized:
+                self.lexical_index.save(LEXICAL_INDEX_PATH, seq)
+                write_json_atomic({'seq': seq, 'size': len(self.vectors)}, SNAPSHOT_PATH)
+                self.wal.truncate(seq)
+                self.store.maybe_compact(STORE_COMPACT_RATIO, STORE_COMPACT_MIN_ROWS)
+                if self.passages is not None:
+                    self.passages.store.maybe_compact(STORE_COMPACT_RATIO, STORE_COMPACT_MIN_ROWS)
+            self.ops_since_snapshot = 0
+            self.last_snapshot = time.monotonic()
+    
+    def update_document(self, doc_id, document):
+        self.check_writable()
         if not self.initialized:
             self.initialize()
         
         # Находим документ по ID
-        for i, doc in enumerate(self.documents):
-            if doc.get('id') == doc_id:
-                # Удаляем документ
-                del self.documents[i]
-                self.save_documents()
-                
-                # Пересоздаем индекс
-                self.rebuild_index()
-                
-                return True
+        doc = self.store.get(doc_id)
+        if doc is None:
+            raise ValueError(f"Document with ID {doc_id} not found")
         
-        # Если документ не найден
-        return False
-    
-    def rebuild_index(self):
-        # Создаем новый индекс
-        self.index = faiss.IndexFlatL2(EMBEDDING_SIZE)
+        # Если контент изменился, обновляем embedding
+        embedding = document.pop('embedding', None)
+        if embedding is None and document.get('content') and document['content'] != doc.get('content'):
+            embedding = self.generate_embedding(document['content'])
+        passage_batches = None
+        if document.get('content') is not None and document['content'] != doc.get('content'):
+            passage_batches = self.encode_passages([{**doc, **document, 'id': doc_id}])
         
-        # Добавляем все embeddings
-        if self.documents:
-            embeddings = [np.array(doc.get('embedding', [])) for doc in self.documents]
-            if embeddings and len(embeddings[0]) == EMBEDDING_SIZE:
-                embeddings_array = np.array(embeddings).astype('float32')
-                self.index.add(embeddings_array)
+        with self.logged('update', [doc_id]):
+            # Документ перечитывается под блокировкой: его могли изменить или удалить параллельно
+            doc = self.store.get(doc_id)
+            if doc is None:
+                raise ValueError(f"Document with ID {doc_id} not found")
+            
+            # Обновляем документ, сохраняя ID
+            updated_doc = {**doc, **document, 'id': doc_id}
+            self.store.put(doc_id, updated_doc, embedding)
+            
+            # Заменяем только вектор этого документа, если embedding изменился;
+            # в flat и HNSW старый вектор лишь помечается мертвым
+            if embedding is not None:
+                self.vectors.replace(np.array([embedding]).astype('float32'), [doc_id])
+            
+            # Переносим вектор между индексами категорий
+            old_category = doc.get('category') or ''
+            new_category = updated_doc.get('category') or ''
+            if embedding is not None or new_category != old_category:
+                self.category_indexes.remove(doc_id, old_category)
+                new_embedding = self.store.get_embeddings([doc_id])
+                self.category_indexes.add([doc_id], new_embedding, [new_category])
+            self.index_lexical(updated_doc)
+            
+            # Фрагменты пересчитываются только при изменении текста
+            if self.passages is not None and updated_doc.get('content') != doc.get('content'):
+                self.passages.remove_documents([doc_id])
+                if passage_batches is None:
+                    passage_batches = self.encode_passages([updated_doc])
+                self.passages.add_encoded(passage_batches)
+        self.maybe_snapshot()
         
-        # Сохраняем индекс
-        faiss.write_index(self.index, INDEX_PATH)
-        logger.info("FAISS index rebuilt")
+        return doc_id
     
-    def search(self, query, limit=5):
+    def delete_document(self, doc_id):
+        self.check_writable()
         if not self.initialized:
             self.initialize()
         
-        # Если индекс пустой, возвращаем пустой результат
-        if self.index.ntotal == 0:
-            return []
-        
-        # Генерируем embedding для запроса
-        query_embedding = self.generate_embedding(query)
-        query_embedding_array = np.array([query_embedding]).astype('float32')
+        # Удаляем документ; если его нет, сообщаем об этом
+        doc = self.store.get(doc_id)
+        if doc is None:
+            return False
+        with self.logged('delete', [doc_id]):
+            doc = self.store.get(doc_id)
+            if doc is None or not self.store.delete(doc_id):
+                return False
+            self.category_indexes.remove(doc_id, doc.get('category') or '')
+            self.lexical_index.remove(doc_id)
+            if self.passages is not None:
+                self.passages.remove_documents([doc_id])
+            
+            # Удаляем вектор документа из индекса; в flat и HNSW он помечается мертвым
+            self.vectors.remove([doc_id])
+        self.maybe_snapshot()
         
-        # Выполняем поиск
-        distances, indices = self.index.search(query_embedding_array, min(limit, self.index.ntotal))
+        return True
+    
+    def rebuild_index(self):
+        self.check_writable()
+        with self.index_lock.writing():
+            ids, embeddings_array = self.store.all_embeddings()
+            
+            # Создаем новый индекс, обучая его на выборке сохраненных embeddings
+            self.use_index(self.create_index(sample_embeddings(embeddings_array, TRAIN_SAMPLE_SIZE)))
+            
+            # Добавляем все embeddings под ID документов
+            if len(ids):
+                self.vectors.add(embeddings_array, ids)
+            
+            # Фрагменты переобучаются вместе с основным индексом
+            if self.passages is not None and self.passages.index is not None:
+                self.passages.rebuild()
+            self.generation += 1
+            
+            # Сохраняем индекс
+            self.save_index()
+            logger.info(f"FAISS index rebuilt ({index_kind(self.index)}, {self.index.ntotal} vectors)")
+    
+    def search(self, query, limit=5, fields='full', filters=None, mode='vector'):
+        return self.search_batch([query], limit, fields, filters, mode)[0]
+    
+    def search_by_embedding(self, embedding, limit=5, fields='full', filters=None):
+        return self.search_embeddings([embedding], limit, fields, filters)[0]
+    
+    def search_batch(self, queries, limit=5, fields='full', filters=None, mode='vector'):
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown mode '{mode}', expected one of {', '.join(SEARCH_MODES)}")
+        if not self.initialized:
+            self.initialize()
+        if RESULT_CACHE_SIZE <= 0:
+            return self.search_uncached(queries, limit, fields, filters, mode)
         
-        # Формируем результаты
-        results = []
-        for i, idx in enumerate(indices[0]):
-            if idx < len(self.documents) and idx != -1:
-                doc = self.documents[idx]
-                results.append({
-                    'id': doc.get('id'),
-                    'title': doc.get('title', ''),
-                    'content': doc.get('content', ''),
-                    'category': doc.get('category', ''),
-                    'score': float(distances[0][i]),
-                    'similarity': 1.0 / (1.0 + float(distances[0][i]))  # Преобразуем расстояние в сходство
-                })
+        # Поколение читается до поиска: результат, посчитанный во время изменения
+        # индекса, попадет под старое поколение и больше не будет выдан
+        generation = self.generation
+        filters_key = json.dumps(filters, sort_keys=True, default=str)
+        keys = [(generation, normalize_query(query), limit, fields, filters_key, mode) for query in queries]
+        results = [self.result_cache.get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            found = self.search_uncached([queries[i] for i in missing], limit, fields, filters, mode)
+            for i, result in zip(missing, found):
+                results[i] = result
+                self.result_cache.put(keys[i], result)
+        return results
+    
+    def search_uncached(self, queries, limit=5, fields='full', filters=None, mode='vector'):
+        if mode == 'vector':
+            # Если индекс пустой, возвращаем пустой результат без обращения к модели
+            if len(self.vectors) == 0:
+                return [self.empty_result(fields) for _ in queries]
+            return self.search_embeddings(self.embed_queries(queries), limit, fields, filters)
         
-        # Сортируем по сходству (от большего к меньшему)
-        results.sort(key=lambda x: x['similarity'], reverse=True)
+        # Лексический поиск BM25; в гибридном режиме берем больше кандидатов
+        # из обоих списков и объединяем их ранги методом RRF
+        categories = self.parse_filters(filters)
+        candidates = limit * HYBRID_CANDIDATES if mode == 'hybrid' else limit
+        # Запросы кодируются до блокировки чтения, чтобы модель не задерживала записи
+        embeddings = self.embed_queries(queries) if mode == 'hybrid' and len(self.vectors) else None
+        with self.index_lock.reading():
+            rankings = [self.lexical_index.search(query, candidates, categories) for query in queries]
+            
+            if embeddings is not None and len(self.vectors):
+                if self.passages is not None and categories is None:
+                    _, indices, _, _ = self.search_passages(embeddings, candidates)
+                else:
+                    _, indices = self.vector_search(embeddings, candidates, categories)
+                rankings = [
+                    reciprocal_rank_fusion([[idx for idx in row if idx != -1], [doc_id for doc_id, _ in lexical]], RRF_K)
+                    for row, lexical in zip(indices.tolist(), rankings)
+                ]
+            
+            ids = np.full((len(queries), limit), -1, dtype='int64')
+            scores = np.zeros((len(queries), limit), dtype='float32')
+            for row, ranking in enumerate(rankings):
+                for col, (doc_id, score) in enumerate(ranking[:limit]):
+                    ids[row, col] = doc_id
+                    scores[row, col] = score
+            return self.assemble_results(scores, ids, fields, similarities=scores)
+    
+    def embed_queries(self, queries):
+        # Одиночный запрос идет через общий планировщик пачек
+        if len(queries) == 1:
+            return [self.embed_query(queries[0])]
         
-        return results
+        # Из кэша берем известные запросы, остальные кодируем одной пачкой
+        keys = [normalize_query(query) for query in queries]
+        embeddings = [self.query_cache.get(key) for key in keys]
+        missing = {}
+        for key, query, embedding in zip(keys, queries, embeddings):
+            if embedding is None:
+                missing.setdefault(key, query)
+        if missing:
+            encoded = dict(zip(missing, (e.tolist() for e in self.generate_embeddings(list(missing.values())))))
+            for key, embedding in encoded.items():
+                self.query_cache.put(key, embedding)
+            embeddings = [encoded[key] if embedding is None else embedding for key, embedding in zip(keys, embeddings)]
+        return embeddings
     
-    def search_by_embedding(self, embedding, limit=5):
+    def search_embeddings(self, embeddings, limit=5, fields='full', filters=None):
+        if fields not in RESULT_FIELDS:
+            raise ValueError(f"Unknown fields '{fields}', expected one of {', '.join(RESULT_FIELDS)}")
+        categories = self.parse_filters(filters)
         if not self.initialized:
             self.initialize()
         
-        # Если индекс пустой, возвращаем пустой результат
-        if self.index.ntotal == 0:
-            return []
+        with self.index_lock.reading():
+            # Если индекс пустой, возвращаем пустой результат
+            if len(self.vectors) == 0:
+                return [self.empty_result(fields) for _ in embeddings]
+            
+            # Без фильтров при включенном разбиении ищем по фрагментам; фильтры
+            # по категории обслуживаются индексами категорий на уровне документов
+            if self.passages is not None and categories is None:
+                # score остается L2-расстоянием до лучшего фрагмента, оценка
+                # агрегации фрагментов возвращается отдельно в passage_score
+                scores, indices, passage_ids, distances = self.search_passages(embeddings, limit)
+                return self.assemble_results(distances, indices, fields, passage_ids=passage_ids, passage_scores=scores)
+            
+            distances, indices = self.vector_search(embeddings, limit, categories)
+            return self.assemble_results(distances, indices, fields)
+    
+    def search_passages(self, embeddings, limit):
+        return self.passages.search(
+            embeddings, limit, PASSAGE_AGGREGATION, PASSAGE_TOP_N, PASSAGE_CANDIDATES
+        )
+    
+    def vector_search(self, embeddings, limit, categories=None):
+        # Все запросы ищутся одним вызовом по матрице N x EMBEDDING_SIZE
+        query_embedding_array = np.array(embeddings).astype('float32').reshape(-1, EMBEDDING_SIZE)
+        if categories is not None:
+            # С фильтром ищем только в индексах выбранных категорий
+            return self.category_indexes.search(query_embedding_array, limit, categories)
+        return self.vectors.search(query_embedding_array, min(limit, len(self.vectors)))
+    
+    def parse_filters(self, filters):
+        if not filters:
+            return None
+        unknown = set(filters) - set(SEARCH_FILTERS)
+        if unknown:
+            raise ValueError(f"Unsupported filters: {', '.join(sorted(unknown))}")
         
-        # Преобразуем embedding в numpy array
-        query_embedding_array = np.array([embedding]).astype('float32')
+        category = filters.get('category')
+        if category is None:
+            return None
+        return [category] if isinstance(category, str) else list(category)
+    
+    def empty_result(self, fields):
+        return {'ids': [], 'scores': [], 'similarities': []} if fields == 'ids' else []
+    
+    def assemble_results(self, distances, indices, fields='full', similarities=None, passage_ids=None, passage_scores=None):
+        if fields not in RESULT_FIELDS:
+            raise ValueError(f"Unknown fields '{fields}', expected one of {', '.join(RESULT_FIELDS)}")
         
-        # Выполняем поиск
-        distances, indices = self.index.search(query_embedding_array, min(limit, self.index.ntotal))
+        # FAISS уже возвращает результаты по возрастанию расстояния, то есть
+        # по убыванию сходства, поэтому дополнительная сортировка не нужна.
+        # Расстояние в сходство переводится сразу для всей матрицы
+        if similarities is None:
+            similarities = 1.0 / (1.0 + distances)
+        valid = indices != -1
         
-        # Формируем результаты
-        results = []
-        for i, idx in enumerate(indices[0]):
-            if idx < len(self.documents) and idx != -1:
-                doc = self.documents[idx]
-                results.append({
-                    'id': doc.get('id'),
-                    'title': doc.get('title', ''),
-                    'content': doc.get('content', ''),
-                    'category': doc.get('category', ''),
-                    'score': float(distances[0][i]),
-                    'similarity': 1.0 / (1.0 + float(distances[0][i]))
-                })
+        if fields == 'ids':
+            results = [
+                {
+                    'ids': row_indices[row_valid].tolist(),
+                    'scores': row_distances[row_valid].tolist(),
+                    'similarities': row_similarities[row_valid].tolist()
+                }
+                for row_distances, row_similarities, row_indices, row_valid
+                in zip(distances, similarities, indices, valid)
+            ]
+            if passage_scores is not None:
+                for result, row_scores, row_valid in zip(results, passage_scores, valid):
+                    result['passage_scores'] = row_scores[row_valid].tolist()
+            return results
         
-        results.sort(key=lambda x: x['similarity'], reverse=True)
+        # Лучший фрагмент документа служит сниппетом вместо начала content
+        passages = {}
+        if passage_ids is not None:
+            passages = self.passages.store.get_many(set(passage_ids[valid].tolist()))
+        else:
+            passage_ids = np.full(indices.shape, -1, dtype='int64')
         
-        return results
+        # Документы для всех запросов читаем одним запросом к хранилищу
+        if fields == 'snippet':
+            content_length = 0 if passages else SNIPPET_LENGTH
+        else:
+            content_length = None
+        docs = self.store.get_many(set(indices[valid].tolist()), content_length)
+        content_key = 'snippet' if fields == 'snippet' else 'content'
+        
+        # Формируем результаты для каждого запроса в исходном порядке
+        batch_results = []
+        for row, (row_distances, row_similarities, row_indices, row_passages) in enumerate(zip(
+                distances.tolist(), similarities.tolist(), indices.tolist(), passage_ids.tolist())):
+            results = []
+            for col, (distance, similarity, idx, passage_id) in enumerate(
+                    zip(row_distances, row_similarities, row_indices, row_passages)):
+                doc = docs.get(idx)
+                if doc is not None:
+                    result = {
+                        'id': idx,
+                        'title': doc.get('title', ''),
+                        content_key: doc.get('content', ''),
+                        'category': doc.get('category', ''),
+                        'score': distance,
+                        'similarity': similarity
+                    }
+                    passage = passages.get(passage_id)
+                    if passage is not None:
+                        result['snippet'] = passage['content']
+                        result['passage'] = {'start': passage.get('start'), 'end': passage.get('end')}
+                    if passage_scores is not None:
+                        result['passage_score'] = float(passage_scores[row, col])
+                    results.append(result)
+            batch_results.append(results)
+        
+        return batch_results
 
 # Создаем экземпляр сервиса
 service = FAISSService()
 
+# Эндпоинты, доступные до окончания загрузки модели и индекса
+NOT_GATED_ENDPOINTS = {'health_check', 'readiness', 'cache_stats', 'batching_stats', 'wal_stats'}
+first_response_logged = False
+
+def respond(result):
+    body, status_code = result
+    return jsonify(body), status_code
+
+@app.before_request
+def wait_until_ready():
+    if request.endpoint in NOT_GATED_ENDPOINTS or not service.loading and service.load_error is None:
+        return None
+    if service.ready.wait(READY_WAIT_TIMEOUT):
+        return None
+    
+    response, status_code = respond(handlers.not_ready(service))
+    response.headers['Retry-After'] = '5'
+    return response, status_code
+
+# Эндпоинты, изменяющие индекс; реплика только на чтение их отклоняет
+WRITE_ENDPOINTS = {'rebuild_index', 'add_document', 'add_documents_bulk', 'update_document', 'delete_document'}
+
+@app.before_request
+def reject_writes():
+    if READ_ONLY and request.endpoint in WRITE_ENDPOINTS:
+        return respond(handlers.read_only())
+    return None
+
+@app.after_request
+def log_first_response(response):
+    global first_response_logged
+    if not first_response_logged:
+        first_response_logged = True
+        logger.info(f"First response sent {time.monotonic() - PROCESS_STARTED:.2f}s after process start")
+    return response
+
 @app.route('/health', methods=['GET'])
 def health_check():
-    return jsonify({'status': 'ok', 'version': '1.0.0'})
+    return respond(handlers.health(service))
+
+@app.route('/ready', methods=['GET'])
+def readiness():
+    return respond(handlers.readiness(service))
 
 @app.route('/initialize', methods=['POST'])
 def initialize():
-    try:
-        service.initialize()
-        return jsonify({'status': 'ok', 'message': 'FAISS service initialized'})
-    except Exception as e:
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+    return respond(handlers.initialize(service))
+
+@app.route('/index/rebuild', methods=['POST'])
+def rebuild_index():
+    return respond(handlers.rebuild_index(service))
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return respond(handlers.cache_stats(service))
+
+@app.route('/batching/stats', methods=['GET'])
+def batching_stats():
+    return respond(handlers.batching_stats(service, EMBED_WORKERS))
+
+@app.route('/wal/stats', methods=['GET'])
+def wal_stats():
+    return respond(handlers.wal_stats(service))
 
 @app.route('/embed', methods=['POST'])
 def embed():
-    data = request.get_json()
-    
-    if not data or 'text' not in data:
-        return jsonify({'status': 'error', 'message': 'Missing text field'}), 400
-    
-    try:
-        embedding = service.generate_embedding(data['text'])
-        return jsonify({'status': 'ok', 'embedding': embedding})
-    except Exception as e:
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+    return respond(handlers.embed(service, request.get_json()))
 
 @app.route('/search', methods=['POST'])
 def search():
-    data = request.get_json()
-    
-    if not data:
-        return jsonify({'status': 'error', 'message': 'Missing request body'}), 400
-    
-    try:
-        if 'query' in data:
-            # Поиск по текстовому запросу
-            limit = int(data.get('limit', 5))
-            results = service.search(data['query'], limit)
-            return jsonify({'status': 'ok', 'results': results})
-        elif 'embedding' in data:
-            # Поиск по embedding
-            limit = int(data.get('limit', 5))
-            results = service.search_by_embedding(data['embedding'], limit)
-            return jsonify({'status': 'ok', 'results': results})
-        else:
-            return jsonify({'status': 'error', 'message': 'Missing query or embedding field'}), 400
-    except Exception as e:
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+    return respond(handlers.search(service, request.get_json()))
+
+@app.route('/search/batch', methods=['POST'])
+def search_batch():
+    return respond(handlers.search_batch(service, request.get_json()))
 
 @app.route('/documents', methods=['POST'])
 def add_document():
-    data = request.get_json()
-    
-    if not data or 'content' not in data or 'title' not in data:
-        return jsonify({'status': 'error', 'message': 'Missing required fields'}), 400
-    
+    return respond(handlers.add_document(service, request.get_json()))
+
+@app.route('/documents/bulk', methods=['POST'])
+def add_documents_bulk():
+    # Тело запроса - NDJSON, по одному документу на строку; читаем его потоком
+    ingest = handlers.BulkIngest(service, request.args.get('batch_size', BULK_BATCH_SIZE, type=int))
     try:
-        doc_id = service.add_document(data)
-        return jsonify({'status': 'ok', 'id': doc_id})
+        for line in request.stream:
+            batch = ingest.feed(line)
+            if batch:
+                ingest.write(batch)
+        ingest.finish()
     except Exception as e:
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+        return respond(ingest.failed(e))
+    return respond(ingest.result())
 
 @app.route('/documents/<int:doc_id>', methods=['PUT'])
 def update_document(doc_id):
-    data = request.get_json()
-    
-    if not data:
-        return jsonify({'status': 'error', 'message': 'Missing request body'}), 400
-    
-    try:
-        service.update_document(doc_id, data)
-        return jsonify({'status': 'ok', 'id': doc_id})
-    except ValueError as e:
-        return jsonify({'status': 'error', 'message': str(e)}), 404
-    except Exception as e:
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+    return respond(handlers.update_document(service, doc_id, request.get_json()))
 
 @app.route('/documents/<int:doc_id>', methods=['DELETE'])
 def delete_document(doc_id):
-    try:
-        success = service.delete_document(doc_id)
-        if success:
-            return jsonify({'status': 'ok'})
-        else:
-            return jsonify({'status': 'error', 'message': f'Document with ID {doc_id} not found'}), 404
-    except Exception as e:
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+    return respond(handlers.delete_document(service, doc_id))
 
 if __name__ == '__main__':
-    # Инициализируем сервис при запуске
-    try:
-        service.initialize()
-    except Exception as e:
-        logger.error(f"Failed to initialize service: {str(e)}")
+    # Инициализируем сервис при запуске: в фоне, чтобы порт открылся сразу,
+    # или синхронно при BACKGROUND_LOADING=0
+    if BACKGROUND_LOADING:
+        service.start_background_loading()
+    else:
+        try:
+            service.load_model()
+            service.initialize()
+            service.mark_ready()
+        except Exception as e:
+            logger.error(f"Failed to initialize service: {str(e)}")
     
     # Запускаем Flask-сервер
     port = int(os.environ.get('PORT', 5000))
@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import threading
+
+import faiss
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def replace_atomic(tmp_path, path):
+    # Сначала данные на диск, затем rename и синхронизация каталога:
+    # после сбоя на месте path лежит либо старый, либо новый файл целиком
+    fsync_path(tmp_path)
+    os.replace(tmp_path, path)
+    if os.name == 'posix':
+        fsync_path(os.path.dirname(os.path.abspath(path)))
+
+
+def write_index_atomic(index, path):
+    tmp_path = f'{path}.tmp'
+    faiss.write_index(index, tmp_path)
+    replace_atomic(tmp_path, path)
+
+
+def write_json_atomic(data, path):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    replace_atomic(tmp_path, path)
+
+
+def read_snapshot_seq(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f).get('seq', 0)
+
+
+class WriteAheadLog:
+    """Журнал изменений индекса с групповой фиксацией.
+
+    Каждая запись - строка JSON ``{"seq", "op", "ids"}``. Запись считается
+    сохраненной после fsync; одновременные вызовы ``append`` ждут не более
+    ``group_commit_ms`` и фиксируются одним fsync. После снимка индекса
+    записи до его номера удаляются через ``truncate``.
+    """
+
+    def __init__(self, path, group_commit_ms=2, fsync=True):
+        self.path = path
+        self.group_commit_wait = group_commit_ms / 1000.0
+        self.fsync = fsync
+        self.cond = threading.Condition()
+        self.buffer = []
+        self.seq = 0
+        self.synced_seq = 0
+        self.flushing = False
+        self.file = None
+        self.commits = 0
+        # Записи, уже сохраненные, но еще не примененные к индексам
+        self.unapplied = set()
+
+    def open(self, start_seq=0):
+        """Открывает журнал и возвращает записи с номером больше start_seq."""
+        records = []
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Оборванная последняя запись после сбоя
+                        continue
+                    if record['seq'] > start_seq:
+                        records.append(record)
+        self.seq = self.synced_seq = max([start_seq] + [record['seq'] for record in records])
+        # Оборванный хвост отрезается, чтобы новые записи начинались с новой строки
+        self._rewrite(records)
+        return records
+
+    def close(self):
+        with self.cond:
+            while self.flushing:
+                self.cond.wait()
+            if self.file:
+                self.file.close()
+                self.file = None
+
+    def append(self, op, ids):
+        """Добавляет запись и возвращается после ее сохранения на диск."""
+        with self.cond:
+            self.seq += 1
+            seq = self.seq
+            self.buffer.append(json.dumps({'seq': seq, 'op': op, 'ids': [int(i) for i in ids]}) + '\n')
+            self.unapplied.add(seq)
+            while self.synced_seq < seq:
+                if self.flushing:
+                    self.cond.wait()
+                else:
+                    try:
+                        self._commit_group()
+                    except Exception:
+                        self.unapplied.discard(seq)
+                        raise
+        return seq
+
+    def _commit_group(self):
+        # Вызывается под self.cond; первый ожидающий пишет записи всей группы
+        self.flushing = True
+        self.cond.release()
+        try:
+            if self.group_commit_wait > 0:
+                time.sleep(self.group_commit_wait)
+        finally:
+            self.cond.acquire()
+        lines, self.buffer = self.buffer, []
+        last_seq = self.seq
+        self.cond.release()
+        try:
+            self.file.write(''.join(lines))
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+        except Exception:
+            self.cond.acquire()
+            self.buffer[:0] = lines
+            self.flushing = False
+            self.cond.notify_all()
+            raise
+        self.cond.acquire()
+        self.synced_seq = last_seq
+        self.commits += 1
+        self.flushing = False
+        self.cond.notify_all()
+
+    def applied(self, seq):
+        with self.cond:
+            self.unapplied.discard(seq)
+
+    def checkpoint_seq(self):
+        """Номер, до которого включительно все записи отражены в индексах."""
+        with self.cond:
+            return min(self.unapplied) - 1 if self.unapplied else self.synced_seq
+
+    def truncate(self, seq):
+        """Удаляет записи, вошедшие в снимок с номером seq."""
+        with self.cond:
+            while self.flushing:
+                self.cond.wait()
+            records = []
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record['seq'] > seq:
+                        records.append(record)
+            self._rewrite(records)
+
+    def _rewrite(self, records):
+        if self.file:
+            self.file.close()
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(record) + '\n' for record in records))
+        replace_atomic(tmp_path, self.path)
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def stats(self):
+        with self.cond:
+            return {'seq': self.seq, 'synced_seq': self.synced_seq, 'commits': self.commits,
+                    'size_bytes': os.path.getsize(self.path) if os.path.exists(self.path) else 0}